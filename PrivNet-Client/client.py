@@ -3,134 +3,217 @@ import socket
 import re
 import html
 import os
+import time
+import functools
+import itertools
+import queue
+import threading
 
 os.environ['QT_QPA_PLATFORM_PLUGIN_PATH'] = os.path.join(os.path.dirname(__file__), 'platforms')
-
-from cryptography.fernet import Fernet
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from protocol.framing import FrameReader, encode_frame
+from protocol.compression import CAPS_COMMAND, DEFLATE, compress_payload, decompress_payload, parse_caps
+from protocol.aead import AEAD_MARKER, CIPHERS, Opener, Sealer, derive_key, master_key, parse_transport
+from protocol.compact import COMPACT, COMPACT_MARK, CompactDecoder, encode_command
+from protocol.heartbeat import HEARTBEAT, PING_COMMAND, PING_INTERVAL, PING_TIMEOUT, PONG_COMMAND, set_keepalive
 from PyQt5 import QtWidgets
-from PyQt5.QtGui import QTextCursor, QIcon
-from PyQt5.QtWidgets import QFileDialog, QTextEdit, QVBoxLayout, QPushButton, QWidget, QLineEdit, QLabel, QTabWidget, QSystemTrayIcon
-from PyQt5.QtCore import QThread, pyqtSignal, Qt
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import QFileDialog, QPlainTextEdit, QVBoxLayout, QPushButton, QWidget, QLineEdit, QLabel, QTabWidget, QSystemTrayIcon, QCheckBox, QListWidget
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, Qt
 from PyQt5.QtMultimedia import QSound
 
+# Chat view: lines arriving within one frame interval are rendered together,
+# the scrollback is capped, and sound/tray notifications are rate-limited.
+MAX_SCROLLBACK = 5000
+RENDER_INTERVAL_MS = 16
+SOUND_INTERVAL = 2.0
+NOTIFY_INTERVAL = 5.0
+
+# Every Fernet token starts with these bytes (version 0x80, then a timestamp).
+FERNET_PREFIX = b'gAAAAA'
+
+# Outgoing messages wait here for the background writer.
+SEND_QUEUE_SIZE = 100
+
+# How often the connection is checked for silence, and TCP keepalive idle
+# time (see protocol/heartbeat.py).
+HEARTBEAT_CHECK_MS = 5000
+TCP_KEEPALIVE = 60
+
+ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+mc_code = re.compile(r'&[0-9a-fl-or]', flags=re.IGNORECASE)
+
 def strip_ansi_codes(text):
-    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
     return ansi_escape.sub('', text)
 
 def strip_mc_codes(text):
     # Убирает все &-коды типа &a, &l, &r и т.п.
-    return re.sub(r'&[0-9a-fl-or]', '', text, flags=re.IGNORECASE)
-
+    return mc_code.sub('', text)
+
+mc_color_map = {
+    '0': 'black',        '1': 'darkblue',   '2': 'darkgreen',  '3': 'darkcyan',
+    '4': 'darkred',      '5': 'darkmagenta','6': 'goldenrod',  '7': 'gray',
+    '8': 'darkgray',     '9': 'blue',       'a': 'green',      'b': 'cyan',
+    'c': 'red',          'd': 'magenta',    'e': 'yellow',     'f': 'white'
+}
+mc_style_map = {
+    'l': 'font-weight:bold;',
+    'o': 'font-style:italic;',
+    'n': 'text-decoration:underline;',
+    'm': 'text-decoration:line-through;',
+}
+
+ansi_colors = {
+    '30': 'black',   '31': 'red',      '32': 'green',   '33': 'yellow',
+    '34': 'blue',    '35': 'magenta',  '36': 'cyan',    '37': 'white',
+    '90': 'gray',    '91': 'lightcoral', '92': 'lightgreen', '93': 'lightyellow',
+    '94': 'lightskyblue', '95': 'violet', '96': 'lightcyan', '97': 'white'
+}
+ansi_styles = {
+    '1': 'font-weight:bold;',          # bold
+    '4': 'text-decoration: underline;',# underline
+    '3': 'font-style: italic;',        # italic
+}
+ansi_sgr = re.compile(r'\033\[(.*?)m')
+
+def parse_mc_colors(text):
+    result = []
+    open_spans = 0
+    i = 0
+    while i < len(text):
+        if text[i] == '&' and i + 1 < len(text):
+            code = text[i+1].lower()
+            if code == 'r':
+                # Сброс всех стилей — просто закрыть все открытые <span>, НЕ открывать новый!
+                result.append('</span>' * open_spans)
+                open_spans = 0
+                i += 2
+                continue
+            elif code in mc_color_map:
+                result.append('</span>' * open_spans)
+                result.append(f'<span style="color:{mc_color_map[code]};">')
+                open_spans = 1
+                i += 2
+                continue
+            elif code in mc_style_map:
+                result.append(f'<span style="{mc_style_map[code]}">')
+                open_spans += 1
+                i += 2
+                continue
+        result.append(html.escape(text[i]))
+        i += 1
+    result.append('</span>' * open_spans)
+    return ''.join(result)
+
+def parse_ansi(text):
+    html_output = []
+    open_tags = 0
+    pos = 0
+    for match in ansi_sgr.finditer(text):
+        start, end = match.span()
+        html_output.append(text[pos:start])
+        html_output.append('</span>' * open_tags)
+        open_tags = 0
+        styles = ''
+        for code in match.group(1).split(';'):
+            if code in ansi_colors:
+                styles += f'color: {ansi_colors[code]};'
+            elif code in ansi_styles:
+                styles += ansi_styles[code]
+        if styles:
+            html_output.append(f'<span style="{styles}">')
+            open_tags = 1
+        pos = end
+    html_output.append(text[pos:])
+    html_output.append('</span>' * open_tags)
+    return ''.join(html_output)
+
+@functools.lru_cache(maxsize=4096)
 def pn_colors_to_html(text):
-    import html, re
-
-    mc_color_map = {
-        '0': 'black',        '1': 'darkblue',   '2': 'darkgreen',  '3': 'darkcyan',
-        '4': 'darkred',      '5': 'darkmagenta','6': 'goldenrod',  '7': 'gray',
-        '8': 'darkgray',     '9': 'blue',       'a': 'green',      'b': 'cyan',
-        'c': 'red',          'd': 'magenta',    'e': 'yellow',     'f': 'white'
-    }
-    mc_style_map = {
-        'l': 'font-weight:bold;',
-        'o': 'font-style:italic;',
-        'n': 'text-decoration:underline;',
-        'm': 'text-decoration:line-through;',
-    }
-
-    def parse_mc_colors(text):
-        result = ''
-        style_stack = []
-        i = 0
-        while i < len(text):
-            if text[i] == '&' and i + 1 < len(text):
-                code = text[i+1].lower()
-                if code == 'r':
-                    # Сброс всех стилей — просто закрыть все открытые <span>, НЕ открывать новый!
-                    while style_stack:
-                        result += '</span>'
-                        style_stack.pop()
-                    i += 2
-                    continue
-                elif code in mc_color_map:
-                    while style_stack:
-                        result += '</span>'
-                        style_stack.pop()
-                    color = mc_color_map[code]
-                    result += f'<span style="color:{color};">'
-                    style_stack.append('color')
-                    i += 2
-                    continue
-                elif code in mc_style_map:
-                    result += f'<span style="{mc_style_map[code]}">'
-                    style_stack.append('style')
-                    i += 2
-                    continue
-            result += html.escape(text[i])
-            i += 1
-        while style_stack:
-            result += '</span>'
-            style_stack.pop()
-        return result
-
-    ansi_colors = {
-        '30': 'black',   '31': 'red',      '32': 'green',   '33': 'yellow',
-        '34': 'blue',    '35': 'magenta',  '36': 'cyan',    '37': 'white',
-        '90': 'gray',    '91': 'lightcoral', '92': 'lightgreen', '93': 'lightyellow',
-        '94': 'lightskyblue', '95': 'violet', '96': 'lightcyan', '97': 'white'
-    }
-    ansi_styles = {
-        '1': 'font-weight:bold;',          # bold
-        '4': 'text-decoration: underline;',# underline
-        '3': 'font-style: italic;',        # italic
-    }
-
-    def parse_ansi(text):
-        html_output = ''
-        open_tags = []
-        ansi_escape = re.compile(r'\033\[(.*?)m')
-        pos = 0
-        for match in ansi_escape.finditer(text):
-            start, end = match.span()
-            html_output += text[pos:start]
-            codes = match.group(1).split(';')
-            while open_tags:
-                html_output += '</span>'
-                open_tags.pop()
-            styles = ''
-            for code in codes:
-                if code in ansi_colors:
-                    styles += f'color: {ansi_colors[code]};'
-                elif code in ansi_styles:
-                    styles += ansi_styles[code]
-            if styles:
-                html_output += f'<span style="{styles}">'
-                open_tags.append('span')
-            pos = end
-        html_output += text[pos:]
-        while open_tags:
-            html_output += '</span>'
-            open_tags.pop()
-        return html_output
-    
-    mc_parsed = parse_mc_colors(text)
-    ansi_parsed = parse_ansi(mc_parsed)
-    return ansi_parsed
+    # Cached: system lines, banners and repeated messages are converted once.
+    return parse_ansi(parse_mc_colors(text))
 
 class ClientWorker(QThread):
     new_message = pyqtSignal(str)
+    disconnected = pyqtSignal(str)
 
-    def __init__(self, client_socket, fernet=None):
+    def __init__(self, client_socket, fernet=None, master=None):
         super().__init__()
         self.client_socket = client_socket
+        self.reader = FrameReader(client_socket)
         self.fernet = fernet
         self.encrypted = fernet is not None
+        self.master = master
+        self.codec = None
+        self.opener = None
+        self.sealer = None
+        self.compact = None
+        self.caps_pending = False
+        self.heartbeat = False
+        self.last_seen = time.monotonic()
+        self.writer = None
+        self.lost_reason = None
         self._running = True
 
     def run(self):
         while self._running:
             message = self.recv_message()
+            if message is None:
+                break
+            self.last_seen = time.monotonic()
+            if self.caps_pending and self.handle_caps_reply(message):
+                continue
+            if self.heartbeat and self.handle_heartbeat(message):
+                continue
+            if self.compact and message.startswith(COMPACT_MARK):
+                try:
+                    message = self.compact.decode(message)
+                except ValueError:
+                    message = None
             if message:
                 self.new_message.emit(message)
+        if self._running:
+            self.disconnected.emit(self.lost_reason or "connection closed by the server")
+
+    def handle_heartbeat(self, message):
+        # Pings are answered here, off the GUI thread; pongs only count as
+        # a sign of life.
+        command, _, token = message.partition(' ')
+        if command == PING_COMMAND:
+            if self.writer:
+                self.writer.enqueue(f"{PONG_COMMAND} {token}")
+            return True
+        return command == PONG_COMMAND
+
+    def drop(self, reason):
+        # Unblocks run(), which then reports the connection as lost.
+        self.lost_reason = reason
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def handle_caps_reply(self, message):
+        # The server's answer to /caps is not shown; a server without
+        # /caps answers with "Unknown command" and keeps plain frames.
+        if message == CAPS_COMMAND or message.startswith(CAPS_COMMAND + ' '):
+            codecs = parse_caps(message[len(CAPS_COMMAND):])
+            self.codec = codecs[0] if codecs else None
+            transport = parse_transport(message[len(CAPS_COMMAND):])
+            if transport and self.master:
+                cipher, server_salt, session_salt = transport
+                self.opener = Opener(cipher, derive_key(self.master, server_salt, b'server'))
+                self.sealer = Sealer(cipher, derive_key(self.master, session_salt, b'client'))
+            if COMPACT in message.split():
+                self.compact = CompactDecoder()
+            self.heartbeat = HEARTBEAT in message.split()
+        elif not message.startswith("Unknown command"):
+            return False
+        self.caps_pending = False
+        return True
 
     def stop(self):
         self._running = False
@@ -139,22 +222,89 @@ class ClientWorker(QThread):
 
     def recv_message(self):
         try:
-            length_bytes = self.client_socket.recv(4)
-            if not length_bytes:
+            data = self.reader.read_frame()
+            if data is None:
                 return None
-            length = int.from_bytes(length_bytes, 'big')
-            data = self.client_socket.recv(length)
             if self.encrypted:
+                sealed = self.opener and data[:1] == AEAD_MARKER
                 try:
-                    return self.fernet.decrypt(data).decode()
-                except:
+                    if sealed:
+                        data = self.opener.open(data)
+                    else:
+                        data = self.fernet.decrypt(data)
+                    return self.decode_payload(data)
+                except (InvalidTag, InvalidToken, ValueError):
+                    if sealed or data.startswith(FERNET_PREFIX):
+                        # Replayed, stale or forged: only this frame is
+                        # dropped, the connection stays encrypted.
+                        return ''
+                    # Not encrypted at all: the server has encryption off.
                     self.encrypted = False
                     return data.decode(errors='ignore')
             else:
-                return data.decode(errors='ignore')
-        except:
+                return self.decode_payload(data, errors='ignore')
+        except (OSError, ValueError):
             return None
 
+    def decode_payload(self, data, errors='strict'):
+        # Frames are deflated only once both sides agreed on it in /caps.
+        if self.codec == DEFLATE:
+            data = decompress_payload(data)
+        return data.decode(errors=errors)
+
+class ClientWriter(QObject):
+    # Encrypts and sends on its own thread, over the socket and negotiated
+    # state of the ClientWorker, so a slow link never blocks the GUI.
+    sent = pyqtSignal(int)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, client_socket, worker, fernet=None, max_queue=SEND_QUEUE_SIZE):
+        super().__init__()
+        self.client_socket = client_socket
+        self.worker = worker
+        self.fernet = fernet
+        self.queue = queue.Queue(max_queue)
+        self.ids = itertools.count(1)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def enqueue(self, message):
+        # Returns the message id, or None when the queue is full.
+        message_id = next(self.ids)
+        try:
+            self.queue.put_nowait((message_id, message))
+        except queue.Full:
+            return None
+        return message_id
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def encode(self, message):
+        if self.worker.compact:
+            message = encode_command(message)
+        data = message.encode()
+        if self.worker.codec == DEFLATE:
+            data = compress_payload(data)
+        if self.worker.sealer:
+            data = self.worker.sealer.seal(data)
+        elif self.fernet:
+            data = self.fernet.encrypt(data)
+        return encode_frame(data)
+
+    def run(self):
+        while True:
+            message_id, message = self.queue.get()
+            if message_id is None:
+                break
+            try:
+                self.client_socket.sendall(self.encode(message))
+                self.sent.emit(message_id)
+            except Exception as e:
+                self.failed.emit(message_id, str(e))
+
+    def stop(self):
+        self.queue.put((None, None))
+
 class ClientGUI(QWidget):
     def __init__(self):
         super().__init__()
@@ -162,9 +312,16 @@ class ClientGUI(QWidget):
         self.setGeometry(100, 100, 800, 600)
 
         self.fernet = None
+        self.master_key = None
         self.client_socket = None
         self.worker = None
+        self.writer = None
+        self.outbox_items = {}
         self.is_connected = False
+        self.last_ping = 0.0
+        self.heartbeat_timer = QTimer(self)
+        self.heartbeat_timer.setInterval(HEARTBEAT_CHECK_MS)
+        self.heartbeat_timer.timeout.connect(self.check_heartbeat)
 
         self.layout = QVBoxLayout()
         self.tabs = QTabWidget()
@@ -179,16 +336,30 @@ class ClientGUI(QWidget):
         self.input_connect.setPlaceholderText("192.168.1.10:12345")
         self.btn_connect = QPushButton("Connect")
         self.btn_connect.clicked.connect(self.connect_to_server)
-        self.chat_display = QTextEdit()
+        self.chat_display = QPlainTextEdit()
         self.chat_display.setReadOnly(True)
+        self.chat_display.setUndoRedoEnabled(False)
+        self.chat_display.setMaximumBlockCount(MAX_SCROLLBACK)
+        self.pending = []
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(RENDER_INTERVAL_MS)
+        self.render_timer.timeout.connect(self.flush_messages)
+        self.last_sound = 0.0
+        self.last_notify = 0.0
+        self.outbox = QListWidget()
+        self.outbox.setMaximumHeight(80)
+        self.outbox.setVisible(False)
+        self.outbox.itemClicked.connect(self.dismiss_outbox_item)
         self.message_input = QLineEdit()
         self.message_input.setPlaceholderText("Enter message")
         self.message_input.returnPressed.connect(self.send_message)
         self.btn_load_key = QPushButton("Load Key")
         self.btn_load_key.clicked.connect(self.load_key)
+        self.check_compact = QCheckBox("Compact protocol (slow links)")
 
-        for widget in [self.label, self.input_connect, self.btn_connect,
-                       self.chat_display, self.message_input, self.btn_load_key]:
+        for widget in [self.label, self.input_connect, self.check_compact, self.btn_connect,
+                       self.chat_display, self.outbox, self.message_input, self.btn_load_key]:
             self.tab_connect.layout.addWidget(widget)
 
         self.tab_connect.setLayout(self.tab_connect.layout)
@@ -212,7 +383,7 @@ class ClientGUI(QWidget):
         self.chat_display.resizeEvent = self.auto_scroll_on_resize
 
     def auto_scroll_on_resize(self, event):
-        QTextEdit.resizeEvent(self.chat_display, event)
+        QPlainTextEdit.resizeEvent(self.chat_display, event)
         self.scroll_to_bottom()
 
     def scroll_to_bottom(self):
@@ -220,11 +391,26 @@ class ClientGUI(QWidget):
             self.chat_display.verticalScrollBar().maximum())
 
     def append_message(self, message_html):
-        formatted = f"<div style='white-space: pre-wrap; word-wrap: break-word;'>{message_html}</div>"
-        self.chat_display.moveCursor(QTextCursor.End)
-        self.chat_display.insertHtml(formatted + "<br>")
+        # Status lines from the GUI itself; queued chat lines go first.
+        self.flush_messages()
+        self.chat_display.appendHtml(f"<span style='white-space: pre-wrap;'>{message_html}</span>")
         self.scroll_to_bottom()
 
+    def flush_messages(self):
+        self.render_timer.stop()
+        if not self.pending:
+            return
+        messages, self.pending = self.pending, []
+        bar = self.chat_display.verticalScrollBar()
+        follow = bar.value() >= bar.maximum()
+        self.chat_display.setUpdatesEnabled(False)
+        for message in messages[-MAX_SCROLLBACK:]:
+            self.chat_display.appendHtml(f"<span style='white-space: pre-wrap;'>{pn_colors_to_html(message)}</span>")
+        self.chat_display.setUpdatesEnabled(True)
+        if follow:
+            self.scroll_to_bottom()
+        self.notify(messages)
+
     def show_ascii_art(self):
         ascii_art = """
         ______        _         _   _        _   
@@ -238,8 +424,8 @@ class ClientGUI(QWidget):
         Enter IP:PORT and load the key.
         Enjoy chatting!
         """
-        html_content = f"<div style='white-space: pre-wrap; font-family: monospace; word-wrap: break-word;'>{ascii_art}</div>"
-        self.chat_display.insertHtml(html_content + "<br>")
+        html_content = f"<pre style='font-family: monospace;'>{ascii_art}</pre>"
+        self.chat_display.appendHtml(html_content)
 
     def load_key(self):
         options = QFileDialog.Options()
@@ -248,6 +434,7 @@ class ClientGUI(QWidget):
             with open(filepath, 'r') as f:
                 key = f.read().strip()
                 self.fernet = Fernet(key.encode())
+                self.master_key = master_key(key.encode())
             self.append_message('<span style="color:green">[+] Key loaded successfully.</span>')
 
     def connect_to_server(self):
@@ -257,10 +444,22 @@ class ClientGUI(QWidget):
             port = int(port)
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((ip, port))
+            set_keepalive(self.client_socket, TCP_KEEPALIVE)
 
-            self.worker = ClientWorker(self.client_socket, self.fernet)
+            self.worker = ClientWorker(self.client_socket, self.fernet, self.master_key)
             self.worker.new_message.connect(self.handle_colored_message)
+            self.worker.disconnected.connect(self.connection_lost)
+            self.worker.caps_pending = True
+            self.writer = ClientWriter(self.client_socket, self.worker, self.fernet)
+            self.writer.sent.connect(self.message_sent)
+            self.writer.failed.connect(self.message_failed)
+            self.worker.writer = self.writer
             self.worker.start()
+            self.heartbeat_timer.start()
+            offer = [CAPS_COMMAND, DEFLATE, HEARTBEAT] + (list(CIPHERS) if self.fernet else [])
+            if self.check_compact.isChecked():
+                offer.append(COMPACT)
+            self.send_with_optional_encryption(' '.join(offer), track=False)
 
             self.is_connected = True
             self.toggle_load_key_button()
@@ -274,36 +473,99 @@ class ClientGUI(QWidget):
         except Exception as e:
             self.append_message(f'<span style="color:red">[!] Connection error: {e}</span>')
 
+    def check_heartbeat(self):
+        # Pings a server that has been quiet for a while and drops the
+        # connection when it stops answering.
+        if not self.worker or not self.worker.heartbeat:
+            return
+        now = time.monotonic()
+        silent = now - self.worker.last_seen
+        if silent >= PING_TIMEOUT:
+            self.heartbeat_timer.stop()
+            self.worker.drop(f"no reply from the server for {silent:.0f} s")
+        elif silent >= PING_INTERVAL and now - self.last_ping >= PING_INTERVAL:
+            self.last_ping = now
+            self.writer.enqueue(f"{PING_COMMAND} {int(now * 1000)}")
+
+    def connection_lost(self, reason):
+        self.heartbeat_timer.stop()
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+        try:
+            self.client_socket.close()
+        except OSError:
+            pass
+        self.is_connected = False
+        self.toggle_load_key_button()
+        self.append_message(f'<span style="color:red">[!] Disconnected: {html.escape(reason)}</span>')
+
     def send_message(self):
         message = self.message_input.text().strip()
         if message:
             self.send_with_optional_encryption(message)
             self.message_input.clear()
 
-    def send_with_optional_encryption(self, message):
-        if self.client_socket:
-            try:
-                if self.fernet:
-                    data = self.fernet.encrypt(message.encode())
-                else:
-                    data = message.encode()
-                self.client_socket.sendall(len(data).to_bytes(4, 'big') + data)
-            except Exception as e:
-                self.append_message(f'<span style="color:red">[!] Failed to send: {e}</span>')
+    def send_with_optional_encryption(self, message, track=True):
+        # Queued for the writer thread; the outbox lists the message until
+        # it is sent, or shows why it failed.
+        if not self.writer:
+            return
+        message_id = self.writer.enqueue(message)
+        if message_id is None:
+            self.append_message(f'<span style="color:red">[!] Failed to send: send queue full ({SEND_QUEUE_SIZE} messages)</span>')
+        elif track:
+            self.outbox_items[message_id] = message
+            self.outbox.addItem(f"⏳ {message}")
+            self.outbox.setVisible(True)
+
+    def outbox_row(self, message_id):
+        ids = list(self.outbox_items)
+        return ids.index(message_id) if message_id in ids else None
+
+    def message_sent(self, message_id):
+        row = self.outbox_row(message_id)
+        if row is not None:
+            self.outbox.takeItem(row)
+            del self.outbox_items[message_id]
+        self.outbox.setVisible(self.outbox.count() > 0)
+
+    def message_failed(self, message_id, error):
+        row = self.outbox_row(message_id)
+        if row is not None:
+            self.outbox.item(row).setText(f"✖ {self.outbox_items[message_id]} ({error}) — click to dismiss")
+        else:
+            self.append_message(f'<span style="color:red">[!] Failed to send: {html.escape(error)}</span>')
+
+    def dismiss_outbox_item(self, item):
+        row = self.outbox.row(item)
+        if item.text().startswith("✖"):
+            self.outbox.takeItem(row)
+            del self.outbox_items[list(self.outbox_items)[row]]
+        self.outbox.setVisible(self.outbox.count() > 0)
 
     def strip_mc_codes(text):
     # Убирает все &-коды типа &a, &l, &r и т.п.
         return re.sub(r'&[0-9a-fl-or]', '', text, flags=re.IGNORECASE)
 
     def handle_colored_message(self, message):
-        html_message = pn_colors_to_html(message)
-        self.append_message(html_message)
-        self.ringtone.play()
-
-        if QtWidgets.QApplication.applicationState() == Qt.ApplicationInactive:
-            clean_message = strip_ansi_codes(message)
+        self.pending.append(message)
+        if not self.render_timer.isActive():
+            self.render_timer.start()
+
+    def notify(self, messages):
+        now = time.monotonic()
+        if now - self.last_sound >= SOUND_INTERVAL:
+            self.last_sound = now
+            self.ringtone.play()
+
+        if QtWidgets.QApplication.applicationState() == Qt.ApplicationInactive and now - self.last_notify >= NOTIFY_INTERVAL:
+            self.last_notify = now
+            clean_message = strip_ansi_codes(messages[-1])
             clean_message = strip_mc_codes(clean_message)  # убираем &-коды для уведомлений
             clean_message = html.unescape(clean_message)
+            if len(messages) > 1:
+                clean_message = f"{clean_message}\n(+{len(messages) - 1} more)"
             self.tray_icon.showMessage("New message", clean_message, QSystemTrayIcon.Information, 5000)
 
     def toggle_load_key_button(self):
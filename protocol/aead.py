@@ -0,0 +1,109 @@
+# Binary AEAD transport (AES-GCM or ChaCha20-Poly1305), negotiated with /caps
+# as an alternative to Fernet:
+#
+#   client -> server   /caps deflate aesgcm chacha20
+#   server -> client   /caps deflate aesgcm <server salt> <session salt>
+#
+# Both sides derive their keys from secret.key with HKDF-SHA256, one key per
+# connection and direction: server -> client from the server salt, client ->
+# server from the session salt. Each key has its own counter, so how far a
+# frame can fall behind depends only on that connection's own traffic.
+#
+# Payload: 0x01 | counter (varint) | ciphertext + 16-byte tag. The nonce is the
+# counter zero-padded to 12 bytes and never repeats under a key. A Fernet
+# token always starts with 'g', so both kinds of frames can be told apart
+# while a connection switches over.
+
+import base64
+import os
+import threading
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+AEAD_MARKER = b'\x01'
+CIPHERS = {'aesgcm': AESGCM, 'chacha20': ChaCha20Poly1305}
+NONCE_SIZE = 12
+SALT_SIZE = 16
+REPLAY_WINDOW = 1024
+
+class ReplayError(ValueError):
+    pass
+
+def master_key(fernet_key):
+    # secret.key is a urlsafe-base64 Fernet key: 32 random bytes.
+    return base64.urlsafe_b64decode(fernet_key.strip())
+
+def derive_key(master, salt, label):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b'openprivnet ' + label).derive(master)
+
+def new_salt():
+    return os.urandom(SALT_SIZE)
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def decode_varint(data, pos=0):
+    value = shift = 0
+    while True:
+        if pos >= len(data) or shift > 7 * NONCE_SIZE:
+            raise ValueError("malformed counter")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def parse_transport(args):
+    # "<cipher> <server salt> <session salt>" from a /caps reply, or None.
+    tokens = args.split()
+    for i, token in enumerate(tokens):
+        if token in CIPHERS and len(tokens) >= i + 3:
+            return token, bytes.fromhex(tokens[i + 1]), bytes.fromhex(tokens[i + 2])
+    return None
+
+class Sealer:
+    def __init__(self, cipher, key):
+        self.cipher = cipher
+        self.aead = CIPHERS[cipher](key)
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def seal(self, data):
+        with self.lock:
+            self.counter += 1
+            counter = self.counter
+        return AEAD_MARKER + encode_varint(counter) + self.aead.encrypt(counter.to_bytes(NONCE_SIZE, 'big'), data, None)
+
+class Opener:
+    # Frames may arrive out of order (several threads seal for the same
+    # connection), so replays are caught with a sliding window instead of a
+    # strict counter.
+
+    def __init__(self, cipher, key, window=REPLAY_WINDOW):
+        self.cipher = cipher
+        self.aead = CIPHERS[cipher](key)
+        self.window = window
+        self.mask = (1 << window) - 1
+        self.highest = 0
+        self.seen = 0
+
+    def open(self, payload):
+        counter, pos = decode_varint(payload, len(AEAD_MARKER))
+        behind = self.highest - counter
+        if counter == 0 or counter >> 8 * NONCE_SIZE or behind >= self.window or (behind >= 0 and self.seen >> behind & 1):
+            raise ReplayError(f"replayed or stale frame (counter {counter})")
+        data = self.aead.decrypt(counter.to_bytes(NONCE_SIZE, 'big'), payload[pos:], None)
+        if behind < 0:
+            self.seen = (self.seen << -behind | 1) & self.mask if -behind < self.window else 1
+            self.highest = counter
+        else:
+            self.seen |= 1 << behind
+        return data
@@ -0,0 +1,159 @@
+# Opt-in compact protocol ("compact" in /caps) for slow links. Instead of the
+# full "[HH:MM] [&2#channel&r] prefix &9nick&r: text" line the server sends
+# short records, and the client rebuilds the line itself:
+#
+#   D<id> <string>        defines a nick/channel/prefix id (base 36)
+#   D=                    forget all ids: the server's table started over
+#   T<minutes>            clock step since the previous T (mod one day)
+#   T=<minutes>           clock reset: minutes since midnight, server time
+#   M<chan>,<prefix>,<nick> <text>     channel message
+#   P><nick> <text>  /  P<<nick> <text>    private message to / from a nick
+#
+# A compact payload starts with 0x02 and holds one or more records split by
+# 0x1e; only the last one (M or P) can carry free text. Ids are server-wide,
+# so the same channel message frame is still shared by all compact clients;
+# definitions and clock steps a session has not seen yet go in front of it.
+# The table holds at most MAX_STRINGS; when full it starts over with a new
+# generation, and each client gets D= before the first id of the new one.
+#
+# The client sends commands as 0x02<opcode> <args>.
+
+import threading
+
+COMPACT = 'compact'
+COMPACT_MARK = '\x02'
+SEPARATOR = '\x1e'
+DAY_MINUTES = 24 * 60
+MAX_STRINGS = 1 << 14
+
+COMMANDS = (
+    '/nick', '/prefix', '/join', '/leave', '/who', '/list', '/topic', '/msg', '/help', '/version',
+    '/admins', '/ahelp', '/kick', '/banip', '/tempban', '/bansubnet', '/warn', '/bans', '/unban',
+    '/plugin_reload', '/caps', '/stats', '/ping', '/pong',
+)
+OPCODES = {command: str(i) for i, command in enumerate(COMMANDS, 1)}
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def to_base36(value):
+    out = ''
+    while True:
+        value, digit = divmod(value, 36)
+        out = DIGITS[digit] + out
+        if not value:
+            return out
+
+def encode_command(message):
+    command, sep, args = message.partition(' ')
+    if command not in OPCODES:
+        return message
+    return COMPACT_MARK + OPCODES[command] + sep + args
+
+def decode_command(message):
+    opcode, sep, args = message[len(COMPACT_MARK):].partition(' ')
+    if not opcode.isdigit() or not 1 <= int(opcode) <= len(COMMANDS):
+        raise ValueError(f"unknown opcode {opcode!r}")
+    return COMMANDS[int(opcode) - 1] + sep + args
+
+def minute_of_day(t):
+    return t.tm_hour * 60 + t.tm_min
+
+def channel_record(channel_id, prefix_id, nick_id, text):
+    return f"M{channel_id},{prefix_id},{nick_id} {text}"
+
+def private_record(outgoing, nick_id, text):
+    return f"P{'>' if outgoing else '<'}{nick_id} {text}"
+
+class StringTable:
+    # Server-wide string -> id map; id 0 is the empty string.
+
+    def __init__(self, max_strings=MAX_STRINGS):
+        self.lock = threading.Lock()
+        self.max_strings = max_strings
+        self.generation = 0
+        self.ids = {'': '0'}
+
+    def intern(self, *texts):
+        # Returns (generation, ids): all ids of one call are from the same
+        # generation, even when the table starts over for them.
+        with self.lock:
+            missing = {text for text in texts if text not in self.ids}
+            if len(self.ids) + len(missing) > self.max_strings:
+                self.generation += 1
+                self.ids = {'': '0'}
+            for text in texts:
+                if text not in self.ids:
+                    self.ids[text] = to_base36(len(self.ids))
+            return self.generation, [self.ids[text] for text in texts]
+
+class CompactSession:
+    # What one client has been told so far. Callers hold `lock` from
+    # prelude() until the frame is queued, so records reach the client in
+    # the order they were decided on.
+
+    def __init__(self, generation=None):
+        self.lock = threading.Lock()
+        self.known = {'0'}
+        self.clock = None
+        self.dropped = 0
+        self.generation = generation
+
+    def prelude(self, generation, definitions, minute, dropped=0):
+        # definitions: (id, string) pairs the record uses, from `generation`.
+        if dropped != self.dropped:
+            # Frames were dropped from the send queue, maybe definitions too.
+            self.known = {'0'}
+            self.clock = None
+            self.dropped = dropped
+        records = []
+        if generation != self.generation:
+            records.append('D=')
+            self.known = {'0'}
+            self.generation = generation
+        if self.clock is None:
+            records.append(f"T={minute}")
+        elif minute != self.clock:
+            records.append(f"T{(minute - self.clock) % DAY_MINUTES}")
+        self.clock = minute
+        for sid, text in definitions:
+            if sid not in self.known:
+                records.append(f"D{sid} {text}")
+                self.known.add(sid)
+        return records
+
+class CompactDecoder:
+    # Client side: turns compact payloads back into the usual text lines.
+
+    def __init__(self):
+        self.strings = {'0': ''}
+        self.clock = 0
+
+    def timestamp(self):
+        return f"[{self.clock // 60:02}:{self.clock % 60:02}]"
+
+    def decode(self, payload):
+        if not payload.startswith(COMPACT_MARK):
+            return payload
+        rest = payload[len(COMPACT_MARK):]
+        while rest[:1] in ('D', 'T'):
+            record, _, rest = rest.partition(SEPARATOR)
+            if record.startswith('T='):
+                self.clock = int(record[2:]) % DAY_MINUTES
+            elif record[0] == 'T':
+                self.clock = (self.clock + int(record[1:])) % DAY_MINUTES
+            elif record == 'D=':
+                self.strings = {'0': ''}
+            else:
+                sid, _, text = record[1:].partition(' ')
+                self.strings[sid] = text
+        if rest.startswith('M'):
+            ids, _, text = rest[1:].partition(' ')
+            channel, prefix, nick = (self.strings.get(i, '?') for i in ids.split(','))
+            return f"{self.timestamp()} [&2#{channel}&r] {prefix} &9{nick}&r: {text}"
+        if rest.startswith('P'):
+            sid, _, text = rest[2:].partition(' ')
+            nick = self.strings.get(sid, '?')
+            if rest[1] == '>':
+                return f"{self.timestamp()} [You ➔ {nick}]: {text}"
+            return f"{self.timestamp()} [{nick} ➔ You]: {text}"
+        return None
@@ -0,0 +1,53 @@
+# Optional per-message compression, negotiated at connect time:
+#
+#   client -> server   /caps deflate
+#   server -> client   /caps deflate      (or just "/caps" if it is off)
+#
+# Every message is compressed on its own (raw deflate primed with a preset
+# dictionary of common protocol strings), so a broadcast is still compressed
+# and encrypted once for all clients. A compressed payload starts with the
+# byte 0x01; anything else is plain UTF-8, so messages that would not shrink
+# are simply sent as they are. A message that starts with 0x01 itself is
+# always sent compressed, so the flag is never ambiguous.
+
+import zlib
+
+CAPS_COMMAND = '/caps'
+DEFLATE = 'deflate'
+CODECS = (DEFLATE,)
+
+DEFLATE_FLAG = b'\x01'
+DEFAULT_MAX_SIZE = 1 << 20
+
+# zlib favours the end of the dictionary, so the most common strings go last.
+PRESET_DICTIONARY = (
+    "Usage: /kick <nick> <reason> /banip /tempban <minutes> /bansubnet <cidr> /warn /unban "
+    "/nick <name> /prefix <prefix> /join <channel> /leave /who /list /topic [text] /msg <nick> <text> "
+    "Unknown command. Type /help You don't have admin privileges. User not found. "
+    "Nick must contain only latin letters and numbers, 3-16 characters. Nick is already in use. "
+    "First set your nick with /nick <name> You're not in a channel. Use /join <channel_name> "
+    "Channel list: Topic of # has no topic. Admins in channel # Server version: Prefix set: "
+    "has been kicked. has been warned has been IP banned on has been banned for warnings. "
+    "You left channel # You joined channel # Topic: members: Nick set: [System] Admin "
+    "kicked user for reason: joined the channel. left the channel. "
+    " ➔ You]: [You ➔ the a to and is it you I that of in this for ok yes no what "
+    "[00:00] [&2#general&r]  &9&r: [12:34] [&2#main&r]  &9&r: "
+).encode()
+
+def compress_payload(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, PRESET_DICTIONARY)
+    packed = DEFLATE_FLAG + compressor.compress(data) + compressor.flush()
+    return packed if len(packed) < len(data) or data[:1] == DEFLATE_FLAG else data
+
+def decompress_payload(data, max_size=DEFAULT_MAX_SIZE):
+    if data[:1] != DEFLATE_FLAG:
+        return data
+    decompressor = zlib.decompressobj(-15, PRESET_DICTIONARY)
+    # Bounded, so a tiny frame cannot inflate into something huge.
+    text = decompressor.decompress(data[1:], max_size)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("compressed message is truncated or larger than the limit")
+    return text
+
+def parse_caps(args):
+    return [codec for codec in args.split() if codec in CODECS]
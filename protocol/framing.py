@@ -0,0 +1,120 @@
+# openPrivNet framing: 4-byte big-endian length + payload. Shared by the
+# server and the client.
+
+HEADER_SIZE = 4
+DEFAULT_MAX_FRAME = 1 << 20
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+class FrameTooLarge(ValueError):
+    pass
+
+def frame_header(length):
+    return length.to_bytes(HEADER_SIZE, 'big')
+
+def encode_frame(payload):
+    return frame_header(len(payload)) + payload
+
+def parse_header(header, max_frame=DEFAULT_MAX_FRAME):
+    length = int.from_bytes(header, 'big')
+    if length > max_frame:
+        raise FrameTooLarge(f"frame of {length} bytes exceeds the {max_frame} byte limit")
+    return length
+
+class FrameReader:
+    # Reads frames with recv_into() into one preallocated buffer. A single
+    # recv can carry several frames; they are handed out without further
+    # syscalls, and each payload is copied out exactly once. Oversized
+    # lengths are rejected before anything is allocated for them.
+
+    def __init__(self, sock, max_frame=DEFAULT_MAX_FRAME, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.sock = sock
+        self.max_frame = max_frame
+        self.buffer_size = buffer_size
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def read_frame(self):
+        # Returns the next payload, or None when the peer closed the connection.
+        while True:
+            available = self.end - self.start
+            if available >= HEADER_SIZE:
+                length = parse_header(self.view[self.start:self.start + HEADER_SIZE], self.max_frame)
+                total = HEADER_SIZE + length
+                if available >= total:
+                    payload = bytes(self.view[self.start + HEADER_SIZE:self.start + total])
+                    self.start += total
+                    return payload
+                self._make_room(total)
+            else:
+                self._make_room(HEADER_SIZE)
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return None
+            self.end += received
+
+    def buffered(self):
+        # Bytes received but not handed out yet (a connection being handed over).
+        return bytes(self.view[self.start:self.end])
+
+    def feed(self, data):
+        # Bytes another reader already took from the socket; they come first.
+        available = self.end - self.start
+        if self.end + len(data) > len(self.buf):
+            self._resize(max(self.buffer_size, available + len(data)))
+            self.start, self.end = 0, available
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def _make_room(self, total):
+        available = self.end - self.start
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > self.buffer_size:
+                self._resize(self.buffer_size)
+            return
+        if self.start + total <= len(self.buf):
+            return
+        if total > len(self.buf):
+            self._resize(total)
+        else:
+            self.view[:available] = self.view[self.start:self.end]
+        self.start, self.end = 0, available
+
+    def _resize(self, size):
+        available = self.end - self.start
+        buf = bytearray(size)
+        buf[:available] = self.view[self.start:self.end]
+        self.view.release()
+        self.buf = buf
+        self.view = memoryview(buf)
+
+# Vectored output: a frame is a (header, payload) pair of buffers so that
+# several frames can go out in one sendmsg() without being concatenated.
+
+IOV_MAX = 1024
+
+def frame_parts(payload):
+    return (frame_header(len(payload)), payload)
+
+def send_vectored(sock, parts):
+    # Sends all buffers, returns the number of syscalls it took.
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(parts))
+        return 1
+    views = [memoryview(p) for p in parts if len(p)]
+    first = 0
+    calls = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + IOV_MAX])
+        calls += 1
+        while sent:
+            size = views[first].nbytes
+            if sent >= size:
+                sent -= size
+                first += 1
+            else:
+                views[first] = views[first][sent:]
+                sent = 0
+    return calls
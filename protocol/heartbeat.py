@@ -0,0 +1,44 @@
+# Heartbeat, negotiated at connect time like compression:
+#
+#   client -> server   /caps ... ping
+#   server -> client   /caps ... ping      (absent if the server has it off)
+#
+# Then a side that has heard nothing from the other for PING_INTERVAL
+# seconds sends "/ping <token>" and the other answers "/pong <token>". Any
+# frame counts as a sign of life, so a busy connection never pings, and a
+# side that hears nothing for PING_TIMEOUT seconds drops the connection.
+# Pings are never shown to the user.
+#
+# TCP keepalive catches peers that vanished without the heartbeat (older
+# clients and servers): the kernel probes an idle connection and fails the
+# next recv() when the probes go unanswered.
+
+import socket
+
+HEARTBEAT = 'ping'
+PING_COMMAND = '/ping'
+PONG_COMMAND = '/pong'
+PING_INTERVAL = 30
+PING_TIMEOUT = 90
+
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_PROBES = 6
+
+def set_keepalive(sock, idle, interval=KEEPALIVE_INTERVAL, probes=KEEPALIVE_PROBES):
+    # Probes start after `idle` seconds of silence; the connection is dropped
+    # after `probes` unanswered ones, or (Linux) when sent data stays
+    # unacknowledged for as long.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+        return
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, probes)
+    if hasattr(socket, 'TCP_USER_TIMEOUT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, (idle + interval * probes) * 1000)
@@ -0,0 +1,255 @@
+import asyncio
+import os
+import socket
+
+import log
+from outbound import OutboundQueue, QueueOverflow, DROP_OLDEST, BLOCK, MAX_BATCH, as_parts, record_write
+from protocol.framing import HEADER_SIZE, FrameTooLarge, parse_header
+from protocol.heartbeat import set_keepalive
+
+# Single event loop engine: accept, framing, command dispatch and channel
+# fan-out all run on one thread. Selected with "engine": "asyncio" in config.json.
+
+# The loop, listening server and open connections, for a restart (park()).
+loop = None
+listener = None
+handler = None
+connections = set()
+
+class StreamSocket(OutboundQueue):
+    # Socket-like facade over a StreamWriter, so send_encrypted(), kicks and
+    # plugins keep using client['socket'] exactly as in the threaded engine.
+    # Frames go through a bounded queue drained by the connection's own task,
+    # which passes each coalesced batch to the transport in one writelines().
+    # That is one call, not one vectored write: before Python 3.12 it joins
+    # the buffers into one bytes object, and the transport decides how many
+    # send() calls it takes, so /queues counts frames per drain here.
+
+    def __init__(self, writer, loop, max_frames=256, policy=DROP_OLDEST, timeout=5.0, coalesce=0.0):
+        super().__init__(max_frames, policy, timeout, coalesce)
+        self.writer = writer
+        self.loop = loop
+        self.full_since = None
+        # Restart bookkeeping: waiting for a frame (`partial` holds a header
+        # whose payload hasn't arrived).
+        self.reader = None
+        self.reading = False
+        self.partial = b''
+        # A handler call running on a thread (defer()); the next frame is
+        # read once it is done.
+        self.waiting = None
+        self.wakeup = asyncio.Event()
+        self.task = loop.create_task(self._drain())
+
+    def defer(self, call):
+        # For handler code that may block (a request to the bus hub).
+        self.waiting = self.loop.run_in_executor(None, call)
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def sendall(self, data):
+        if not self._on_loop():
+            self.loop.call_soon_threadsafe(self._enqueue_quietly, tuple(bytes(p) for p in as_parts(data)))
+            return
+        self._enqueue(data)
+
+    def _enqueue_quietly(self, data):
+        try:
+            self._enqueue(data)
+        except OSError as e:
+            log.warning(f"Send error: {e}", key='send')
+
+    def _enqueue(self, data):
+        if self.closed:
+            raise OSError("connection is closed")
+        if len(self.frames) >= self.max_frames:
+            if self.policy == DROP_OLDEST:
+                self.frames.popleft()
+                self._count_drops(1)
+            elif self.policy == BLOCK:
+                # The loop cannot block, so the queue may run over its limit
+                # until the timeout; a receiver that stays behind is dropped.
+                now = self.loop.time()
+                if self.full_since is None:
+                    self.full_since = now
+                elif now - self.full_since > self.timeout:
+                    self._overflow()
+            else:
+                self._overflow()
+        self._push(data)
+        self.wakeup.set()
+
+    def _overflow(self):
+        self._count_drops(len(self.frames) + 1, disconnect=True)
+        self.abort()
+        raise QueueOverflow(f"send queue overflow ({self.max_frames} frames), connection dropped")
+
+    async def _drain(self):
+        try:
+            while True:
+                if not self.frames or self.held:
+                    if self.closed and not self.held:
+                        break
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                if self.coalesce and not self.closed and len(self.frames) < MAX_BATCH:
+                    await asyncio.sleep(self.coalesce)
+                    if self.held:
+                        continue
+                batch = self._take_batch()
+                if not batch:
+                    continue
+                self.writer.writelines([part for frame in batch for part in frame])
+                self.sent += len(batch)
+                record_write(len(batch))
+                if len(self.frames) < self.max_frames:
+                    self.full_since = None
+                await self.writer.drain()
+        except ConnectionError:
+            self.frames.clear()
+            self.closed = True
+        self.writer.close()
+
+    def abort(self):
+        self.closed = True
+        self.frames.clear()
+        self.writer.transport.abort()
+        self.wakeup.set()
+
+    def release(self):
+        self.held = False
+        self.wakeup.set()
+
+    def close(self):
+        if not self._on_loop():
+            self.loop.call_soon_threadsafe(self.close)
+            return
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        if self.frames:
+            self.loop.call_later(self.timeout, self.abort)
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+    def fileno(self):
+        return self.writer.get_extra_info('socket').fileno()
+
+async def serve_client(reader, writer, on_connect, on_frame, on_disconnect, queue_options, max_frame, keepalive,
+                       client=None):
+    # client: a connection taken over from the previous server, already set up.
+    addr = writer.get_extra_info('peername')
+    if client is None:
+        if keepalive:
+            set_keepalive(writer.get_extra_info('socket'), keepalive)
+        sock = StreamSocket(writer, asyncio.get_running_loop(), **queue_options)
+        sock.reader = reader
+        client = on_connect(sock, addr)
+        if client is None:
+            return
+    sock = client['socket']
+
+    connections.add(sock)
+    try:
+        while client['active']:
+            try:
+                sock.reading, sock.partial = True, b''
+                sock.partial = await reader.readexactly(HEADER_SIZE)
+                data = await reader.readexactly(parse_header(sock.partial, max_frame))
+                sock.reading = False
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            except FrameTooLarge as e:
+                log.warning(f"Receive error: {e}", key='receive')
+                break
+            pause = on_frame(client, data)
+            if pause is False:
+                break
+            if sock.waiting:
+                waiting, sock.waiting = sock.waiting, None
+                await waiting
+            # Let the writer tasks drain before the next buffered frame
+            # (flood control may ask for a longer pause).
+            await asyncio.sleep(pause)
+    except Exception as e:
+        log.exception(f"Client error {addr}: {e}", key='client')
+    finally:
+        connections.discard(sock)
+        on_disconnect(client)
+
+async def park(timeout):
+    # Restart (see handoff.py): stops accepting and reading, then waits until
+    # each connection waits for its next frame and has nothing left in its
+    # transport. Returns a copy of the listening socket and {StreamSocket:
+    # (bytes read but not handled, queued frames)}; connections that don't
+    # get there in time are left out.
+    global listener
+    listen = socket.socket(fileno=os.dup(listener.sockets[0].fileno()))
+    listener.close()
+    listener = None
+    for sock in connections:
+        sock.writer.transport.pause_reading()
+    deadline = loop.time() + timeout
+    while not all(sock.reading for sock in connections) and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    parked = [sock for sock in connections if sock.reading and not sock.closed]
+    for sock in parked:
+        sock.held = True
+    while any(sock.writer.transport.get_write_buffer_size() for sock in parked) and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    pending = {}
+    for sock in parked:
+        if not sock.writer.transport.get_write_buffer_size():
+            sock.writer.transport.pause_reading()
+            pending[sock] = (sock.partial + bytes(sock.reader._buffer), [b''.join(frame) for frame in sock.frames])
+    return listen, pending
+
+async def resume(listen):
+    # The restart failed: back to serving.
+    global listener
+    for sock in connections:
+        sock.release()
+        sock.writer.transport.resume_reading()
+    if listen:
+        listener = await asyncio.start_server(handler, sock=listen)
+
+def run(host, port, on_connect, on_frame, on_disconnect, backlog=128, queue_options=None, max_frame=65536,
+        reuse_port=False, keepalive=0, listen_sock=None, adopted=(), on_adopt=None):
+    # listen_sock and adopted ([(socket, state, pending bytes)]) come from a
+    # restart; on_adopt(sock, state) restores a client like on_connect.
+    global handler
+    queue_options = queue_options or {}
+    handler = lambda r, w: serve_client(r, w, on_connect, on_frame, on_disconnect, queue_options, max_frame, keepalive)
+
+    async def main():
+        global loop, listener
+        loop = asyncio.get_running_loop()
+        if listen_sock:
+            listener = await asyncio.start_server(handler, sock=listen_sock, backlog=backlog)
+        else:
+            listener = await asyncio.start_server(handler, host, port, backlog=backlog, reuse_address=True,
+                                                  reuse_port=reuse_port or None)
+            log.info(f"Server started on {host}:{port} (asyncio engine)")
+        # Every connection is back in its channel before any of them is read.
+        streams = []
+        for raw, state, pending in adopted:
+            reader, writer = await asyncio.open_connection(sock=raw)
+            reader.feed_data(pending)
+            streams.append((reader, writer, state))
+        for reader, writer, state in streams:
+            sock = StreamSocket(writer, loop, **queue_options)
+            sock.reader = reader
+            client = on_adopt(sock, state)
+            loop.create_task(serve_client(reader, writer, on_connect, on_frame, on_disconnect, queue_options,
+                                          max_frame, keepalive, client))
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(main())
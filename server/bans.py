@@ -0,0 +1,172 @@
+import heapq
+import ipaddress
+import threading
+import time
+
+# Indexed IP matching for bans and admins: a hash lookup for single
+# addresses and a binary prefix trie for CIDR ranges, so a lookup costs the
+# same whether the list holds ten entries or ten thousand.
+
+def parse_network(text):
+    try:
+        return ipaddress.ip_network(text.strip(), strict=False)
+    except ValueError:
+        return None
+
+def address_in(ip, network):
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return address.version == network.version and address in network
+
+class PrefixTrie:
+    # Nodes are [zero_child, one_child, entries].
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+
+    def _walk(self, network, create):
+        node = self.root
+        value = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (value >> (self.bits - 1 - i)) & 1
+            if node[bit] is None:
+                if not create:
+                    return None
+                node[bit] = [None, None, None]
+            node = node[bit]
+        return node
+
+    def insert(self, network, entry):
+        node = self._walk(network, True)
+        if node[2] is None:
+            node[2] = []
+        node[2].append(entry)
+
+    def remove(self, network, entry):
+        node = self._walk(network, False)
+        if node and node[2]:
+            node[2] = [e for e in node[2] if e is not entry]
+
+    def match(self, address):
+        # Returns the entries of the most specific matching prefix.
+        node = self.root
+        value = int(address)
+        found = node[2] or None
+        for i in range(self.bits):
+            node = node[(value >> (self.bits - 1 - i)) & 1]
+            if node is None:
+                break
+            if node[2]:
+                found = node[2]
+        return found
+
+class IPIndex:
+    def __init__(self):
+        self.exact = {}
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+
+    def _key(self, text):
+        network = parse_network(text)
+        if network is None:
+            return text, None
+        if network.prefixlen == network.max_prefixlen:
+            return str(network.network_address), None
+        return None, network
+
+    def add(self, text, entry):
+        key, network = self._key(text)
+        if network is not None:
+            self.tries[network.version].insert(network, entry)
+        else:
+            self.exact.setdefault(key, []).append(entry)
+
+    def remove(self, text, entry):
+        key, network = self._key(text)
+        if network is not None:
+            self.tries[network.version].remove(network, entry)
+            return
+        entries = [e for e in self.exact.get(key, ()) if e is not entry]
+        if entries:
+            self.exact[key] = entries
+        else:
+            self.exact.pop(key, None)
+
+    def match(self, ip):
+        entries = self.exact.get(ip)
+        if entries:
+            return entries[0]
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+            entries = self.exact.get(str(address))
+            if entries:
+                return entries[0]
+        entries = self.tries[address.version].match(address)
+        return entries[0] if entries else None
+
+class BanList:
+    # Ban entries keep the banip_users.json shape: {"ip", "nick", "reason",
+    # "time"} plus an optional "expires" timestamp. "ip" may be a CIDR range.
+
+    def __init__(self, entries=(), on_expire=None):
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.index = IPIndex()
+        self.expiry = []
+        self.on_expire = on_expire
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        with self.lock:
+            self.entries[id(entry)] = entry
+            self.index.add(entry.get('ip', ''), entry)
+            if entry.get('expires'):
+                heapq.heappush(self.expiry, (entry['expires'], id(entry), entry))
+
+    def remove(self, entry):
+        with self.lock:
+            if self.entries.pop(id(entry), None) is not None:
+                self.index.remove(entry.get('ip', ''), entry)
+                return True
+            return False
+
+    def expire(self, now=None):
+        now = now or time.time()
+        expired = []
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                entry = heapq.heappop(self.expiry)[2]
+                if self.remove(entry):
+                    expired.append(entry)
+        if self.on_expire:
+            for entry in expired:
+                self.on_expire(entry)
+        return expired
+
+    def match(self, ip):
+        if self.expiry and self.expiry[0][0] <= time.time():
+            self.expire()
+        return self.index.match(ip)
+
+    def __iter__(self):
+        return iter(list(self.entries.values()))
+
+    def __len__(self):
+        return len(self.entries)
+
+class AdminIndex:
+    def __init__(self, admins=()):
+        self.by_nick = {}
+        for admin in admins:
+            self.by_nick.setdefault(admin['nick'].casefold(), IPIndex()).add(admin['ip'], admin)
+
+    def match(self, ip, nickname):
+        index = self.by_nick.get(nickname.casefold())
+        return index.match(ip) if index else None
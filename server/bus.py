@@ -0,0 +1,260 @@
+import itertools
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import log
+from outbound import QueuedSocket, DISCONNECT
+from protocol.framing import FrameReader, encode_frame
+
+# Multi-process mode ("workers" > 1 in config.json). Every worker listens on
+# the same port with SO_REUSEPORT, so the kernel spreads connections over
+# them, and the workers exchange events over a local bus: the first process
+# runs the hub on a Unix socket and every worker (itself too) connects to it.
+#
+# A worker keeps a mirror record for each client of the other workers, with
+# a RemoteSocket instead of a real one, so nick lookups, /who, /msg and admin
+# commands find them as usual. Events are JSON objects with a type in "t":
+#
+#   client   - a client connected or changed nick/prefix/channel (full state)
+#   gone     - a client disconnected
+#   chat     - a channel message; each worker fans it out to its own members
+#   system   - a [System] broadcast
+#   send, private, close - for one client ("to"); the hub routes them to the
+#              worker that holds the connection
+#   ban, unban, warns, channel, plugins - changes already written to the
+#              shared databases (or files) that the other workers pick up
+#   report   - print /mem, /queues or /flood for this worker
+#
+# The hub keeps the last "client" state of every client. It replays it to
+# workers that (re)connect and is the only one that hands out nicks.
+
+def encode_event(event):
+    return encode_frame(json.dumps(event, separators=(',', ':')).encode())
+
+class BusHub:
+    def __init__(self, path, queue_size=65536):
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.peers = {}
+        self.clients = {}
+        self.nicks = {}
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(64)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        reader = FrameReader(conn)
+        peer = QueuedSocket(conn, self.queue_size, DISCONNECT)
+        worker = None
+        try:
+            data = reader.read_frame()
+            if data is None:
+                return
+            worker = json.loads(data)['worker']
+            with self.lock:
+                self.peers[worker] = peer
+                for _, state in self.clients.values():
+                    peer.sendall(encode_event(state))
+            while True:
+                data = reader.read_frame()
+                if data is None:
+                    break
+                self._dispatch(worker, peer, data)
+        except (OSError, ValueError) as e:
+            log.warning(f"Bus error (worker {worker}): {e}")
+        finally:
+            peer.close()
+            if worker is not None:
+                self._drop(worker, peer)
+
+    def _dispatch(self, worker, peer, data):
+        event = json.loads(data)
+        kind = event['t']
+        with self.lock:
+            if kind == 'nick':
+                ok = self._claim(event['id'], event['nick'])
+                peer.sendall(encode_event({'t': 'reply', 'rid': event['rid'], 'ok': ok}))
+                return
+            if kind == 'client':
+                self._index(event['id'], event.get('nick'))
+                self.clients[event['id']] = (worker, event)
+            elif kind == 'gone':
+                self._forget(event['id'])
+            if 'to' in event:
+                target = self.clients.get(event['to'])
+                peers = [self.peers.get(target[0])] if target else []
+            else:
+                peers = [p for w, p in self.peers.items() if w != worker]
+            frame = encode_frame(data)
+            for p in peers:
+                if p is not None:
+                    try:
+                        p.sendall(frame)
+                    except OSError as e:
+                        log.warning(f"Bus relay error: {e}", key='bus relay')
+
+    def _claim(self, client_id, nick):
+        owner = self.nicks.get(nick.casefold())
+        if owner is not None and owner != client_id:
+            return False
+        self._index(client_id, nick)
+        if client_id in self.clients:
+            self.clients[client_id][1]['nick'] = nick
+        return True
+
+    def _index(self, client_id, nick):
+        state = self.clients.get(client_id)
+        old = state[1].get('nick') if state else None
+        if old and self.nicks.get(old.casefold()) == client_id:
+            del self.nicks[old.casefold()]
+        if nick:
+            self.nicks[nick.casefold()] = client_id
+
+    def _forget(self, client_id):
+        self._index(client_id, None)
+        self.clients.pop(client_id, None)
+
+    def _drop(self, worker, peer):
+        # A worker went away: its clients are gone for everybody else.
+        with self.lock:
+            if self.peers.get(worker) is peer:
+                del self.peers[worker]
+            gone = [cid for cid, (w, _) in self.clients.items() if w == worker]
+            for cid in gone:
+                self._forget(cid)
+            for p in self.peers.values():
+                for cid in gone:
+                    try:
+                        p.sendall(encode_event({'t': 'gone', 'id': cid}))
+                    except OSError:
+                        break
+        log.info(f"Worker {worker} left the bus ({len(gone)} client(s) dropped)")
+
+class BusClient:
+    def __init__(self, path, worker, on_event, on_lost, queue_size=65536, timeout=10.0):
+        self.worker = worker
+        self.on_event = on_event
+        self.on_lost = on_lost
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.pending = {}
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                break
+            except OSError:
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.reader = FrameReader(sock)
+        self.sock = QueuedSocket(sock, queue_size, DISCONNECT)
+        self.send({'t': 'hello', 'worker': worker})
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def new_id(self):
+        # Unique across restarts of the same worker.
+        return f"{os.getpid()}.{next(self.ids)}"
+
+    def send(self, event):
+        self.sock.sendall(encode_event(event))
+
+    def request(self, event, timeout=5.0):
+        rid = next(self.ids)
+        waiter = [threading.Event(), None]
+        with self.lock:
+            self.pending[rid] = waiter
+        try:
+            self.send(dict(event, rid=rid))
+            waiter[0].wait(timeout)
+        finally:
+            with self.lock:
+                self.pending.pop(rid, None)
+        return waiter[1]
+
+    def claim_nick(self, client_id, nick):
+        reply = self.request({'t': 'nick', 'id': client_id, 'nick': nick})
+        return bool(reply and reply['ok'])
+
+    def _read(self):
+        try:
+            while True:
+                data = self.reader.read_frame()
+                if data is None:
+                    break
+                event = json.loads(data)
+                if event['t'] == 'reply':
+                    with self.lock:
+                        waiter = self.pending.get(event['rid'])
+                    if waiter:
+                        waiter[1] = event
+                        waiter[0].set()
+                    continue
+                try:
+                    self.on_event(event)
+                except Exception as e:
+                    log.exception(f"Bus event error ({event['t']}): {e}", key=f"bus event {event['t']}")
+        except (OSError, ValueError) as e:
+            log.error(f"Bus error: {e}")
+        self.on_lost()
+
+class RemoteSocket:
+    # Stands in for the socket of a client on another worker: what is sent
+    # to it goes over the bus as text, and that worker encrypts and frames it.
+    codec = None
+    sealer = None
+    opener = None
+    compact = None
+    dropped = 0
+
+    def __init__(self, bus, client_id, addr):
+        self.bus = bus
+        self.client_id = client_id
+        self.addr = addr
+        self.closed = False
+
+    def send_text(self, message):
+        self.bus.send({'t': 'send', 'to': self.client_id, 'text': message})
+
+    def send_private(self, outgoing, nick, message, line):
+        self.bus.send({'t': 'private', 'to': self.client_id, 'outgoing': outgoing, 'nick': nick,
+                       'text': message, 'line': line})
+
+    def sendall(self, data):
+        raise OSError("client is on another worker")
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.bus.send({'t': 'close', 'to': self.client_id})
+
+    def getpeername(self):
+        return self.addr
+
+def supervise_workers(count, command):
+    # Starts workers 1..count-1 with `command --worker N` and restarts any
+    # that exits. They quit by themselves when this process goes away.
+    def run(worker):
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        while True:
+            proc = subprocess.Popen(command + ['--worker', str(worker)], stdin=subprocess.DEVNULL, env=env)
+            code = proc.wait()
+            log.error(f"Worker {worker} exited with code {code}, restarting.")
+            time.sleep(1)
+
+    for worker in range(1, count):
+        threading.Thread(target=run, args=(worker,), daemon=True).start()
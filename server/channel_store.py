@@ -0,0 +1,156 @@
+import sqlite3
+import threading
+import time
+
+import log
+
+# channels.db behind one long-lived WAL connection. Channel metadata is
+# served from memory; changes are marked dirty and written back in batches
+# by a background thread (and on shutdown). A restart freezes the store so
+# the new process loads everything the old one had.
+
+class StoreFrozen(RuntimeError):
+    pass
+
+class ChannelInfo:
+    __slots__ = ('name', 'topic', 'created', 'flags')
+
+    def __init__(self, name, topic='', created=None, flags=()):
+        self.name = name
+        self.topic = topic
+        self.created = created or time.time()
+        self.flags = set(flags)
+
+class ChannelStore:
+    def __init__(self, path, flush_interval=2.0):
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS channels (name TEXT PRIMARY KEY)")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(channels)")}
+        for column, ddl in (('topic', "TEXT NOT NULL DEFAULT ''"),
+                            ('created', "REAL"),
+                            ('flags', "TEXT NOT NULL DEFAULT ''")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE channels ADD COLUMN {column} {ddl}")
+        # Rows from before the column existed: their creation time is
+        # unknown, so it becomes the time of the migration, once.
+        self.conn.execute("UPDATE channels SET created = ? WHERE created IS NULL", (time.time(),))
+
+        self.channels = {}
+        for name, topic, created, flags in self.conn.execute("SELECT name, topic, created, flags FROM channels"):
+            self.channels[name] = ChannelInfo(name, topic, created, filter(None, flags.split(',')))
+        self.dirty = set()
+        self.deleted = set()
+        self.frozen = False
+
+        self.flush_interval = flush_interval
+        threading.Thread(target=self._flusher, daemon=True).start()
+
+    def names(self):
+        return list(self.channels)
+
+    def get(self, name):
+        return self.channels.get(name)
+
+    def freeze(self):
+        # Changes already made are in memory and go out with the next
+        # flush(); new ones raise StoreFrozen until thaw().
+        with self.lock:
+            self.frozen = True
+
+    def thaw(self):
+        with self.lock:
+            self.frozen = False
+
+    def _check(self):
+        if self.frozen:
+            raise StoreFrozen("channels can't be changed while the server restarts")
+
+    def create(self, name):
+        with self.lock:
+            self._check()
+            if name in self.channels:
+                return False
+            self.channels[name] = ChannelInfo(name)
+            self.deleted.discard(name)
+            self.dirty.add(name)
+            return True
+
+    def delete(self, name):
+        with self.lock:
+            self._check()
+            if self.channels.pop(name, None) is None:
+                return False
+            self.dirty.discard(name)
+            self.deleted.add(name)
+            return True
+
+    def set_topic(self, name, topic):
+        with self.lock:
+            self._check()
+            self.channels[name].topic = topic
+            self.dirty.add(name)
+
+    def set_flag(self, name, flag, enabled):
+        with self.lock:
+            self._check()
+            flags = self.channels[name].flags
+            if enabled:
+                flags.add(flag)
+            else:
+                flags.discard(flag)
+            self.dirty.add(name)
+
+    def update(self, name, topic, created, flags):
+        with self.lock:
+            self.channels[name] = ChannelInfo(name, topic, created, flags)
+            self.deleted.discard(name)
+            self.dirty.add(name)
+
+    def reload(self, name):
+        # Another process changed this channel in the database; returns
+        # whether it still exists.
+        with self.write_lock:
+            row = self.conn.execute("SELECT topic, created, flags FROM channels WHERE name=?", (name,)).fetchone()
+        with self.lock:
+            self.dirty.discard(name)
+            self.deleted.discard(name)
+            if row is None:
+                self.channels.pop(name, None)
+                return False
+            topic, created, flags = row
+            self.channels[name] = ChannelInfo(name, topic, created, filter(None, flags.split(',')))
+            return True
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                dirty, self.dirty = self.dirty, set()
+                deleted, self.deleted = self.deleted, set()
+                rows = [(i.name, i.topic, i.created, ','.join(sorted(i.flags)))
+                        for i in (self.channels[n] for n in dirty)]
+            if not rows and not deleted:
+                return
+            try:
+                with self.conn:
+                    self.conn.execute("BEGIN")
+                    self.conn.executemany("DELETE FROM channels WHERE name=?", [(n,) for n in deleted])
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO channels (name, topic, created, flags) VALUES (?, ?, ?, ?)", rows)
+            except sqlite3.Error:
+                # Keep the changes for the next attempt.
+                with self.lock:
+                    self.dirty |= {n for n in dirty if n in self.channels}
+                    self.deleted |= {n for n in deleted if n not in self.channels}
+                raise
+
+    def _flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                log.error(f"Channel store flush error: {e}", key='channel store')
@@ -0,0 +1,34 @@
+import functools
+import re
+
+# &-colour codes to ANSI escapes, done in one regex pass instead of
+# char-by-char concatenation. Output matches the old parse_colors exactly.
+
+RESET = '\033[0m'
+
+mc_color_map = {
+    '0': '\033[30m', '1': '\033[34m', '2': '\033[32m', '3': '\033[36m',
+    '4': '\033[31m', '5': '\033[35m', '6': '\033[33m', '7': '\033[37m',
+    '8': '\033[90m', '9': '\033[94m', 'a': '\033[92m', 'b': '\033[96m',
+    'c': '\033[91m', 'd': '\033[95m', 'e': '\033[93m', 'f': '\033[97m',
+}
+mc_style_map = {
+    'l': '\033[1m', 'o': '\033[3m', 'n': '\033[4m', 'm': '\033[9m',
+}
+
+_codes = {'r': RESET, **mc_color_map, **mc_style_map}
+_escapes = {}
+for _code, _escape in _codes.items():
+    _escapes['&' + _code] = _escape
+    _escapes['&' + _code.upper()] = _escape
+
+_code_re = re.compile('&[' + ''.join(k[1] for k in _escapes) + ']')
+
+def _escape_for(match):
+    return _escapes[match.group()]
+
+@functools.lru_cache(maxsize=1024)
+def parse_colors(text):
+    if '&' not in text:
+        return text + RESET
+    return _code_re.sub(_escape_for, text) + RESET
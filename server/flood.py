@@ -0,0 +1,114 @@
+import threading
+import time
+
+# Token-bucket flood control. Every limit (messages, commands, bytes per
+# second) has a bucket per connection and one shared by all connections from
+# the same IP. What happens when a bucket runs dry is configured per limit:
+#
+#   delay - the message is handled, and reading from the client pauses until
+#           the bucket has refilled, so TCP pushes the flood back to it;
+#   drop  - the message is discarded;
+#   warn  - discarded, and the client gets an automatic /warn.
+
+DELAY = 'delay'
+DROP = 'drop'
+WARN = 'warn'
+ACTIONS = (DELAY, DROP, WARN)
+SEVERITY = {DELAY: 0, DROP: 1, WARN: 2}
+
+LIMITS = ('messages', 'commands', 'bytes')
+DEFAULT_LIMITS = {
+    'messages': {'rate': 5, 'burst': 20, 'ip_rate': 10, 'ip_burst': 40, 'action': DELAY},
+    'commands': {'rate': 2, 'burst': 10, 'ip_rate': 5, 'ip_burst': 20, 'action': DELAY},
+    'bytes': {'rate': 4096, 'burst': 32768, 'ip_rate': 8192, 'ip_burst': 65536, 'action': DELAY},
+}
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def wait(self, amount, now):
+        # Seconds until `amount` tokens are there (0 if they already are).
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        missing = min(amount, self.burst) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount):
+        # May go below zero; with "delay" the debt is paid by pausing.
+        self.tokens -= min(amount, self.burst)
+
+class FloodState:
+    # Per connection: its buckets and what flood control did to it.
+    __slots__ = ('ip', 'buckets', 'counts', 'last_notice', 'last_warn')
+
+    def __init__(self, ip, buckets):
+        self.ip = ip
+        self.buckets = buckets
+        self.counts = {}
+        self.last_notice = 0.0
+        self.last_warn = 0.0
+
+class FloodControl:
+    def __init__(self, limits=None):
+        self.limits = {}
+        for name in LIMITS:
+            limit = dict(DEFAULT_LIMITS[name], **((limits or {}).get(name) or {}))
+            if limit['action'] not in ACTIONS:
+                raise ValueError(f"flood_control.{name}.action must be one of: {', '.join(ACTIONS)}")
+            if limit['rate'] > 0 or limit['ip_rate'] > 0:
+                self.limits[name] = limit
+        self.lock = threading.Lock()
+        self.ip_buckets = {}
+        self.ip_refs = {}
+        self.totals = {}
+
+    def attach(self, ip):
+        with self.lock:
+            if ip not in self.ip_buckets:
+                self.ip_buckets[ip] = {name: TokenBucket(limit['ip_rate'], limit['ip_burst'])
+                                       for name, limit in self.limits.items() if limit['ip_rate'] > 0}
+            self.ip_refs[ip] = self.ip_refs.get(ip, 0) + 1
+        return FloodState(ip, {name: TokenBucket(limit['rate'], limit['burst'])
+                               for name, limit in self.limits.items() if limit['rate'] > 0})
+
+    def detach(self, state):
+        with self.lock:
+            self.ip_refs[state.ip] -= 1
+            if not self.ip_refs[state.ip]:
+                del self.ip_refs[state.ip]
+                del self.ip_buckets[state.ip]
+
+    def check(self, state, command, size):
+        # Returns (action, wait, limit): action is None when the message is
+        # within every limit.
+        now = time.monotonic()
+        wanted = [('commands' if command else 'messages', 1), ('bytes', size)]
+        with self.lock:
+            ip_buckets = self.ip_buckets.get(state.ip, {})
+            buckets = []
+            for name, amount in wanted:
+                for bucket in (state.buckets.get(name), ip_buckets.get(name)):
+                    if bucket is not None:
+                        buckets.append((name, amount, bucket))
+            action, wait, limit = None, 0.0, None
+            for name, amount, bucket in buckets:
+                needed = bucket.wait(amount, now)
+                if needed > 0:
+                    chosen = self.limits[name]['action']
+                    if action is None or SEVERITY[chosen] > SEVERITY[action]:
+                        action, limit = chosen, name
+                    wait = max(wait, needed)
+            if action in (None, DELAY):
+                for name, amount, bucket in buckets:
+                    bucket.take(amount)
+            if action is not None:
+                key = (limit, action)
+                state.counts[key] = state.counts.get(key, 0) + 1
+                self.totals[key] = self.totals.get(key, 0) + 1
+        return action, wait, limit
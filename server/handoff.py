@@ -0,0 +1,244 @@
+import base64
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+# Zero-downtime restart (/restart in the console). The running server starts
+# `server.py --takeover <socket>` and waits for it on a Unix socket; the new
+# process loads its config, channels and plugins first, so a broken upgrade
+# fails while the old one is still serving. Then the old server:
+#
+#   1. stops accepting and parks every reader at a frame boundary; bytes it
+#      already took from a client's socket but hasn't handled go along,
+#   2. stops its send queues after the write in progress (frames still
+#      queued go along too),
+#   3. sends the listening socket and every client socket (SCM_RIGHTS) with
+#      the client's nick, channel and negotiated protocol state.
+#
+# The new server adopts the connections and carries on; clients see a pause,
+# not a disconnect. The old process then turns into a small waiter that
+# keeps its pid (the shell's job, a supervisor's main process) until the new
+# server exits. If anything fails before the new server has the sockets,
+# the old one resumes.
+#
+# Messages on the Unix socket: 4-byte length + JSON, with the sockets as
+# ancillary data on the first byte.
+
+FDS_PER_MESSAGE = 200
+MESSAGE_SIZE = 256 * 1024
+# An adopted connection's AEAD counter starts this far past the one sent.
+COUNTER_MARGIN = 1 << 12
+
+def supported():
+    return hasattr(socket, 'send_fds') and hasattr(socket, 'MSG_DONTWAIT') and hasattr(select, 'poll')
+
+class Handoff:
+    # start() wakes every ParkingSocket; they park until resume(). After a
+    # hand-over that worked the process is replaced, so they never return.
+
+    def __init__(self):
+        self.active = False
+        self.wake_r, self.wake_w = os.pipe()
+        self.cond = threading.Condition()
+        self.round = 0
+
+    def start(self):
+        with self.cond:
+            self.active = True
+        os.write(self.wake_w, b'!')
+
+    def park(self, parker):
+        with self.cond:
+            parker.parked = True
+            self.cond.notify_all()
+            current = self.round
+            self.cond.wait_for(lambda: self.round != current)
+            parker.parked = False
+
+    def wait_parked(self, parkers, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: all(p.parked for p in parkers), timeout)
+            return [p for p in parkers if p.parked]
+
+    def resume(self):
+        os.read(self.wake_r, 1)
+        with self.cond:
+            self.active = False
+            self.round += 1
+            self.cond.notify_all()
+
+class ParkingSocket:
+    # Threaded engine: what FrameReader and the accept loop go through. While
+    # no hand-over is on, recv_into() is one recv when data is waiting, else
+    # a poll() on the socket and the wake-up pipe; during one it parks
+    # instead of reading.
+    __slots__ = ('sock', 'handoff', 'poller', 'parked')
+
+    def __init__(self, sock, handoff):
+        self.sock = sock
+        self.handoff = handoff
+        self.parked = False
+        self.poller = select.poll()
+        self.poller.register(sock, select.POLLIN)
+        self.poller.register(handoff.wake_r, select.POLLIN)
+
+    def _wait(self):
+        while True:
+            if self.handoff.active:
+                self.handoff.park(self)
+                continue
+            self.poller.poll()
+            if not self.handoff.active:
+                return
+
+    def recv_into(self, view):
+        try:
+            if not self.handoff.active:
+                try:
+                    return self.sock.recv_into(view, 0, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    pass
+            self._wait()
+            return self.sock.recv_into(view)
+        except OSError:
+            # Closed by its writer (kick, disconnect) while this waited: EOF.
+            if self.sock.fileno() < 0:
+                return 0
+            raise
+
+    def accept(self):
+        # The listening socket is non-blocking, so a connection that went
+        # away between poll() and accept() can't leave this stuck.
+        while True:
+            self._wait()
+            try:
+                return self.sock.accept()
+            except BlockingIOError:
+                pass
+
+# --- transfer ---
+
+def encode_bytes(data):
+    return base64.b64encode(data).decode()
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+def listen(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(1)
+    return server
+
+def wait_for(server, proc, timeout):
+    # The new process connects once it is ready; None if it exits or
+    # doesn't get there in time.
+    deadline = time.monotonic() + timeout
+    server.settimeout(0.5)
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            return None
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        conn.settimeout(None)
+        return conn
+    return None
+
+def send_message(conn, message, fds=()):
+    data = json.dumps(message).encode()
+    data = len(data).to_bytes(4, 'big') + data
+    sent = socket.send_fds(conn, [data], list(fds))
+    conn.sendall(data[sent:])
+
+def recv_exact(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("hand-over connection closed")
+        data += chunk
+    return data
+
+def recv_message(conn):
+    head, fds, _, _ = socket.recv_fds(conn, 4, FDS_PER_MESSAGE + 1)
+    if not head:
+        raise ConnectionError("hand-over connection closed")
+    head += recv_exact(conn, 4 - len(head))
+    return json.loads(recv_exact(conn, int.from_bytes(head, 'big'))), fds
+
+def send_state(conn, state, listen_fd, clients):
+    # clients: (fd, state) pairs, sent in batches.
+    send_message(conn, {'state': state, 'clients': len(clients)}, [listen_fd])
+    batch, fds, size = [], [], 0
+    for fd, client in clients:
+        batch.append(client)
+        fds.append(fd)
+        size += len(json.dumps(client))
+        if len(fds) >= FDS_PER_MESSAGE or size >= MESSAGE_SIZE:
+            send_message(conn, {'batch': batch}, fds)
+            batch, fds, size = [], [], 0
+    if batch:
+        send_message(conn, {'batch': batch}, fds)
+    # The new server has everything once it says so.
+    conn.settimeout(30)
+    if recv_exact(conn, 2) != b'ok':
+        raise ConnectionError("new server refused the hand-over")
+
+def receive_state(path):
+    # New process: returns (conn, state, listening socket, [(socket, client state)]).
+    # Reply with accept_state(conn) before serving any of them.
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    header, fds = recv_message(conn)
+    listener = socket.socket(fileno=fds[0])
+    clients = []
+    while len(clients) < header['clients']:
+        message, fds = recv_message(conn)
+        clients.extend((socket.socket(fileno=fd), client) for fd, client in zip(fds, message['batch']))
+    return conn, header['state'], listener, clients
+
+def accept_state(conn):
+    # Returns once the old process is gone (its end closes on exec), so the
+    # two never serve a connection at the same time.
+    conn.sendall(b'ok')
+    conn.settimeout(30)
+    try:
+        conn.recv(1)
+    except OSError:
+        pass
+    conn.close()
+
+# --- after the hand-over ---
+
+def become_waiter(pid):
+    # Replaces the old process with `python handoff.py wait <pid>`: same pid,
+    # none of the old server's memory or sockets.
+    sys.stdout.flush()
+    os.execv(sys.executable, [sys.executable, os.path.abspath(__file__), 'wait', str(pid)])
+
+def wait(pid):
+    # Ctrl+C reaches the server too (same process group); TERM and HUP from
+    # a supervisor are passed on.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, lambda number, frame: os.kill(pid, number))
+    _, status = os.waitpid(pid, 0)
+    code = os.waitstatus_to_exitcode(status)
+    if code < 0:
+        # Killed by a signal: end the same way.
+        signal.signal(-code, signal.SIG_DFL)
+        os.kill(os.getpid(), -code)
+    sys.exit(code)
+
+if __name__ == '__main__' and sys.argv[1:2] == ['wait']:
+    wait(int(sys.argv[2]))
@@ -0,0 +1,363 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+import log
+from bus import BusClient
+from outbound import QueuedSocket, DISCONNECT
+from protocol.aead import Opener, Sealer, derive_key, master_key, new_salt
+from protocol.framing import FrameReader, encode_frame
+
+# Server-to-server links ("link" in config.json). Linked servers form a tree.
+# Each one passes the bus events of its own clients (see bus.py) to its
+# links, and what it gets from one link to the others, so every server
+# mirrors the clients of the whole network and channel messages reach the
+# members on every node. The link manager runs in the first process and
+# sits on the local bus like a worker.
+#
+# A link starts with a handshake sealed with the shared link key (Fernet):
+# each side sends its name, the servers behind it and a fresh salt, and the
+# reply echoes the caller's nonce. Events then go as AEAD frames under keys
+# derived from both salts, so nothing from an older session can be replayed
+# into a new one. A link that would close a loop (a server name that is
+# already reachable) is refused.
+#
+# Client ids on links are "<server>/<id>". When clients on two servers end up
+# with the same nick, the one that took it later loses everywhere: its own
+# server renames it, the others hide its nick until then.
+
+LINK_CIPHER = 'aesgcm'
+HANDSHAKE_TIMEOUT = 10
+HANDSHAKE_TTL = 60
+
+class LinkRefused(Exception):
+    pass
+
+def encode_json(event):
+    return json.dumps(event, separators=(',', ':')).encode()
+
+class Link:
+    def __init__(self, sock, reader, name, servers, sealer, opener, queue_size):
+        self.sock = QueuedSocket(sock, queue_size, DISCONNECT)
+        self.reader = reader
+        self.name = name
+        self.servers = set(servers)
+        self.sealer = sealer
+        self.opener = opener
+
+    def send(self, event):
+        try:
+            self.sock.sendall(encode_frame(self.sealer.seal(encode_json(event))))
+        except OSError as e:
+            log.warning(f"Link send error ({self.name}): {e}", key=f"link send {self.name}")
+
+    def recv(self):
+        data = self.reader.read_frame()
+        return None if data is None else json.loads(self.opener.open(data))
+
+class LinkManager:
+    def __init__(self, name, key, bus_path, store, queue_size=65536):
+        self.name = name
+        self.fernet = Fernet(key)
+        self.master = master_key(key)
+        self.store = store
+        self.queue_size = queue_size
+        self.lock = threading.RLock()
+        self.links = []
+        self.routes = {}
+        self.clients = {}
+        self.nicks = {}
+        self.hidden = set()
+        self.bus = BusClient(bus_path, 'link', self.on_local, self.on_bus_lost, queue_size)
+
+    def known(self):
+        return {self.name} | set(self.routes)
+
+    # --- handshake ---
+
+    def _hello(self, salt, nonce):
+        return encode_frame(self.fernet.encrypt(encode_json({
+            't': 'link', 'name': self.name, 'servers': sorted(self.known()),
+            'salt': salt.hex(), 'nonce': nonce.hex()})))
+
+    def _read_hello(self, reader):
+        data = reader.read_frame()
+        if data is None:
+            raise LinkRefused("connection closed during the handshake")
+        try:
+            hello = json.loads(self.fernet.decrypt(data, ttl=HANDSHAKE_TTL))
+        except InvalidToken:
+            raise LinkRefused("handshake not sealed with the link key") from None
+        if hello.get('t') == 'error':
+            raise LinkRefused(hello['reason'])
+        return hello
+
+    def _check(self, hello):
+        loop = set(hello['servers']) & self.known()
+        if loop:
+            raise LinkRefused(f"{', '.join(sorted(loop))} already linked")
+
+    def _keys(self, up_salt, down_salt):
+        salts = up_salt + down_salt
+        return derive_key(self.master, salts, b'link-up'), derive_key(self.master, salts, b'link-down')
+
+    def connect(self, host, port):
+        sock = socket.create_connection((host, port), timeout=HANDSHAKE_TIMEOUT)
+        try:
+            reader = FrameReader(sock)
+            salt, nonce = new_salt(), os.urandom(16)
+            sock.sendall(self._hello(salt, nonce))
+            hello = self._read_hello(reader)
+            if hello.get('nonce') != nonce.hex():
+                raise LinkRefused("handshake reply does not match")
+            self._check(hello)
+            up, down = self._keys(salt, bytes.fromhex(hello['salt']))
+            sock.settimeout(None)
+            return self._attach(sock, reader, hello, Sealer(LINK_CIPHER, up), Opener(LINK_CIPHER, down))
+        except BaseException:
+            sock.close()
+            raise
+
+    def accept(self, sock):
+        sock.settimeout(HANDSHAKE_TIMEOUT)
+        reader = FrameReader(sock)
+        hello = self._read_hello(reader)
+        try:
+            self._check(hello)
+        except LinkRefused as e:
+            sock.sendall(encode_frame(self.fernet.encrypt(encode_json({'t': 'error', 'reason': str(e)}))))
+            raise
+        salt = new_salt()
+        sock.sendall(self._hello(salt, bytes.fromhex(hello['nonce'])))
+        up, down = self._keys(bytes.fromhex(hello['salt']), salt)
+        sock.settimeout(None)
+        return self._attach(sock, reader, hello, Sealer(LINK_CIPHER, down), Opener(LINK_CIPHER, up))
+
+    def _attach(self, sock, reader, hello, sealer, opener):
+        link = Link(sock, reader, hello['name'], hello['servers'], sealer, opener, self.queue_size)
+        with self.lock:
+            self._check(hello)
+            for other in self.links:
+                other.send({'t': 'servers', 'add': sorted(link.servers)})
+            self.links.append(link)
+            for server in link.servers:
+                self.routes[server] = link
+            # Burst: everything this side knows, channels first.
+            for name in self.store.names():
+                link.send({'t': 'channel', 'name': name, 'info': self.channel_info(name), 'burst': True})
+            for state in self.clients.values():
+                link.send(state)
+        log.info(f"Linked with {link.name} ({len(link.servers)} server(s) behind it)")
+        return link
+
+    # --- running links ---
+
+    def listen(self, ip, port):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((ip, port))
+        sock.listen(16)
+        log.info(f"Accepting server links on {ip}:{port}")
+
+        def serve(conn, addr):
+            try:
+                link = self.accept(conn)
+            except (OSError, ValueError, KeyError, LinkRefused) as e:
+                log.warning(f"Link from {addr[0]} refused: {e}", key=f"link from {addr[0]}")
+                conn.close()
+                return
+            self.serve(link)
+
+        def accept_loop():
+            while True:
+                conn, addr = sock.accept()
+                threading.Thread(target=serve, args=(conn, addr), daemon=True).start()
+
+        threading.Thread(target=accept_loop, daemon=True).start()
+
+    def keep_linked(self, host, port, retry=10):
+        # Connects to a peer and reconnects whenever the link goes down.
+        def run():
+            last_error = None
+            while True:
+                try:
+                    link = self.connect(host, port)
+                    last_error = None
+                    self.serve(link)
+                except (OSError, ValueError, KeyError, LinkRefused) as e:
+                    if str(e) != last_error:
+                        log.warning(f"Link to {host}:{port} failed: {e}", key=f"link to {host}:{port}")
+                        last_error = str(e)
+                time.sleep(retry)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def serve(self, link):
+        try:
+            while True:
+                event = link.recv()
+                if event is None:
+                    break
+                self.on_remote(link, event)
+        except Exception as e:
+            # Includes frames that fail authentication or replay checks.
+            log.warning(f"Link error ({link.name}): {e}")
+        finally:
+            link.sock.close()
+            self._unlink(link)
+
+    def _unlink(self, link):
+        with self.lock:
+            if link not in self.links:
+                return
+            self.links.remove(link)
+            for server in link.servers:
+                self.routes.pop(server, None)
+            for other in self.links:
+                other.send({'t': 'squit', 'servers': sorted(link.servers)})
+            dropped = self._drop_servers(link.servers)
+        log.warning(f"Link to {link.name} lost ({len(link.servers)} server(s), {dropped} client(s) gone)")
+
+    def _drop_servers(self, servers):
+        gone = [cid for cid, state in self.clients.items() if state['server'] in servers]
+        for cid in gone:
+            self._untrack(cid)
+            self.bus.send({'t': 'gone', 'id': cid})
+        return len(gone)
+
+    # --- events ---
+
+    def _forward(self, source, event):
+        for link in self.links:
+            if link is not source:
+                link.send(event)
+
+    def _untrack(self, cid):
+        state = self.clients.pop(cid, None)
+        self.hidden.discard(cid)
+        if state and state.get('nick') and self.nicks.get(state['nick'].casefold()) == cid:
+            del self.nicks[state['nick'].casefold()]
+
+    def _publish(self, cid):
+        state = self.clients[cid]
+        if state['server'] != self.name:
+            self.bus.send(dict(state, nick=None) if cid in self.hidden else state)
+
+    def _track(self, state):
+        cid = state['id']
+        self._untrack(cid)
+        self.clients[cid] = state
+        nick = state.get('nick')
+        if not nick:
+            return
+        other = self.nicks.get(nick.casefold())
+        if other is None:
+            self.nicks[nick.casefold()] = cid
+            return
+        # Nick collision: the later claim loses on every server.
+        if (self.clients[other].get('since', 0), other) <= (state.get('since', 0), cid):
+            loser = cid
+        else:
+            loser = other
+            self.nicks[nick.casefold()] = cid
+        self.hidden.add(loser)
+        server, _, local_id = loser.partition('/')
+        if server == self.name:
+            self.bus.send({'t': 'collide', 'to': local_id})
+        elif loser == other:
+            self._publish(other)
+
+    def on_remote(self, link, event):
+        kind = event['t']
+        with self.lock:
+            if kind == 'servers':
+                added = set(event['add'])
+                link.servers |= added
+                for server in added:
+                    self.routes[server] = link
+                self._forward(link, event)
+            elif kind == 'squit':
+                lost = set(event['servers']) & link.servers
+                link.servers -= lost
+                for server in lost:
+                    self.routes.pop(server, None)
+                self._forward(link, event)
+                self._drop_servers(lost)
+            elif kind in ('send', 'private', 'close'):
+                server, _, local_id = event['to'].partition('/')
+                if server == self.name:
+                    self.bus.send(dict(event, to=local_id))
+                elif server in self.routes:
+                    self.routes[server].send(event)
+            elif kind == 'client':
+                self._forward(link, event)
+                self._track(event)
+                self._publish(event['id'])
+            elif kind == 'gone':
+                self._forward(link, event)
+                if event['id'] in self.clients:
+                    self._untrack(event['id'])
+                    self.bus.send(event)
+            elif kind == 'channel':
+                self._forward(link, event)
+                if self.apply_channel(event['name'], event['info'], event.get('burst')):
+                    self.bus.send({'t': 'channel', 'name': event['name']})
+            elif kind in ('chat', 'system'):
+                self._forward(link, event)
+                self.bus.send(event)
+
+    def on_local(self, event):
+        kind = event['t']
+        with self.lock:
+            if kind == 'client':
+                state = dict(event, id=f"{self.name}/{event['id']}", server=self.name)
+                self._track(state)
+                self._forward(None, state)
+            elif kind == 'gone':
+                cid = f"{self.name}/{event['id']}"
+                self._untrack(cid)
+                self._forward(None, {'t': 'gone', 'id': cid})
+            elif kind in ('chat', 'system'):
+                self._forward(None, event)
+            elif kind == 'channel':
+                self._forward(None, {'t': 'channel', 'name': event['name'], 'info': self.channel_info(event['name'])})
+            elif kind in ('send', 'private', 'close'):
+                link = self.routes.get(event['to'].partition('/')[0])
+                if link:
+                    link.send(event)
+
+    def report(self):
+        with self.lock:
+            if not self.links:
+                return f"{self.name}: no links."
+            return f"{self.name} is linked with:\n" + "\n".join(
+                f"{link.name} ({', '.join(sorted(link.servers))}) | queued {link.sock.depth()}" for link in self.links)
+
+    def on_bus_lost(self):
+        log.error("Link manager lost the bus, shutting down.")
+        log.flush()
+        os._exit(1)
+
+    # --- channels ---
+
+    def channel_info(self, name):
+        if not self.store.reload(name):
+            return None
+        info = self.store.get(name)
+        return {'topic': info.topic, 'created': info.created, 'flags': sorted(info.flags)}
+
+    def apply_channel(self, name, info, burst=False):
+        # Returns whether channels.db changed. A burst only adds channels
+        # that are missing, so two servers don't swap their topics.
+        if info is None:
+            changed = self.store.delete(name)
+        elif burst and self.store.get(name):
+            return False
+        else:
+            self.store.update(name, info['topic'], info['created'], info['flags'])
+            changed = True
+        self.store.flush()
+        return changed
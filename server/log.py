@@ -0,0 +1,176 @@
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+import traceback
+
+# Server log. A call only checks the level, stamps the record and puts it on
+# a queue; one background thread formats and writes records, so a slow
+# terminal or disk never holds up a connection. Records are text
+# ("12:00:01 WARNING message") or one JSON object per line, on stdout or in
+# a file.
+#
+# Calls that pass a key (e.g. key='send') are rate limited: the first one in
+# every repeat_window seconds is written, the rest are counted and reported
+# as one "suppressed" line when the window ends. If the queue is full (the
+# writer can't keep up), records are dropped and counted the same way.
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+NAMES = {value: name.upper() for name, value in LEVELS.items()}
+
+class Record:
+    __slots__ = ('time', 'level', 'message', 'fields', 'trace')
+
+    def __init__(self, level, message, fields, trace=None):
+        self.time = time.time()
+        self.level = level
+        self.message = message
+        self.fields = fields
+        self.trace = trace
+
+class Logger:
+    def __init__(self, level=INFO, format='text', repeat_window=10, queue_size=10000):
+        self.level = level
+        self.format = format
+        self.stream = sys.stdout
+        self.repeat_window = repeat_window
+        self.worker = None
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.repeats = {}
+        self.dropped = 0
+        threading.Thread(target=self._writer, daemon=True).start()
+        atexit.register(self.flush)
+
+    def configure(self, level='info', format='text', file=None, repeat_window=10, worker=None):
+        if level not in LEVELS:
+            raise ValueError(f"log level must be one of: {', '.join(LEVELS)}")
+        if format not in ('text', 'json'):
+            raise ValueError("log format must be text or json")
+        self.level = LEVELS[level]
+        self.format = format
+        self.repeat_window = repeat_window
+        self.worker = worker
+        if file:
+            self.stream = open(file, 'a', encoding='utf-8')
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, key=None, trace=None, **fields):
+        if level < self.level:
+            return
+        if key is not None and self.repeat_window:
+            now = time.monotonic()
+            with self.lock:
+                seen = self.repeats.get(key)
+                if seen and now - seen[0] < self.repeat_window:
+                    seen[1] += 1
+                    seen[3] = message
+                    return
+                self.repeats[key] = [now, 0, level, message]
+            if seen and seen[1]:
+                self._put(Record(seen[2], f"{seen[1]} similar messages suppressed (last: {seen[3]})", {'key': key}))
+        self._put(Record(level, message, fields, trace))
+
+    def _put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def debug(self, message, key=None, **fields):
+        self.log(DEBUG, message, key, **fields)
+
+    def info(self, message, key=None, **fields):
+        self.log(INFO, message, key, **fields)
+
+    def warning(self, message, key=None, **fields):
+        self.log(WARNING, message, key, **fields)
+
+    def error(self, message, key=None, **fields):
+        self.log(ERROR, message, key, **fields)
+
+    def exception(self, message, key=None, **fields):
+        # Call from an except block: the traceback is taken here, written later.
+        self.log(ERROR, message, key, traceback.format_exc().rstrip(), **fields)
+
+    def flush(self, timeout=1.0):
+        done = threading.Event()
+        self._put(done)
+        done.wait(timeout)
+
+    # --- writer thread ---
+
+    def _writer(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=1)
+            except queue.Empty:
+                record = None
+            batch = [] if record is None else [record]
+            while len(batch) < 256:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch[:0] = self._expired()
+            events = []
+            lines = []
+            for record in batch:
+                if isinstance(record, threading.Event):
+                    events.append(record)
+                else:
+                    lines.append(self._format(record))
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except Exception:
+                    pass
+            for event in events:
+                event.set()
+
+    def _expired(self):
+        # Windows that ended without another call: report what they held back.
+        records = []
+        now = time.monotonic()
+        with self.lock:
+            for key, (started, count, level, message) in list(self.repeats.items()):
+                if now - started >= self.repeat_window:
+                    del self.repeats[key]
+                    if count:
+                        records.append(Record(level, f"{count} similar messages suppressed (last: {message})",
+                                              {'key': key}))
+            if self.dropped:
+                records.append(Record(WARNING, f"{self.dropped} log records dropped (writer can't keep up)", {}))
+                self.dropped = 0
+        return records
+
+    def _format(self, record):
+        if self.format == 'json':
+            entry = {'time': round(record.time, 3), 'level': NAMES[record.level].lower(), 'message': record.message}
+            if self.worker is not None:
+                entry['worker'] = self.worker
+            entry.update(record.fields)
+            if record.trace:
+                entry['traceback'] = record.trace
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        stamp = time.strftime('%H:%M:%S', time.localtime(record.time))
+        worker = f"[worker {self.worker}] " if self.worker is not None else ""
+        line = f"{stamp} {NAMES[record.level]:<7} {worker}{record.message}"
+        return f"{line}\n{record.trace}" if record.trace else line
+
+default = Logger()
+configure = default.configure
+enabled = default.enabled
+flush = default.flush
+debug = default.debug
+info = default.info
+warning = default.warning
+error = default.error
+exception = default.exception
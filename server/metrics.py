@@ -0,0 +1,165 @@
+import bisect
+import http.server
+import threading
+import time
+
+import log
+
+# Server metrics: counters, latency histograms with fixed buckets and gauges
+# read when a report is made. An update is one short lock and a dict write,
+# so collection stays on under load; rates per second come from two
+# snapshots of the counters taken by a background thread every `interval`
+# seconds. render() writes the Prometheus text format.
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def quantile(self, q):
+        # Upper bound of the bucket the q-th observation falls in.
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Metrics:
+    def __init__(self, enabled=True, interval=5.0):
+        self.enabled = enabled
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.values = {}
+        self.histograms = {}
+        self.collectors = []
+        self.rates = {}
+        if enabled:
+            threading.Thread(target=self._ticker, daemon=True).start()
+
+    def define(self, name, kind, help_text, labels=()):
+        self.kinds[name] = (kind, help_text, labels)
+
+    def collect(self, fn):
+        # fn() returns (name, labels, value) rows for gauges and counters
+        # kept elsewhere; it runs only when a report is made.
+        self.collectors.append(fn)
+
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram.count += 1
+            histogram.sum += seconds
+
+    def _ticker(self):
+        with self.lock:
+            last = dict(self.values)
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                current = dict(self.values)
+            self.rates = {key: (value - last.get(key, 0)) / self.interval for key, value in current.items()}
+            last = current
+
+    def rate(self, name, labels=()):
+        return self.rates.get((name, labels), 0.0)
+
+    def value(self, name, labels=()):
+        return self.values.get((name, labels), 0)
+
+    def by_label(self, name):
+        # {labels: value} for one counter.
+        with self.lock:
+            return {labels: value for (n, labels), value in self.values.items() if n == name}
+
+    def histogram(self, name):
+        with self.lock:
+            return {labels: h for (n, labels), h in self.histograms.items() if n == name}
+
+    def gauges(self):
+        rows = {}
+        for fn in self.collectors:
+            for name, labels, value in fn():
+                rows[(name, labels)] = value
+        return rows
+
+    # --- Prometheus ---
+
+    def _labels(self, name, labels, extra=''):
+        names = self.kinds[name][2]
+        pairs = [f'{key}="{escape(str(value))}"' for key, value in zip(names, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (list(h.counts), h.count, h.sum) for key, h in self.histograms.items()}
+        values.update(self.gauges())
+        lines = []
+        for name, (kind, help_text, _) in self.kinds.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                for (n, labels), (counts, count, total) in sorted(histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, c in zip(BUCKETS + ('+Inf',), counts):
+                        cumulative += c
+                        le = f'le="{bound}"'
+                        lines.append(f"{name}_bucket{self._labels(name, labels, le)} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(name, labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(name, labels)} {count}")
+            else:
+                for (n, labels), value in sorted(values.items()):
+                    if n == name:
+                        lines.append(f"{name}{self._labels(name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, ip='127.0.0.1'):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((ip, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log.info(f"Metrics on http://{ip}:{port}/metrics")
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
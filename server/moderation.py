@@ -0,0 +1,97 @@
+import json
+import os
+import sqlite3
+import threading
+
+import log
+
+# Bans and warning counters in SQLite (WAL mode): every /warn, /banip or
+# /unban is one small row write instead of rewriting a whole JSON file.
+
+class ModerationStore:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS bans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ip TEXT NOT NULL,
+            nick TEXT,
+            reason TEXT,
+            time REAL,
+            expires REAL)""")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS warns (ip TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _read_json(self, path, expected):
+        if not os.path.exists(path):
+            return expected()
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except ValueError as e:
+            log.warning(f"{path} is corrupted ({e}), skipping import.")
+            return expected()
+        if not isinstance(data, expected):
+            log.warning(f"{path} is corrupted (expected {expected.__name__}, got {type(data).__name__}), skipping import.")
+            return expected()
+        return data
+
+    def import_json(self, banip_file, warn_counts_file):
+        # One-time migration of the old JSON files, on the first start.
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key='json_imported'").fetchone():
+                return
+            bans = self._read_json(banip_file, list)
+            warns = {}
+            for ip, count in self._read_json(warn_counts_file, dict).items():
+                try:
+                    warns[ip] = int(count)
+                except (TypeError, ValueError):
+                    log.warning(f"{warn_counts_file}: skipping bad warning count for {ip} ({count!r}).")
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "INSERT INTO bans (ip, nick, reason, time, expires) VALUES (?, ?, ?, ?, ?)",
+                    [(b.get('ip', ''), b.get('nick'), b.get('reason'), b.get('time'), b.get('expires'))
+                     for b in bans if isinstance(b, dict)])
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO warns (ip, count) VALUES (?, ?)",
+                    list(warns.items()))
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', '1')")
+        if bans or warns:
+            log.info(f"Imported {len(bans)} bans and {len(warns)} warning counters from JSON.")
+
+    def load_bans(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT id, ip, nick, reason, time, expires FROM bans ORDER BY id").fetchall()
+        bans = []
+        for ban_id, ip, nick, reason, ban_time, expires in rows:
+            entry = {"id": ban_id, "ip": ip, "nick": nick, "reason": reason, "time": ban_time}
+            if expires:
+                entry["expires"] = expires
+            bans.append(entry)
+        return bans
+
+    def add_ban(self, entry):
+        with self.lock:
+            cur = self.conn.execute(
+                "INSERT INTO bans (ip, nick, reason, time, expires) VALUES (?, ?, ?, ?, ?)",
+                (entry['ip'], entry.get('nick'), entry.get('reason'), entry.get('time'), entry.get('expires')))
+        entry['id'] = cur.lastrowid
+
+    def remove_ban(self, entry):
+        with self.lock:
+            self.conn.execute("DELETE FROM bans WHERE id=?", (entry['id'],))
+
+    def load_warns(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT ip, count FROM warns").fetchall())
+
+    def set_warns(self, ip, count):
+        with self.lock:
+            if count:
+                self.conn.execute("INSERT OR REPLACE INTO warns (ip, count) VALUES (?, ?)", (ip, count))
+            else:
+                self.conn.execute("DELETE FROM warns WHERE ip=?", (ip,))
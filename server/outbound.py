@@ -0,0 +1,213 @@
+import collections
+import socket
+import threading
+
+import log
+from protocol.framing import IOV_MAX, send_vectored
+
+# Per-connection bounded outbound queues. A broadcasting thread only appends
+# the frame; each connection's own writer drains it, so one slow receiver
+# lags alone instead of stalling the channel and the sender.
+#
+# Frames are queued as (header, payload) buffer tuples. After waking up a
+# writer waits up to the coalesce window for more frames and then hands the
+# whole batch to the kernel in one vectored write.
+
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+MAX_BATCH = IOV_MAX // 2
+
+stats = {'dropped_frames': 0, 'overflow_disconnects': 0, 'writes': 0, 'frames_written': 0,
+         'drains': 0, 'frames_drained': 0, 'batches': {}}
+stats_lock = threading.Lock()
+
+def record_write(frames, calls=None):
+    # calls: send syscalls the batch took, or None for a batch handed to an
+    # asyncio transport, which does its own writes (counted as a drain).
+    # 'batches' is a histogram of frames per batch, in power-of-two buckets.
+    bucket = 1 << (frames.bit_length() - 1)
+    with stats_lock:
+        if calls is None:
+            stats['drains'] += 1
+            stats['frames_drained'] += frames
+        else:
+            stats['writes'] += calls
+            stats['frames_written'] += frames
+        stats['batches'][bucket] = stats['batches'].get(bucket, 0) + 1
+
+def as_parts(data):
+    return data if isinstance(data, tuple) else (data,)
+
+class QueueOverflow(OSError):
+    pass
+
+class OutboundQueue:
+    def __init__(self, max_frames=256, policy=DROP_OLDEST, timeout=5.0, coalesce=0.0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown send queue policy '{policy}', expected one of: {', '.join(POLICIES)}")
+        self.frames = collections.deque()
+        self.max_frames = max_frames
+        self.policy = policy
+        self.timeout = timeout
+        self.coalesce = coalesce
+        # Negotiated with /caps: payload codec, AEAD sealer and opener,
+        # compact protocol session, heartbeat.
+        self.codec = None
+        self.sealer = None
+        self.opener = None
+        self.compact = None
+        self.heartbeat = False
+        self.closed = False
+        # Set while a restart hands the connection to a new process (handoff.py).
+        self.held = False
+        self.sent = 0
+        self.dropped = 0
+        self.peak = 0
+
+    def depth(self):
+        return len(self.frames)
+
+    def _count_drops(self, count, disconnect=False):
+        self.dropped += count
+        with stats_lock:
+            stats['dropped_frames'] += count
+            if disconnect:
+                stats['overflow_disconnects'] += 1
+
+    def _take_batch(self):
+        batch = []
+        while self.frames and len(batch) < MAX_BATCH:
+            batch.append(self.frames.popleft())
+        return batch
+
+    def _push(self, data):
+        self.frames.append(as_parts(data))
+        if len(self.frames) > self.peak:
+            self.peak = len(self.frames)
+
+class QueuedSocket(OutboundQueue):
+    # Threaded engine: the connection's reader keeps using the raw socket,
+    # sendall() only queues and a dedicated writer thread does the blocking I/O.
+
+    def __init__(self, sock, max_frames=256, policy=DROP_OLDEST, timeout=5.0, coalesce=0.0):
+        super().__init__(max_frames, policy, timeout, coalesce)
+        self.sock = sock
+        self.cond = threading.Condition()
+        self.sending = False
+        threading.Thread(target=self._drain, daemon=True).start()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendall(self, data):
+        with self.cond:
+            if self.closed:
+                raise OSError("connection is closed")
+            if len(self.frames) >= self.max_frames:
+                if self.policy == DROP_OLDEST:
+                    self.frames.popleft()
+                    self._count_drops(1)
+                elif self.policy == BLOCK and self.cond.wait_for(
+                        lambda: self.closed or len(self.frames) < self.max_frames, self.timeout):
+                    if self.closed:
+                        raise OSError("connection is closed")
+                else:
+                    self._count_drops(len(self.frames) + 1, disconnect=True)
+                    self._abort_locked()
+                    raise QueueOverflow(f"send queue overflow ({self.max_frames} frames), connection dropped")
+            self._push(data)
+            self.cond.notify_all()
+
+    def _drain(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: not self.held and (self.frames or self.closed))
+                if not self.frames:
+                    break
+                if self.coalesce and not self.closed and len(self.frames) < MAX_BATCH:
+                    self.cond.wait_for(lambda: self.closed or self.held or len(self.frames) >= MAX_BATCH,
+                                       self.coalesce)
+                    if self.held:
+                        continue
+                batch = self._take_batch()
+                if not batch:
+                    break
+                self.sending = True
+                self.cond.notify_all()
+            try:
+                calls = send_vectored(self.sock, [part for frame in batch for part in frame])
+                self.sent += len(batch)
+                record_write(len(batch), calls)
+                with self.cond:
+                    self.sending = False
+                    self.cond.notify_all()
+            except OSError as e:
+                with self.cond:
+                    self.sending = False
+                    if not self.closed:
+                        log.warning(f"Send error: {e}", key='send')
+                    self._abort_locked()
+                break
+        self._shutdown()
+
+    def hold(self, timeout):
+        # Restart: the writer stops after the write in progress. Returns the
+        # frames still queued (as bytes), or None if that write doesn't
+        # finish in time.
+        with self.cond:
+            self.held = True
+            if not self.cond.wait_for(lambda: not self.sending, timeout) or self.closed:
+                return None
+            return [b''.join(frame) for frame in self.frames]
+
+    def release(self):
+        with self.cond:
+            self.held = False
+            self.cond.notify_all()
+
+    def _shutdown(self):
+        # shutdown() would end the connection for a process that took it over too.
+        if not self.held:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.sock.close()
+
+    def _abort_locked(self):
+        self.closed = True
+        self.frames.clear()
+        self.cond.notify_all()
+        if self.held:
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def abort(self):
+        with self.cond:
+            self._abort_locked()
+
+    def close(self):
+        # Pending frames (e.g. a kick reason) are still flushed; a writer that
+        # cannot finish within the timeout gets its socket shut down.
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+            pending = bool(self.frames)
+            if self.held:
+                return
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        if pending:
+            timer = threading.Timer(self.timeout, self.abort)
+            timer.daemon = True
+            timer.start()
@@ -0,0 +1,301 @@
+import concurrent.futures
+import heapq
+import importlib.util
+import itertools
+import sys
+import threading
+import time
+
+import log
+
+# Plugin runtime. Plugin code never runs on a connection thread (or the
+# asyncio loop): commands and event hooks are queued to a bounded pool of
+# worker threads, and every call has a time budget. Python can't stop a
+# thread, so a call over budget is reported, the user is told, and a plugin
+# that goes over budget too often is disabled until the next reload.
+#
+# A plugin is a module in plugins/ listed in plugins.cfg with
+#
+#   def setup(plugin):
+#       plugin.command('/roll', roll)      # roll(client, args, reply)
+#       plugin.on_message(log_message)     # log_message(event)  MessageEvent
+#       plugin.on_join(greet)              # greet(event)        JoinEvent
+#       plugin.on_leave(...)               #                     LeaveEvent
+#
+# Older plugins with init_plugin(channels, globals) still load; they get a
+# copy of the server globals, and the commands they put in plugin_commands
+# run on the pool as well.
+#
+# A reload executes every plugin's source in a fresh module object (the
+# loaded module is never changed in place) and builds a new set of commands
+# and hooks. Once all of them are loaded, the modules go into sys.modules and
+# the set is swapped in with one assignment: calls already running finish on
+# the old code, the next ones use the new code. A plugin that fails to
+# reload keeps its previous module and version untouched.
+
+HOOKS = ('message', 'join', 'leave')
+
+class MessageEvent:
+    __slots__ = ('client', 'nick', 'channel', 'text')
+
+    def __init__(self, client, nick, channel, text):
+        self.client = client
+        self.nick = nick
+        self.channel = channel
+        self.text = text
+
+class JoinEvent:
+    __slots__ = ('client', 'nick', 'channel')
+
+    def __init__(self, client, nick, channel):
+        self.client = client
+        self.nick = nick
+        self.channel = channel
+
+class LeaveEvent(JoinEvent):
+    __slots__ = ()
+
+class Plugin:
+    # Handed to setup(); also what plugins may do with the server.
+
+    def __init__(self, name, module, runtime):
+        self.name = name
+        self.module = module
+        self.runtime = runtime
+        self.commands = {}
+        self.hooks = {kind: [] for kind in HOOKS}
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.disabled = False
+
+    def command(self, name, handler):
+        if not name.startswith('/'):
+            raise ValueError(f"command {name!r} must start with '/'")
+        self.commands[name] = handler
+
+    def on_message(self, handler):
+        self.hooks['message'].append(handler)
+
+    def on_join(self, handler):
+        self.hooks['join'].append(handler)
+
+    def on_leave(self, handler):
+        self.hooks['leave'].append(handler)
+
+    def send(self, client, text):
+        self.runtime.send(client, text)
+
+    def find_client(self, nick):
+        return self.runtime.find_client(nick)
+
+    def members(self, channel):
+        return self.runtime.members(channel)
+
+    def system_message(self, text):
+        self.runtime.system_message(text)
+
+class PluginSet:
+    def __init__(self, plugins=()):
+        self.plugins = list(plugins)
+        self.commands = {}
+        self.hooks = {kind: [] for kind in HOOKS}
+        for plugin in self.plugins:
+            for name, handler in plugin.commands.items():
+                if name in self.commands:
+                    log.warning(f"Plugin '{plugin.name}': {name} is already provided by '{self.commands[name][0].name}'.")
+                    continue
+                self.commands[name] = (plugin, handler)
+            for kind, handlers in plugin.hooks.items():
+                self.hooks[kind].extend((plugin, handler) for handler in handlers)
+
+class Call:
+    __slots__ = ('plugin', 'label', 'notify', 'started', 'done', 'late')
+
+    def __init__(self, plugin, label, notify):
+        self.plugin = plugin
+        self.label = label
+        self.notify = notify
+        self.started = time.monotonic()
+        self.done = False
+        self.late = False
+
+class PluginRuntime:
+    def __init__(self, workers=4, timeout=2.0, max_pending=64, max_timeouts=3, channels=None,
+                 send=None, find_client=None, members=None, system_message=None, legacy_globals=None,
+                 on_call=None):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='plugin')
+        self.workers = workers
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_timeouts = max_timeouts
+        self.channels = channels
+        self.send = send
+        self.find_client = find_client
+        self.members = members
+        self.system_message = system_message
+        self.legacy_globals = legacy_globals
+        self.on_call = on_call
+        self.active = PluginSet()
+        self.reload_lock = threading.Lock()
+        self.lock = threading.Condition()
+        self.pending = 0
+        self.rejected = 0
+        self.deadlines = []
+        self.ids = itertools.count()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    # --- loading ---
+
+    def _import(self, full_name):
+        spec = importlib.util.find_spec(full_name)
+        if spec is None or not spec.origin:
+            raise ModuleNotFoundError(f"No module named '{full_name}'")
+        spec = importlib.util.spec_from_file_location(full_name, spec.origin)
+        module = importlib.util.module_from_spec(spec)
+        # Code that looks itself up while it runs (dataclasses, pickle) needs
+        # the entry; the previous module is put back right after.
+        previous = sys.modules.get(full_name)
+        sys.modules[full_name] = module
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            if previous is None:
+                del sys.modules[full_name]
+            else:
+                sys.modules[full_name] = previous
+        return module
+
+    def _load_one(self, name):
+        module = self._import(f"plugins.{name}")
+        plugin = Plugin(name, module, self)
+        if hasattr(module, 'setup'):
+            module.setup(plugin)
+        elif hasattr(module, 'init_plugin'):
+            scope = dict(self.legacy_globals())
+            scope['plugin_commands'] = {}
+            module.init_plugin(self.channels, scope)
+            send_encrypted = scope['send_encrypted']
+            for command, handler in scope['plugin_commands'].items():
+                plugin.command(command, lambda client, args, reply, handler=handler:
+                               handler(client, args, send_encrypted))
+        else:
+            raise ValueError("no setup(plugin) or init_plugin(channels, globals) function")
+        return plugin
+
+    def load(self, names):
+        with self.reload_lock:
+            previous = {plugin.name: plugin for plugin in self.active.plugins}
+            plugins = []
+            for name in names:
+                try:
+                    plugins.append(self._load_one(name))
+                    log.info(f"Plugin '{name}' loaded.")
+                except Exception as e:
+                    log.error(f"Error loading plugin '{name}': {e}")
+                    if name in previous:
+                        log.warning(f"Plugin '{name}' keeps its previous version.")
+                        plugins.append(previous[name])
+            for plugin in plugins:
+                sys.modules[plugin.module.__name__] = plugin.module
+                package = sys.modules.get('plugins')
+                if package is not None:
+                    setattr(package, plugin.name, plugin.module)
+            self.active = PluginSet(plugins)
+
+    def reload(self, names, done=None):
+        # Off the caller's thread; names() is read when the reload starts.
+        def run():
+            self.load(names())
+            if done:
+                done()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    # --- calls ---
+
+    def has_command(self, command):
+        return command in self.active.commands
+
+    def run_command(self, command, client, args, reply):
+        plugin, handler = self.active.commands[command]
+        if plugin.disabled:
+            reply(f"{command} is disabled for now.")
+        elif not self._submit(plugin, command, handler, (client, args, reply), reply):
+            reply("Server is busy, try again later.")
+
+    def wants(self, kind):
+        return bool(self.active.hooks[kind])
+
+    def fire(self, kind, event):
+        for plugin, handler in self.active.hooks[kind]:
+            if not plugin.disabled:
+                self._submit(plugin, f"on_{kind}", handler, (event,))
+
+    def _submit(self, plugin, label, handler, args, notify=None):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            self.pending += 1
+        self.pool.submit(self._run, plugin, label, handler, args, notify)
+        return True
+
+    def _run(self, plugin, label, handler, args, notify):
+        call = Call(plugin, label, notify)
+        with self.lock:
+            heapq.heappush(self.deadlines, (call.started + self.timeout, next(self.ids), call))
+            self.lock.notify()
+        try:
+            handler(*args)
+        except Exception as e:
+            plugin.errors += 1
+            log.exception(f"Plugin '{plugin.name}' error in {label}: {e}", key=f"plugin {plugin.name} {label}")
+            if notify:
+                notify(f"{label} failed.")
+        finally:
+            with self.lock:
+                call.done = True
+                self.pending -= 1
+            plugin.calls += 1
+            if self.on_call:
+                self.on_call(plugin.name, label, time.monotonic() - call.started)
+            if call.late:
+                log.warning(f"Plugin '{plugin.name}' {label} finished after {time.monotonic() - call.started:.1f} s.")
+
+    def _watch(self):
+        while True:
+            with self.lock:
+                while self.deadlines and self.deadlines[0][2].done:
+                    heapq.heappop(self.deadlines)
+                if not self.deadlines:
+                    self.lock.wait()
+                    continue
+                wait = self.deadlines[0][0] - time.monotonic()
+                if wait > 0:
+                    self.lock.wait(wait)
+                    continue
+                call = heapq.heappop(self.deadlines)[2]
+                call.late = True
+            self._over_budget(call)
+
+    def _over_budget(self, call):
+        plugin = call.plugin
+        plugin.timeouts += 1
+        log.warning(f"Plugin '{plugin.name}' {call.label} is over its {self.timeout} s budget.")
+        if call.notify:
+            call.notify(f"{call.label} is taking too long.")
+        if plugin.timeouts >= self.max_timeouts and not plugin.disabled:
+            plugin.disabled = True
+            log.error(f"Plugin '{plugin.name}' disabled after {plugin.timeouts} slow calls (until /plugin_reload).")
+
+    def report(self):
+        with self.lock:
+            pending, rejected = self.pending, self.rejected
+        lines = [f"Plugin pool: {self.workers} workers | {pending}/{self.max_pending} calls pending | "
+                 f"rejected {rejected} | budget {self.timeout} s"]
+        for plugin in self.active.plugins:
+            state = " | DISABLED" if plugin.disabled else ""
+            lines.append(f"{plugin.name} | calls {plugin.calls} | errors {plugin.errors} | "
+                         f"over budget {plugin.timeouts}{state}")
+        return "\n".join(lines)
@@ -0,0 +1,21 @@
+import random
+
+# Example plugin: /roll [NdM] and a greeting for anyone joining a channel.
+# Enable it with "plugins = dice" in plugins.cfg.
+
+def roll(client, args, reply):
+    count, _, sides = (args.strip() or '1d6').lower().partition('d')
+    try:
+        count, sides = int(count or 1), int(sides or 6)
+    except ValueError:
+        reply("Usage: /roll [NdM], e.g. /roll 2d6")
+        return
+    if not (1 <= count <= 20 and 2 <= sides <= 1000):
+        reply("Roll 1-20 dice with 2-1000 sides.")
+        return
+    rolls = [random.randint(1, sides) for _ in range(count)]
+    reply(f"{client.get('nickname', '???')} rolled {count}d{sides}: {' '.join(map(str, rolls))} = {sum(rolls)}")
+
+def setup(plugin):
+    plugin.command('/roll', roll)
+    plugin.on_join(lambda event: plugin.send(event.client, f"Welcome to #{event.channel}, {event.nick}!"))
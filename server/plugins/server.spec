@@ -3,7 +3,7 @@
 
 a = Analysis(
     ['server.py'],
-    pathex=[],
+    pathex=['..'],
     binaries=[('/usr/lib/x86_64-linux-gnu/libpython3.8.so.1.0', '.')],
     datas=[],
     hiddenimports=[],
@@ -0,0 +1,187 @@
+import threading
+from collections.abc import MutableMapping
+
+# Connected clients, nicknames and channel membership. Keeps the old
+# dict/list surface that plugins use (client['nickname'], channels[name],
+# clients.append, ...) on top of hashed indexes.
+
+_MISSING = object()
+_FIELDS = ('socket', 'addr', 'active', 'nickname', 'prefix', 'channel', 'seen')
+
+class ClientRecord(MutableMapping):
+    # A full mapping (keys, items, update, setdefault, del, dict(client), ...)
+    # like the dict it replaces, but hashed and compared by identity so it
+    # can be a member of the channel and client sets.
+    __slots__ = _FIELDS + ('registry', 'extra')
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __init__(self, sock, addr, registry=None):
+        self.socket = sock
+        self.addr = addr
+        self.active = True
+        self.registry = registry
+        self.extra = None
+
+    def _slot(self, key):
+        return key in _FIELDS
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        if self._slot(key):
+            return getattr(self, key, default)
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+
+    def __setitem__(self, key, value):
+        if key == 'nickname' and self.registry is not None:
+            self.registry.reindex(self, value)
+        if self._slot(key):
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        for key in _FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from list(self.extra)
+
+    def __len__(self):
+        return sum(hasattr(self, key) for key in _FIELDS) + len(self.extra or ())
+
+    def pop(self, key, default=_MISSING):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        if key == 'nickname' and self.registry is not None:
+            self.registry.reindex(self, None)
+        if self._slot(key):
+            delattr(self, key)
+        else:
+            del self.extra[key]
+        return value
+
+    def __repr__(self):
+        return f"<Client {self.get('nickname', '???')} {self.addr}>"
+
+class MemberSet:
+    # Insertion-ordered set with the list methods callers used before.
+    # Iteration walks a snapshot, so members may leave while it runs.
+    __slots__ = ('_members',)
+
+    def __init__(self, members=()):
+        self._members = dict.fromkeys(members)
+
+    def append(self, client):
+        self._members[client] = None
+
+    add = append
+
+    def remove(self, client):
+        try:
+            del self._members[client]
+        except KeyError:
+            raise ValueError(f"{client!r} is not a member") from None
+
+    def discard(self, client):
+        self._members.pop(client, None)
+
+    def __contains__(self, client):
+        return client in self._members
+
+    def __iter__(self):
+        return iter(list(self._members))
+
+    def __getitem__(self, index):
+        return list(self._members)[index]
+
+    def __len__(self):
+        return len(self._members)
+
+    def __repr__(self):
+        return f"MemberSet({list(self._members)!r})"
+
+class ChannelMap(dict):
+    # name -> MemberSet. Plugins written for the old API may store a plain
+    # list or set (channels[name] = []); it is turned into a MemberSet.
+
+    def __setitem__(self, name, members):
+        super().__setitem__(name, as_members(members))
+
+    def setdefault(self, name, members=None):
+        if name not in self:
+            self[name] = members if members is not None else MemberSet()
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, members in dict(*args, **kwargs).items():
+            self[name] = members
+
+def as_members(members):
+    return members if isinstance(members, MemberSet) else MemberSet(members)
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clients = MemberSet()
+        self.channels = ChannelMap()
+        self.nicks = {}
+
+    def new_client(self, sock, addr):
+        return ClientRecord(sock, addr, self)
+
+    def add(self, client):
+        with self.lock:
+            self.clients.append(client)
+
+    def remove(self, client):
+        with self.lock:
+            self.part(client)
+            nick = client.get('nickname')
+            if nick and self.nicks.get(nick.casefold()) is client:
+                del self.nicks[nick.casefold()]
+            self.clients.discard(client)
+
+    def find(self, nick):
+        return self.nicks.get(nick.casefold())
+
+    def claim_nick(self, client, nick):
+        with self.lock:
+            owner = self.nicks.get(nick.casefold())
+            if owner is not None and owner is not client:
+                return False
+            client['nickname'] = nick
+            return True
+
+    def reindex(self, client, new_nick):
+        with self.lock:
+            old_nick = client.get('nickname')
+            if old_nick and self.nicks.get(old_nick.casefold()) is client:
+                del self.nicks[old_nick.casefold()]
+            if new_nick:
+                self.nicks[new_nick.casefold()] = client
+
+    def part(self, client):
+        with self.lock:
+            ch = client.pop('channel', None)
+            if ch and ch in self.channels:
+                self.channels[ch].discard(client)
+            return ch
@@ -1,15 +1,38 @@
 import socket
+import sqlite3
+import sys
 import threading
 import time
 import json
 import os
 import re
-import sqlite3
-import importlib
-import importlib.util
-import traceback
+import random
+import subprocess
 from cryptography.fernet import Fernet
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from protocol.framing import FrameReader, frame_parts
+from protocol.compression import CAPS_COMMAND, DEFLATE, compress_payload, decompress_payload, parse_caps
+from protocol.heartbeat import HEARTBEAT, PING_COMMAND, PONG_COMMAND, set_keepalive
+from protocol.aead import AEAD_MARKER, CIPHERS, Opener, Sealer, derive_key, master_key, new_salt
+from protocol.compact import (COMMANDS, COMPACT, COMPACT_MARK, SEPARATOR, CompactSession, StringTable,
+                              channel_record, decode_command, minute_of_day, private_record)
+
+import aio_engine
+import handoff
+import log
+import outbound
+from bus import BusClient, BusHub, RemoteSocket, supervise_workers
+from links import LinkManager
+from registry import Registry, MemberSet
+from bans import AdminIndex, BanList, address_in, parse_network
+from moderation import ModerationStore
+from channel_store import ChannelStore, StoreFrozen
+from colors import parse_colors
+from flood import FloodControl, DELAY, WARN
+from metrics import Metrics
+from plugin_runtime import PluginRuntime, JoinEvent, LeaveEvent, MessageEvent
+
 SERVER_VERSION = "0.9.7"
 
 # === Administration ===
@@ -26,6 +49,7 @@ def load_admins():
         return json.load(f)
 
 admins = load_admins()
+admin_index = AdminIndex(admins)
 
 def get_admin_immunity(admin):
     if admin and 'immunity' in admin:
@@ -36,61 +60,66 @@ def get_admin_immunity(admin):
     return 0
 
 def is_admin(ip, nickname):
-    for a in admins:
-        if a['ip'] == ip and a['nick'].lower() == nickname.lower():
-            return a
-    return None
+    return admin_index.match(ip, nickname)
 
+# Bans and warnings live in moderation.db; the JSON files are only read once
+# to import data from older versions.
+MODERATION_DB = 'moderation.db'
 banip_file = 'banip_users.json'
 WARN_COUNTS_FILE = 'warn_counts.json'
-warn_counts = {}
 
-def load_banned_ips():
-    if not os.path.exists(banip_file):
-        return []
-    with open(banip_file, 'r') as f:
-        return json.load(f)
+moderation = ModerationStore(MODERATION_DB)
+moderation.import_json(banip_file, WARN_COUNTS_FILE)
+
+def set_warn_count(ip, count):
+    if count:
+        warn_counts[ip] = count
+    else:
+        warn_counts.pop(ip, None)
+    moderation.set_warns(ip, count)
+    publish({'t': 'warns', 'ip': ip, 'count': count})
+
+banned_ips = BanList(moderation.load_bans(), on_expire=moderation.remove_ban)
+banned_ips.expire()
+warn_counts = moderation.load_warns()
+
+def ban_ip(ip, reason, nickname="???", duration=None):
+    entry = {"ip": ip, "nick": nickname, "reason": reason, "time": time.time()}
+    if duration:
+        entry["expires"] = entry["time"] + duration
+    moderation.add_ban(entry)
+    banned_ips.add(entry)
+    publish({'t': 'ban', 'entry': entry})
+
+def parse_minutes(text):
+    try:
+        minutes = int(text)
+    except ValueError:
+        return None
+    return minutes if minutes >= 0 else None
 
-def save_banned_ips(data):
-    with open(banip_file, 'w') as f:
-        json.dump(data, f)
-
-def load_warn_counts():
-    if not os.path.exists(WARN_COUNTS_FILE):
-        return {}
-    with open(WARN_COUNTS_FILE, 'r') as f:
-        data = json.load(f)
-        if not isinstance(data, dict):
-            print(f"[!] WARNING: warn_counts.json is corrupted (expected dict, got {type(data)}), overwriting.")
-            import shutil
-            shutil.move(WARN_COUNTS_FILE, WARN_COUNTS_FILE + ".bak")
-            return {}
-        return data
-
-def save_warn_counts():
-    with open(WARN_COUNTS_FILE, 'w') as f:
-        json.dump(warn_counts, f)
-
-banned_ips = load_banned_ips()
-warn_counts = load_warn_counts()
-
-def ban_ip(ip, reason, nickname="???"):
-    global banned_ips
-    banned_ips.append({"ip": ip, "nick": nickname, "reason": reason, "time": time.time()})
-    save_banned_ips(banned_ips)
-
-def broadcast_system_message(message):
-    for c in clients[:]:
+def broadcast_system_message(message, relay=True):
+    # Encrypted once per codec, the same frame goes to every client.
+    frames = {}
+    if relay:
+        publish({'t': 'system', 'text': message})
+    for c in clients:
+        if is_remote(c):
+            continue
         try:
-            if not isinstance(c, dict):
-                print(f"[!] Invalid object in clients: {repr(c)}")
-                clients.remove(c)
-                continue
-            send_encrypted(c['socket'], f"[System] {message}")
+            send_frame(c['socket'], cached_frame(frames, f"[System] {message}", c['socket']))
         except Exception as e:
-            print(f"[!] System broadcast error: {e}")
-            if c in clients:
-                clients.remove(c)
+            log.warning(f"System broadcast error: {e}", key='broadcast')
+            registry.remove(c)
+
+def disconnect_client(target):
+    target['active'] = False
+    try:
+        ch = target.get('channel')
+        registry.remove(target)
+        fire_leave(target, ch)
+    finally:
+        target['socket'].close()
 
 def handle_admin_command(client, command, args, sock):
     admin = is_admin(client.get('addr')[0], client.get('nickname', ''))
@@ -102,7 +131,9 @@ def handle_admin_command(client, command, args, sock):
     args_split = args.strip().split()
 
     if cmd == '/ahelp':
-        send_encrypted(sock, "/kick <nick> <reason>, /banip <nick> <reason>, /warn <nick>, /bans, /unban <nick>, /plugin_reload")
+        send_encrypted(sock, "/kick <nick> <reason>, /banip <nick> <reason>, /tempban <nick> <minutes> <reason>, "
+                             "/bansubnet <cidr> <minutes, 0 = permanent> <reason>, /warn <nick>, /bans, "
+                             "/unban <nick|ip|cidr>, /plugin_reload, /stats")
 
     elif cmd == '/kick':
         if len(args_split) < 2:
@@ -117,26 +148,26 @@ def handle_admin_command(client, command, args, sock):
                 send_encrypted(sock, "Cannot kick an admin with equal or higher immunity.")
                 return
             send_encrypted(target['socket'], f"You have been kicked. Reason: {reason}")
-            target['active'] = False
-            with channel_lock:
-                ch = target.get('channel')
-                if ch and ch in channels and target in channels[ch]:
-                    channels[ch].remove(target)
-                target.pop('channel', None)
-            target['socket'].close()
-            if target in clients:
-                clients.remove(target)
+            disconnect_client(target)
             send_encrypted(sock, f"User {target_nick} has been kicked.")
             broadcast_system_message(f"Admin {client.get('nickname', '???')} kicked user {target_nick} for reason: {reason}")
         else:
             send_encrypted(sock, "User not found.")
 
-    elif cmd == '/banip':
-        if len(args_split) < 2:
-            send_encrypted(sock, "Usage: /banip <nick> <reason>")
+    elif cmd in ('/banip', '/tempban'):
+        timed = cmd == '/tempban'
+        usage = "Usage: /tempban <nick> <minutes> <reason>" if timed else "Usage: /banip <nick> <reason>"
+        reason_at = 2 if timed else 1
+        if len(args_split) <= reason_at:
+            send_encrypted(sock, usage)
+            return
+        minutes = parse_minutes(args_split[1]) if timed else None
+        if timed and not minutes:
+            send_encrypted(sock, usage)
             return
         target_nick = args_split[0]
-        reason = ' '.join(args_split[1:])
+        reason = ' '.join(args_split[reason_at:])
+        period = f" for {minutes} min" if timed else ""
         target = find_client_by_nickname(target_nick, clients)
         if target:
             target_admin = is_admin(target['addr'][0], target.get('nickname', ''))
@@ -144,22 +175,42 @@ def handle_admin_command(client, command, args, sock):
                 send_encrypted(sock, "Cannot ban an admin with equal or higher immunity.")
                 return
             ip = target['addr'][0]
-            ban_ip(ip, reason, target.get('nickname', '???'))
-            send_encrypted(target['socket'], f"You have been IP banned. Reason: {reason}")
-            target['active'] = False
-            with channel_lock:
-                ch = target.get('channel')
-                if ch and ch in channels and target in channels[ch]:
-                    channels[ch].remove(target)
-                target.pop('channel', None)
-            target['socket'].close()
-            if target in clients:
-                clients.remove(target)
-            send_encrypted(sock, f"User {target_nick} has been IP banned on {ip}.")
-            broadcast_system_message(f"Admin {client.get('nickname', '???')} blocked IP address of user {target_nick} ({ip}) for reason: {reason}") 
+            ban_ip(ip, reason, target.get('nickname', '???'), minutes * 60 if timed else None)
+            send_encrypted(target['socket'], f"You have been IP banned{period}. Reason: {reason}")
+            disconnect_client(target)
+            send_encrypted(sock, f"User {target_nick} has been IP banned on {ip}{period}.")
+            broadcast_system_message(f"Admin {client.get('nickname', '???')} blocked IP address of user {target_nick} ({ip}){period} for reason: {reason}") 
         else:
             send_encrypted(sock, "User not found.")
 
+    elif cmd == '/bansubnet':
+        usage = "Usage: /bansubnet <cidr> <minutes, 0 = permanent> <reason>"
+        if len(args_split) < 3:
+            send_encrypted(sock, usage)
+            return
+        network = parse_network(args_split[0])
+        minutes = parse_minutes(args_split[1])
+        if network is None or minutes is None:
+            send_encrypted(sock, usage)
+            return
+        reason = ' '.join(args_split[2:])
+        affected = [c for c in clients if address_in(c['addr'][0], network)]
+        if client in affected:
+            send_encrypted(sock, "Cannot ban a subnet that contains your own address.")
+            return
+        for c in affected:
+            c_admin = is_admin(c['addr'][0], c.get('nickname', ''))
+            if c_admin and get_admin_immunity(c_admin) >= get_admin_immunity(admin):
+                send_encrypted(sock, f"Cannot ban a subnet with admin {c.get('nickname', '???')} of equal or higher immunity.")
+                return
+        period = f" for {minutes} min" if minutes else ""
+        ban_ip(str(network), reason, "*", minutes * 60 or None)
+        for c in affected:
+            send_encrypted(c['socket'], f"Your network has been banned{period}. Reason: {reason}")
+            disconnect_client(c)
+        send_encrypted(sock, f"Subnet {network} has been banned{period}, {len(affected)} user(s) disconnected.")
+        broadcast_system_message(f"Admin {client.get('nickname', '???')} blocked subnet {network}{period} for reason: {reason}")
+
     elif cmd == '/warn':
         if len(args_split) != 1:
             send_encrypted(sock, "Usage: /warn <nick>")
@@ -172,31 +223,22 @@ def handle_admin_command(client, command, args, sock):
                 send_encrypted(sock, "Cannot warn an admin with equal or higher immunity.")
                 return
             ip = target['addr'][0]
-            warn_counts[ip] = warn_counts.get(ip, 0) + 1
-            save_warn_counts()
+            set_warn_count(ip, warn_counts.get(ip, 0) + 1)
             send_encrypted(target['socket'], f"Warning! ({warn_counts[ip]}/{WARN_LIMIT})")
             send_encrypted(sock, f"User {target_nick} has been warned ({warn_counts[ip]}/{WARN_LIMIT}).")
             broadcast_system_message(f"Admin {client.get('nickname', '???')} warned user {target_nick} ({warn_counts[ip]}/{WARN_LIMIT})")
             if warn_counts[ip] >= WARN_LIMIT:
                 ban_ip(ip, "Multiple warnings", target.get('nickname', '???'))
                 send_encrypted(target['socket'], "You have been banned for multiple warnings.")
-                warn_counts.pop(ip)
-                save_warn_counts()
-                target['active'] = False
-                with channel_lock:
-                    ch = target.get('channel')
-                    if ch and ch in channels and target in channels[ch]:
-                        channels[ch].remove(target)
-                    target.pop('channel', None)
-                target['socket'].close()
-                if target in clients:
-                    clients.remove(target)
+                set_warn_count(ip, 0)
+                disconnect_client(target)
                 send_encrypted(sock, f"User {target_nick} has been banned for warnings.")
                 broadcast_system_message(f"Admin {client.get('nickname', '???')} blocked IP address of user {target_nick} ({ip}) for exceeding warning limit.")
         else:
             send_encrypted(sock, "User not found.")
 
     elif cmd == '/bans':
+        banned_ips.expire()
         if not banned_ips:
             send_encrypted(sock, "Ban list is empty.")
         else:
@@ -206,35 +248,42 @@ def handle_admin_command(client, command, args, sock):
                 nick = ban.get('nick', '???')
                 reason = ban.get('reason', 'not specified')
                 ban_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ban.get('time', 0)))
+                if ban.get('expires'):
+                    ban_time += " until " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ban['expires']))
                 lines.append(f"{idx}. {nick} | {ip} | {reason} | {ban_time}")
             bans_text = "\n".join(lines)
             send_encrypted(sock, bans_text)
 
     elif cmd == '/unban':
         if len(args_split) != 1:
-            send_encrypted(sock, "Usage: /unban <nick>")
+            send_encrypted(sock, "Usage: /unban <nick|ip|cidr>")
             return
         target_nick = args_split[0].lower()
+        network = parse_network(target_nick)
         unbanned = False
-        for entry in banned_ips[:]:
-            if entry.get('nick', '').lower() == target_nick:
+        for entry in banned_ips:
+            if (entry.get('nick') or '').lower() == target_nick or (network and parse_network(entry.get('ip') or '') == network):
                 banned_ips.remove(entry)
-                save_banned_ips(banned_ips)
+                moderation.remove_ban(entry)
+                publish({'t': 'unban', 'id': entry.get('id')})
                 send_encrypted(sock, f"IP {entry.get('ip', '???')} has been unbanned.")
                 unbanned = True
                 break
         if not unbanned:
             send_encrypted(sock, "User not found or not banned.")
 
+    elif cmd == '/stats':
+        send_encrypted(sock, worker_report('/stats'))
+
     elif cmd == '/plugin_reload':
-        load_plugins()
-        send_encrypted(sock, "Plugins reloaded.")
+        plugins.reload(plugin_names, lambda: send_encrypted(sock, "Plugins reloaded."))
+        publish({'t': 'plugins'})
 
     else:
         send_encrypted(sock, "Unknown command. Use /ahelp for command list.")
 
 def is_banned(ip):
-    return any(entry['ip'] == ip for entry in banned_ips)
+    return banned_ips.match(ip) is not None
 
 def load_config():
     if not os.path.exists('config.json'):
@@ -255,122 +304,267 @@ if config.get('encryption', True):
 else:
     fernet = None
 
-clients = []
-channel_lock = threading.Lock()
-plugin_commands = {}
-
-def parse_colors(text):
-    mc_color_map = {
-        '0': '\033[30m', '1': '\033[34m', '2': '\033[32m', '3': '\033[36m',
-        '4': '\033[31m', '5': '\033[35m', '6': '\033[33m', '7': '\033[37m',
-        '8': '\033[90m', '9': '\033[94m', 'a': '\033[92m', 'b': '\033[96m',
-        'c': '\033[91m', 'd': '\033[95m', 'e': '\033[93m', 'f': '\033[97m',
-    }
-    mc_style_map = {
-        'l': '\033[1m', 'o': '\033[3m', 'n': '\033[4m', 'm': '\033[9m',
-    }
-
-    i = 0
-    result = ''
-    while i < len(text):
-        if text[i] == '&' and i + 1 < len(text):
-            code = text[i+1].lower()
-            if code == 'r':
-                result += '\033[0m'
-                i += 2
-                continue
-            elif code in mc_color_map:
-                result += mc_color_map[code]
-                i += 2
-                continue
-            elif code in mc_style_map:
-                result += mc_style_map[code]
-                i += 2
-                continue
-        result += text[i]
-        i += 1
-    result += '\033[0m'
-    return result
-
-def init_db():
-    conn = sqlite3.connect('channels.db')
-    cur = conn.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS channels (name TEXT PRIMARY KEY)")
-    conn.commit()
-    conn.close()
+# Optional AEAD transport ("transport" in config.json), offered to clients
+# that ask for it in /caps. Others keep using Fernet.
+if fernet and config.get('transport', 'fernet') in CIPHERS:
+    aead_cipher = config['transport']
+else:
+    aead_cipher = None
+
+welcome_banner = parse_colors(config['welcome_text'])
+
+# Multi-process mode (see bus.py). The process started by hand is worker 0:
+# it runs the bus hub and the console and starts the other workers.
+WORKERS = config.get('workers', 1)
+worker_id = int(sys.argv[sys.argv.index('--worker') + 1]) if '--worker' in sys.argv else 0
+bus = None
+bus_clients = {}
+# Server-to-server links (see links.py); they need the bus even with one worker.
+LINK = config.get('link')
+link_manager = None
+
+# Logging (see log.py). Channel messages are only written with echo_messages.
+log_config = config.get('log', {})
+try:
+    log.configure(log_config.get('level', 'info'), log_config.get('format', 'text'), log_config.get('file'),
+                  log_config.get('repeat_window', 10), worker_id if WORKERS > 1 else None)
+except (ValueError, OSError) as e:
+    print(f"Error: {e}.")
+    exit(1)
+ECHO_MESSAGES = log_config.get('echo_messages', False)
+ECHO_COLORS = log_config.get('format', 'text') == 'text' and not log_config.get('file')
+
+flood_config = config.get('flood_control', {})
+try:
+    flood = FloodControl(flood_config) if flood_config.get('enabled', True) else None
+except ValueError as e:
+    print(f"Error: {e}.")
+    exit(1)
+FLOOD_WARN_INTERVAL = flood_config.get('warn_interval', 10)
+
+# Heartbeat (see protocol/heartbeat.py): clients that negotiated it are
+# pinged after ping_interval seconds of silence and closed after
+# ping_timeout; idle_timeout closes any client, old ones included.
+PING_INTERVAL = config.get('ping_interval', 30)
+PING_TIMEOUT = config.get('ping_timeout', 90)
+IDLE_TIMEOUT = config.get('idle_timeout', 0)
+TCP_KEEPALIVE = config.get('tcp_keepalive', 60)
+
+# Console /restart (see handoff.py). Threaded readers and the accept loop go
+# through handoff.ParkingSocket so a restart can stop them between frames.
+restarts = handoff.Handoff() if handoff.supported() and WORKERS == 1 and not LINK else None
+RESTART_TIMEOUT = config.get('restart_timeout', 10)
+listener = None
+
+metrics = Metrics(config.get('metrics', True), config.get('metrics_interval', 5))
+metrics.define('privnet_connections', 'gauge', "Open client connections.")
+metrics.define('privnet_frames_in_total', 'counter', "Frames received from clients.")
+metrics.define('privnet_bytes_in_total', 'counter', "Bytes received from clients.")
+metrics.define('privnet_frames_out_total', 'counter', "Frames sent to clients.")
+metrics.define('privnet_bytes_out_total', 'counter', "Bytes sent to clients.")
+metrics.define('privnet_receive_errors_total', 'counter', "Frames that could not be read or decrypted.")
+metrics.define('privnet_send_errors_total', 'counter', "Frames that could not be sent.")
+metrics.define('privnet_channel_messages_in_total', 'counter', "Chat messages sent to a channel.", ('channel',))
+metrics.define('privnet_channel_bytes_in_total', 'counter', "Chat message text bytes sent to a channel.", ('channel',))
+metrics.define('privnet_channel_messages_out_total', 'counter', "Chat messages delivered to channel members.", ('channel',))
+metrics.define('privnet_channel_bytes_out_total', 'counter', "Bytes of chat messages delivered to channel members.", ('channel',))
+metrics.define('privnet_encrypt_seconds', 'histogram', "Time to compress and encrypt one frame.")
+metrics.define('privnet_decrypt_seconds', 'histogram', "Time to decrypt and decompress one frame.")
+metrics.define('privnet_command_seconds', 'histogram', "Time to handle a command or chat message.", ('command',))
+metrics.define('privnet_plugin_seconds', 'histogram', "Time plugin commands and hooks run.", ('plugin', 'call'))
+metrics.define('privnet_send_queue_frames', 'gauge', "Frames waiting in client send queues.")
+metrics.define('privnet_send_queue_max_frames', 'gauge', "Frames in the longest client send queue.")
+metrics.define('privnet_dropped_frames_total', 'counter', "Frames dropped from full send queues.")
+metrics.define('privnet_flood_throttled_total', 'counter', "Messages held back by flood control.", ('limit', 'action'))
+metrics.define('privnet_plugin_calls_pending', 'gauge', "Plugin calls queued or running.")
+metrics.define('privnet_plugin_calls_rejected_total', 'counter', "Plugin calls refused because the pool was full.")
+metrics.define('privnet_ping_seconds', 'histogram', "Round trip of server pings.")
+metrics.define('privnet_reaped_total', 'counter', "Connections closed for not answering or idling.", ('reason',))
+
+registry = Registry()
+clients = registry.clients
+channels = registry.channels
+channel_lock = registry.lock
+
+plugins = PluginRuntime(
+    workers=config.get('plugin_workers', 4),
+    timeout=config.get('plugin_timeout', 2.0),
+    max_pending=config.get('plugin_queue_size', 64),
+    max_timeouts=config.get('plugin_max_timeouts', 3),
+    channels=channels,
+    send=lambda client, text: send_encrypted(client['socket'], text),
+    find_client=lambda nick: find_client_by_nickname(nick),
+    members=lambda name: [c.get('nickname', '???') for c in channels.get(name, ())],
+    system_message=lambda text: broadcast_system_message(text),
+    legacy_globals=lambda: globals(),
+    on_call=lambda plugin, label, seconds: record_plugin_call(plugin, label, seconds),
+)
+
+channel_store = ChannelStore('channels.db')
 
 def load_channels():
-    conn = sqlite3.connect('channels.db')
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM channels")
-    result = {row[0]: [] for row in cur.fetchall()}
-    conn.close()
-    return result
+    return {name: MemberSet() for name in channel_store.names()}
 
 def create_channel(name, channels):
     if name in channels:
         return f"Channel #{name} already exists."
     try:
-        conn = sqlite3.connect('channels.db')
-        cur = conn.cursor()
-        cur.execute("INSERT INTO channels (name) VALUES (?)", (name,))
-        conn.commit()
-        conn.close()
-        channels[name] = []
-        return f"Channel #{name} created."
-    except Exception as e:
-        return f"Error: {e}"
+        channel_store.create(name)
+    except StoreFrozen as e:
+        return f"Error: {e}."
+    channels[name] = MemberSet()
+    publish_channel(name)
+    return f"Channel #{name} created."
 
 def delete_channel(name, channels):
     if name not in channels:
         return f"Channel #{name} not found."
     try:
-        conn = sqlite3.connect('channels.db')
-        cur = conn.cursor()
-        cur.execute("DELETE FROM channels WHERE name=?", (name,))
-        conn.commit()
-        conn.close()
-        del channels[name]
-        return f"Channel #{name} deleted."
-    except Exception as e:
-        return f"Error: {e}"
+        channel_store.delete(name)
+    except StoreFrozen as e:
+        return f"Error: {e}."
+    drop_channel(name)
+    publish_channel(name)
+    return f"Channel #{name} deleted."
+
+def drop_channel(name):
+    with channel_lock:
+        for member in channels.pop(name, ()):
+            member.pop('channel', None)
 
-def send_encrypted(sock, message):
+def set_topic(name, topic):
+    try:
+        channel_store.set_topic(name, topic)
+    except StoreFrozen as e:
+        return f"Error: {e}."
+    publish_channel(name)
+    return f"Topic of #{name} set: {topic}" if topic else f"Topic of #{name} cleared."
+
+def set_channel_flag(name, change):
+    if not change or change[0] not in '+-' or not is_valid_name(change[1:]):
+        return "Usage: /flag <channel> <+flag|-flag>"
+    try:
+        channel_store.set_flag(name, change[1:], change[0] == '+')
+    except StoreFrozen as e:
+        return f"Error: {e}."
+    publish_channel(name)
+    return f"Flags of #{name}: {', '.join(sorted(channel_store.get(name).flags)) or 'none'}"
+
+def channel_info(name):
+    info = channel_store.get(name)
+    created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info.created))
+    return (f"#{name} | members: {len(channels.get(name, ()))} | created: {created} | "
+            f"flags: {', '.join(sorted(info.flags)) or 'none'} | topic: {info.topic or '-'}")
+
+def channel_list_line(name):
+    info = channel_store.get(name)
+    return f"#{name} – {info.topic}" if info and info.topic else f"#{name}"
+
+def encode_payload(message, codec=None):
     data = message.encode()
-    if fernet:
-        data = fernet.encrypt(data)
+    return compress_payload(data) if codec == DEFLATE else data
+
+def seal_payload(data, sealer=None):
+    if sealer:
+        return sealer.seal(data)
+    return fernet.encrypt(data) if fernet else data
+
+def build_frame(message, codec=None, sealer=None):
+    start = time.perf_counter()
+    data = seal_payload(encode_payload(message, codec), sealer)
+    metrics.observe('privnet_encrypt_seconds', (), time.perf_counter() - start)
+    return frame_parts(data)
+
+def send_frame(sock, frame):
     try:
-        sock.sendall(len(data).to_bytes(4, 'big') + data)
+        sock.sendall(frame)
     except Exception as e:
-        print(f"[!] Send error: {e}")
+        metrics.inc('privnet_send_errors_total')
+        log.warning(f"Send error: {e}", key='send')
+        return
+    metrics.inc('privnet_frames_out_total')
+    metrics.inc('privnet_bytes_out_total', (), len(frame[0]) + len(frame[1]))
+
+def cached_frame(frames, message, sock):
+    # One frame per negotiated codec for a message going to many clients.
+    # AEAD connections each have their own key and counter: they share the
+    # compressed payload and seal it themselves.
+    codec = getattr(sock, 'codec', None)
+    sealer = getattr(sock, 'sealer', None)
+    if not sealer:
+        if codec not in frames:
+            frames[codec] = build_frame(message, codec)
+        return frames[codec]
+    start = time.perf_counter()
+    variant = ('plain', codec)
+    if variant not in frames:
+        frames[variant] = encode_payload(message, codec)
+    data = sealer.seal(frames[variant])
+    metrics.observe('privnet_encrypt_seconds', (), time.perf_counter() - start)
+    return frame_parts(data)
 
-def recv_encrypted(sock):
+def send_encrypted(sock, message):
+    if isinstance(sock, RemoteSocket):
+        sock.send_text(message)
+        return
+    send_frame(sock, build_frame(message, getattr(sock, 'codec', None), getattr(sock, 'sealer', None)))
+
+# Nick/channel/prefix ids for clients using the compact protocol.
+compact_strings = StringTable()
+
+def send_compact(sock, record, generation, definitions, frames=None):
+    # Definitions and the clock step this client has not seen yet go in
+    # front of the record; otherwise the frame is shared via `frames`.
+    session = sock.compact
+    with session.lock:
+        prelude = session.prelude(generation, definitions, minute_of_day(time.localtime()), sock.dropped)
+        if prelude:
+            frame = build_frame(COMPACT_MARK + SEPARATOR.join(prelude + [record]), sock.codec, sock.sealer)
+        else:
+            frame = cached_frame({} if frames is None else frames, COMPACT_MARK + record, sock)
+        send_frame(sock, frame)
+        return frame
+
+def send_private(sock, outgoing, nick, message, line):
+    if isinstance(sock, RemoteSocket):
+        sock.send_private(outgoing, nick, message, line)
+    elif getattr(sock, 'compact', None):
+        generation, (sid,) = compact_strings.intern(nick)
+        send_compact(sock, private_record(outgoing, sid, message), generation, [(sid, nick)])
+    else:
+        send_encrypted(sock, line)
+
+def decode_payload(data, sock=None):
+    start = time.perf_counter()
+    metrics.inc('privnet_frames_in_total')
+    metrics.inc('privnet_bytes_in_total', (), len(data) + 4)
+    opener = getattr(sock, 'opener', None)
+    if opener and data[:1] == AEAD_MARKER:
+        data = opener.open(data)
+    elif fernet:
+        data = fernet.decrypt(data)
+    if getattr(sock, 'codec', None) == DEFLATE:
+        data = decompress_payload(data, config.get('max_frame_size', 65536))
+    metrics.observe('privnet_decrypt_seconds', (), time.perf_counter() - start)
+    return data.decode()
+
+def recv_encrypted(reader, sock=None):
     try:
-        length_bytes = sock.recv(4)
-        if not length_bytes:
+        data = reader.read_frame()
+        if data is None:
             return None
-        length = int.from_bytes(length_bytes, 'big')
-        data = b''
-        while len(data) < length:
-            chunk = sock.recv(length - len(data))
-            if not chunk:
-                return None
-            data += chunk
-        if fernet:
-            data = fernet.decrypt(data)
-        return data.decode()
+        return decode_payload(data, sock)
     except Exception as e:
-        print(f"[!] Receive error: {e}")
+        metrics.inc('privnet_receive_errors_total')
+        log.warning(f"Receive error: {e}", key='receive')
         return None
 
-def load_plugins():
-    global plugin_commands
-    plugin_commands.clear()
+def plugin_names():
     if not os.path.exists('plugins.cfg'):
-        print("plugins.cfg file not found.")
-        return
+        log.warning("plugins.cfg file not found.")
+        return []
 
-    plugin_names = []
+    names = []
 
     with open('plugins.cfg', 'r') as f:
         for line in f:
@@ -378,18 +572,11 @@ def load_plugins():
             if line.startswith("plugins"):
                 parts = line.split("=")
                 if len(parts) == 2:
-                    plugin_names = parts[1].strip().split()
+                    names = parts[1].strip().split()
+    return names
 
-    for name in plugin_names:
-        try:
-            module = importlib.import_module(f"plugins.{name}")
-            if hasattr(module, 'init_plugin'):
-                module.init_plugin(channels, globals())
-                print(f"[+] Plugin '{name}' loaded.")
-            else:
-                print(f"[!] Plugin '{name}' doesn't have init_plugin function.")
-        except Exception as e:
-            print(f"[!] Error loading plugin '{name}': {e}")
+def load_plugins():
+    plugins.load(plugin_names())
 
 def format_message(client, msg):
     timestamp = time.strftime("[%H:%M]")
@@ -412,23 +599,32 @@ def join_channel(client, name, channels):
             return f"You're already in channel #{client['channel']}"
         if name not in channels:
             return f"Channel #{name} doesn't exist."
-        if not isinstance(client, dict):
-            print(f"[!] Attempt to add non-dict to channel {name}: {client}")
-            return "Client structure error."
         client['channel'] = name
         channels[name].append(client)
+        if plugins.wants('join'):
+            plugins.fire('join', JoinEvent(client, client.get('nickname'), name))
+        info = channel_store.get(name)
+        if info and info.topic:
+            return f"You joined channel #{name}\nTopic: {info.topic}"
         return f"You joined channel #{name}"
 
 def leave_channel(client, channels):
     with channel_lock:
         ch = client.pop('channel', None)
-        if ch and ch in channels and client in channels[ch]:
-            channels[ch].remove(client)
+        if ch and ch in channels:
+            channels[ch].discard(client)
+        fire_leave(client, ch)
         return f"You left channel #{ch}" if ch else "You're not in a channel."
 
-def find_client_by_nickname(nick, clients):
+def fire_leave(client, ch):
+    if ch and plugins.wants('leave'):
+        plugins.fire('leave', LeaveEvent(client, client.get('nickname'), ch))
+
+def find_client_by_nickname(nick, clients=None):
+    if clients is None or clients is registry.clients:
+        return registry.find(nick)
     for c in clients:
-        if isinstance(c, dict) and c.get('nickname', '').lower() == nick.lower():
+        if c.get('nickname', '').lower() == nick.lower():
             return c
     return None
 
@@ -436,200 +632,886 @@ def get_admins_in_channel(channel_name, channels):
     nicks = []
     if channel_name in channels:
         for c in channels[channel_name]:
-            if isinstance(c, dict):
-                admin_info = is_admin(c.get('addr', [''])[0], c.get('nickname', ''))
-                if admin_info:
-                    nicks.append(c.get('nickname', '?'))
+            admin_info = is_admin(c.get('addr', [''])[0], c.get('nickname', ''))
+            if admin_info:
+                nicks.append(c.get('nickname', '?'))
     return nicks
 
 def is_valid_name(name):
     return re.fullmatch(r'[A-Za-z0-9_]{3,16}', name) is not None
 
-def handle_client(sock, addr, channels):
-    client = {'socket': sock, 'active': True}
-    client['addr'] = addr
+def accept_client(sock, addr):
+    client = registry.new_client(sock, addr)
     admin_info = is_admin(addr[0], client.get('nickname', ''))
     if admin_info:
         client['prefix'] = admin_info['prefix']
 
     if is_banned(addr[0]):
         sock.close()
-        print(f"[-] Blocked connection from banned IP {addr[0]}")
-        return
+        log.info(f"Blocked connection from banned IP {addr[0]}", key=f'banned {addr[0]}')
+        return None
 
-    # --- Client limit ---
-    if len(clients) >= config.get("max_clients", 32):
+    # --- Client limit --- (connections to this process; users on other
+    # workers and linked servers are only mirrored here)
+    if local_count() >= config.get("max_clients", 32):
         try:
             send_encrypted(sock, "Server is full, try again later.")
         except Exception:
             pass
         sock.close()
-        print(f"[-] Rejected connection {addr}: client limit reached.")
-        return
-
-    clients.append(client)
-    print(f"[+] Connection from {addr}")
-    send_encrypted(sock, parse_colors(config['welcome_text']))
-
-    try:
-        while client['active']:
-            msg = recv_encrypted(sock)
-            if not msg:
-                break
-
-            if msg.startswith('/'):
-                parts = msg.strip().split(' ', 1)
-                command = parts[0]
-                args = parts[1] if len(parts) > 1 else ''
-
-                if command == '/nick':
-                    new_nick = args.strip()
-                    if not new_nick:
-                        send_encrypted(sock, "Usage: /nick <name>")
-                        continue
-                    if not is_valid_name(new_nick):
-                        send_encrypted(sock, "Nick must contain only latin letters and numbers, 3-16 characters.")
-                        continue
-                    if any(isinstance(c, dict) and c.get('nickname', '').lower() == new_nick.lower() for c in clients):
-                        send_encrypted(sock, "Nick is already in use.")
-                        continue
-                    client['nickname'] = new_nick
-                    admin_info = is_admin(addr[0], new_nick)
-                    if admin_info:
-                        client['prefix'] = admin_info['prefix']
-                    else:
-                        client['prefix'] = ''
-                    send_encrypted(sock, f"Nick set: {new_nick}")
-                    continue
-
-                elif command == '/prefix':
-                    new_prefix = args.strip()
-                    if not is_valid_name(new_prefix):
-                        send_encrypted(sock, "Prefix must contain only latin letters and numbers, 3-16 characters.")
-                        continue
-                    client['prefix'] = new_prefix
-                    send_encrypted(sock, f"Prefix set: {new_prefix}")
-                    continue
-
-                elif command == '/join':
-                    send_encrypted(sock, join_channel(client, args, channels))
-                    continue
-
-                elif command == '/leave':
-                    send_encrypted(sock, leave_channel(client, channels))
-                    continue
-
-                elif command == '/who':
-                    ch = client.get('channel')
-                    if ch and ch in channels:
-                        names = [c.get('nickname', '?') for c in channels[ch] if isinstance(c, dict)]
-                        send_encrypted(sock, f"Channel #{ch} members: {', '.join(names)}")
-                    else:
-                        send_encrypted(sock, "You're not in a channel.")
-                    continue
-
-                elif command == '/list':
-                    send_encrypted(sock, "Channel list:\n" + "\n".join(f"#{k}" for k in channels))
-                    continue
-
-                elif command == '/msg':
-                    try:
-                        to, message = args.split(' ', 1)
-                        target = find_client_by_nickname(to, clients)
-                        if target:
-                            timestamp = time.strftime("[%H:%M]")
-                            from_msg = f"{timestamp} [You ➔ {to}]: {message}"
-                            to_msg = f"{timestamp} [{client['nickname']} ➔ You]: {message}"
-                            send_encrypted(sock, from_msg)
-                            send_encrypted(target['socket'], to_msg)
-                        else:
-                            send_encrypted(sock, f"User '{to}' not found.")
-                    except Exception as e:
-                        send_encrypted(sock, "Format: /msg <nick> <message>")
-                        print(f"[!] /msg error: {e}")
-                    continue
+        log.warning(f"Rejected connection {addr}: client limit reached.", key='full')
+        return None
 
-                elif command == '/help':
-                    send_encrypted(sock, (
-                        "/nick <name>\n/prefix <prefix>\n/join <channel>\n"
-                        "/leave\n/who\n/list\n/msg <nick> <text>\n"
-                        "/version – server version"
-                        "\n=== Admin Commands ==="
-                        "\n/kick <nick> <reason>\n/banip <nick> <reason>\n/warn <nick>\n/plugin_reload – reload plugins"
-                        "\n/admins – list admins in your channel\n"
-                    ))
-                    continue
+    client['seen'] = time.monotonic()
+    registry.add(client)
+    if flood:
+        client['flood'] = flood.attach(addr[0])
+    if bus:
+        client['bus_id'] = bus.new_id()
+        bus_clients[client['bus_id']] = client
+        publish_client(client)
+    log.info(f"Connection from {addr}")
+    send_encrypted(sock, welcome_banner)
+    return client
+
+def handle_message(client, msg, channels):
+    # Returns False when the connection has to be closed.
+    sock = client['socket']
+    addr = client['addr']
+
+    if msg.startswith(COMPACT_MARK) and getattr(sock, 'compact', None):
+        try:
+            msg = decode_command(msg)
+        except ValueError:
+            send_encrypted(sock, "Unknown command. Type /help")
+            return True
+
+    if msg.startswith('/'):
+        parts = msg.strip().split(' ', 1)
+        command = parts[0]
+        args = parts[1] if len(parts) > 1 else ''
+
+        if command == CAPS_COMMAND:
+            # Compression/transport/compact protocol negotiation; the reply
+            # itself still goes out in the old format.
+            codecs = parse_caps(args) if config.get('compression', True) else []
+            reply = [CAPS_COMMAND] + codecs[:1]
+            sealer = None
+            if aead_cipher and aead_cipher in args.split():
+                # A key and counter of its own per direction and connection.
+                server_salt, session_salt = new_salt(), new_salt()
+                client['server_salt'], client['session_salt'] = server_salt, session_salt
+                sealer = Sealer(aead_cipher, derive_key(master_key(key), server_salt, b'server'))
+                sock.opener = Opener(aead_cipher, derive_key(master_key(key), session_salt, b'client'))
+                reply += [aead_cipher, server_salt.hex(), session_salt.hex()]
+            compact = COMPACT in args.split() and config.get('compact', True)
+            if compact:
+                reply.append(COMPACT)
+            heartbeat = HEARTBEAT in args.split() and PING_INTERVAL > 0
+            if heartbeat:
+                reply.append(HEARTBEAT)
+            send_encrypted(sock, ' '.join(reply))
+            sock.codec = codecs[0] if codecs else None
+            sock.sealer = sealer
+            sock.compact = CompactSession(compact_strings.generation) if compact else None
+            sock.heartbeat = heartbeat
+            return True
+
+        elif command == PING_COMMAND:
+            send_encrypted(sock, f"{PONG_COMMAND} {args}".rstrip())
+            return True
+
+        elif command == PONG_COMMAND:
+            # The token is the server's clock in ms when the ping went out.
+            try:
+                rtt = time.monotonic() - int(args) / 1000
+            except ValueError:
+                return True
+            if 0 <= rtt < PING_TIMEOUT + 60:
+                metrics.observe('privnet_ping_seconds', (), rtt)
+            return True
+
+        elif command == '/nick':
+            new_nick = args.strip()
+            if not new_nick:
+                send_encrypted(sock, "Usage: /nick <name>")
+                return True
+            if not is_valid_name(new_nick):
+                send_encrypted(sock, "Nick must contain only latin letters and numbers, 3-16 characters.")
+                return True
+            if bus:
+                # The hub hands out nicks; its answer may take a while.
+                blocking_call(client, lambda: set_nick(client, new_nick))
+            else:
+                set_nick(client, new_nick)
+            return True
+
+        elif command == '/prefix':
+            new_prefix = args.strip()
+            if not is_valid_name(new_prefix):
+                send_encrypted(sock, "Prefix must contain only latin letters and numbers, 3-16 characters.")
+                return True
+            client['prefix'] = new_prefix
+            publish_client(client)
+            send_encrypted(sock, f"Prefix set: {new_prefix}")
+            return True
+
+        elif command == '/join':
+            send_encrypted(sock, join_channel(client, args, channels))
+            publish_client(client)
+            return True
+
+        elif command == '/leave':
+            send_encrypted(sock, leave_channel(client, channels))
+            publish_client(client)
+            return True
+
+        elif command == '/who':
+            ch = client.get('channel')
+            if ch and ch in channels:
+                names = [c.get('nickname', '?') for c in channels[ch]]
+                send_encrypted(sock, f"Channel #{ch} members: {', '.join(names)}")
+            else:
+                send_encrypted(sock, "You're not in a channel.")
+            return True
 
-                elif command in ['/ahelp', '/kick', '/banip', '/warn', '/bans', '/unban', '/plugin_reload']:
-                    handle_admin_command(client, command, args, sock)
-                    if not client['active']:
-                        break
-                    continue
+        elif command == '/list':
+            send_encrypted(sock, "Channel list:\n" + "\n".join(channel_list_line(k) for k in channels))
+            return True
 
-                elif command == '/version':
-                    send_encrypted(sock, f"Server version: {SERVER_VERSION}")
-                    continue
+        elif command == '/topic':
+            ch = client.get('channel')
+            if not ch or ch not in channels:
+                send_encrypted(sock, "You're not in a channel.")
+                return True
+            topic = args.strip()
+            if not topic:
+                info = channel_store.get(ch)
+                send_encrypted(sock, f"Topic of #{ch}: {info.topic}" if info.topic else f"#{ch} has no topic.")
+                return True
+            if 'topiclock' in channel_store.get(ch).flags and not is_admin(addr[0], client.get('nickname', '')):
+                send_encrypted(sock, "Only admins can change the topic of this channel.")
+                return True
+            send_encrypted(sock, set_topic(ch, topic[:200]))
+            return True
+
+        elif command == '/msg':
+            try:
+                to, message = args.split(' ', 1)
+                target = find_client_by_nickname(to, clients)
+                if target:
+                    timestamp = time.strftime("[%H:%M]")
+                    from_msg = f"{timestamp} [You ➔ {to}]: {message}"
+                    to_msg = f"{timestamp} [{client['nickname']} ➔ You]: {message}"
+                    send_private(sock, True, to, message, from_msg)
+                    send_private(target['socket'], False, client['nickname'], message, to_msg)
+                else:
+                    send_encrypted(sock, f"User '{to}' not found.")
+            except Exception as e:
+                send_encrypted(sock, "Format: /msg <nick> <message>")
+                log.debug(f"/msg error: {e}")
+            return True
+
+        elif command == '/help':
+            send_encrypted(sock, (
+                "/nick <name>\n/prefix <prefix>\n/join <channel>\n"
+                "/leave\n/who\n/list\n/topic [text]\n/msg <nick> <text>\n"
+                "/version – server version"
+                "\n=== Admin Commands ==="
+                "\n/kick <nick> <reason>\n/banip <nick> <reason>\n/tempban <nick> <minutes> <reason>"
+                "\n/bansubnet <cidr> <minutes> <reason>\n/warn <nick>\n/plugin_reload – reload plugins\n/stats – server statistics"
+                "\n/admins – list admins in your channel\n"
+            ))
+            return True
+
+        elif command in ['/ahelp', '/kick', '/banip', '/tempban', '/bansubnet', '/warn', '/bans', '/unban', '/plugin_reload', '/stats']:
+            handle_admin_command(client, command, args, sock)
+            return client['active']
+
+        elif command == '/version':
+            send_encrypted(sock, f"Server version: {SERVER_VERSION}")
+            return True
+
+        elif command == '/admins':
+            ch = client.get('channel')
+            if not ch or ch not in channels:
+                send_encrypted(sock, "You're not in a channel.")
+                return True
+            admin_nicks = get_admins_in_channel(ch, channels)
+            if not admin_nicks:
+                send_encrypted(sock, "No admins in this channel.")
+            else:
+                admins_list = "\n".join([f"{i+1}. {name}" for i, name in enumerate(admin_nicks)])
+                send_encrypted(sock, f"Admins in channel #{ch}:\n{admins_list}")
+            return True
 
-                elif command == '/admins':
-                    ch = client.get('channel')
-                    if not ch or ch not in channels:
-                        send_encrypted(sock, "You're not in a channel.")
-                        continue
-                    admin_nicks = get_admins_in_channel(ch, channels)
-                    if not admin_nicks:
-                        send_encrypted(sock, "No admins in this channel.")
-                    else:
-                        admins_list = "\n".join([f"{i+1}. {name}" for i, name in enumerate(admin_nicks)])
-                        send_encrypted(sock, f"Admins in channel #{ch}:\n{admins_list}")
-                    continue
+        elif plugins.has_command(command):
+            plugins.run_command(command, client, args, lambda text: send_encrypted(sock, text))
+            return True
 
-                elif command in plugin_commands:
-                    plugin_commands[command](client, args, send_encrypted)
-                    continue
+        else:
+            send_encrypted(sock, "Unknown command. Type /help")
+            return True
+
+    if not client.get('nickname'):
+        send_encrypted(sock, "First set your nick with /nick <name>")
+        return True
+    if 'channel' not in client:
+        send_encrypted(sock, "You're not in a channel. Use /join <channel_name>")
+        return True
+
+    formatted = format_message(client, msg)
+    ch = client['channel']
+    prefix, nick = client.get('prefix', ''), client.get('nickname', '???')
+    if ECHO_MESSAGES:
+        log.info(parse_colors(formatted) if ECHO_COLORS else formatted, channel=ch, nick=nick)
+    publish({'t': 'chat', 'ch': ch, 'line': formatted, 'prefix': prefix, 'nick': nick, 'text': msg})
+    metrics.inc('privnet_channel_messages_in_total', (ch,))
+    metrics.inc('privnet_channel_bytes_in_total', (ch,), len(msg.encode()))
+    broadcast_channel(ch, formatted, prefix, nick, msg)
+    if plugins.wants('message'):
+        plugins.fire('message', MessageEvent(client, nick, ch, msg))
+    return True
+
+def command_label(msg):
+    # Histogram label for a message: built-in commands by name, everything
+    # else lumped together. Plugin commands are timed on the plugin pool.
+    if msg.startswith(COMPACT_MARK):
+        try:
+            msg = decode_command(msg)
+        except ValueError:
+            return 'unknown'
+    if not msg.startswith('/'):
+        return 'message'
+    command = msg.split(' ', 1)[0]
+    if command in COMMANDS:
+        return command
+    return None if plugins.has_command(command) else 'unknown'
+
+def timed_message(client, msg, channels):
+    if not metrics.enabled:
+        return handle_message(client, msg, channels)
+    start = time.perf_counter()
+    result = handle_message(client, msg, channels)
+    label = command_label(msg)
+    if label:
+        metrics.observe('privnet_command_seconds', (label,), time.perf_counter() - start)
+    return result
 
+def record_plugin_call(plugin, label, seconds):
+    metrics.observe('privnet_plugin_seconds', (plugin, label), seconds)
+    if label.startswith('/'):
+        metrics.observe('privnet_command_seconds', (label,), seconds)
+
+def broadcast_channel(ch, formatted, prefix, nick, msg):
+    # Members on other workers get the message from their own worker.
+    if ch and ch in channels:
+        frames = {}
+        compact_frames = {}
+        record = None
+        delivered = sent_bytes = 0
+        for other in channels[ch]:
+            if is_remote(other):
+                continue
+            try:
+                if getattr(other['socket'], 'compact', None):
+                    if record is None:
+                        generation, ids = compact_strings.intern(ch, prefix, nick)
+                        record = channel_record(*ids, msg)
+                        definitions = list(zip(ids, (ch, prefix, nick)))
+                    frame = send_compact(other['socket'], record, generation, definitions, compact_frames)
                 else:
-                    send_encrypted(sock, "Unknown command. Type /help")
+                    frame = cached_frame(frames, formatted, other['socket'])
+                    send_frame(other['socket'], frame)
+                delivered += 1
+                sent_bytes += len(frame[0]) + len(frame[1])
+            except Exception as e:
+                log.warning(f"Message send error: {e}", key='send')
+                try:
+                    other['socket'].close()
+                except Exception:
+                    pass
+                channels[ch].discard(other)
+        metrics.inc('privnet_channel_messages_out_total', (ch,), delivered)
+        metrics.inc('privnet_channel_bytes_out_total', (ch,), sent_bytes)
+
+def auto_warn(client, reason):
+    # Same escalation as an admin's /warn: WARN_LIMIT warnings ban the IP.
+    ip = client['addr'][0]
+    nick = client.get('nickname', '???')
+    set_warn_count(ip, warn_counts.get(ip, 0) + 1)
+    send_encrypted(client['socket'], f"Warning! {reason} ({warn_counts[ip]}/{WARN_LIMIT})")
+    broadcast_system_message(f"User {nick} was warned automatically for {reason} ({warn_counts[ip]}/{WARN_LIMIT})")
+    if warn_counts[ip] >= WARN_LIMIT:
+        ban_ip(ip, "Multiple warnings", nick)
+        send_encrypted(client['socket'], "You have been banned for multiple warnings.")
+        set_warn_count(ip, 0)
+        disconnect_client(client)
+        broadcast_system_message(f"IP address of user {nick} ({ip}) was blocked for exceeding warning limit.")
+
+def flood_control(client, msg):
+    # Returns whether to handle msg, and how long to pause reading from the
+    # client afterwards.
+    state = client.get('flood')
+    if state is None or is_admin(client['addr'][0], client.get('nickname', '')):
+        return True, 0
+    action, wait, limit = flood.check(state, msg.startswith(('/', COMPACT_MARK)), len(msg.encode()))
+    if action is None:
+        return True, 0
+    if action == DELAY:
+        return True, wait
+    now = time.monotonic()
+    if action == WARN and now - state.last_warn >= FLOOD_WARN_INTERVAL:
+        state.last_warn = now
+        auto_warn(client, f"flooding ({limit})")
+    elif now - state.last_notice >= 1:
+        state.last_notice = now
+        send_encrypted(client['socket'], f"Slow down! Message dropped (too many {limit}).")
+    return False, 0
+
+def release_client(client, channels):
+    try:
+        ch = client.get('channel')
+        registry.remove(client)
+        fire_leave(client, ch)
+        if client.get('flood'):
+            flood.detach(client['flood'])
+        if bus:
+            bus_clients.pop(client['bus_id'], None)
+            publish({'t': 'gone', 'id': client['bus_id']})
+    finally:
+        client['socket'].close()
+        log.info(f"Disconnection from {client['addr']}")
+
+def reap_client(client, reason, detail):
+    log.info(f"Closing {client['addr']}: {detail}")
+    metrics.inc('privnet_reaped_total', (reason,))
+    send_encrypted(client['socket'], f"Disconnected: {detail}.")
+    disconnect_client(client)
+
+def reap_clients():
+    # Pings clients that went quiet and closes the ones that stopped
+    # answering, so a client lost on a dead link frees its slot and stops
+    # getting channel broadcasts. Runs for both engines.
+    tick = min(5, max(0.5, min(t for t in (PING_INTERVAL, PING_TIMEOUT, IDLE_TIMEOUT) if t) / 6))
+    while True:
+        time.sleep(tick)
+        if restarts and restarts.active:
+            continue
+        now = time.monotonic()
+        for client in clients:
+            try:
+                if is_remote(client) or not client['active']:
                     continue
+                sock = client['socket']
+                silent = now - client['seen']
+                if IDLE_TIMEOUT and silent >= IDLE_TIMEOUT:
+                    reap_client(client, 'idle', f"idle for {silent:.0f} s")
+                elif sock.heartbeat and PING_TIMEOUT and silent >= PING_TIMEOUT:
+                    reap_client(client, 'ping_timeout', f"no reply for {silent:.0f} s")
+                elif (sock.heartbeat and PING_INTERVAL and silent >= PING_INTERVAL
+                      and now - client.get('pinged', 0) >= PING_INTERVAL):
+                    client['pinged'] = now
+                    send_encrypted(sock, f"{PING_COMMAND} {int(now * 1000)}")
+            except Exception as e:
+                log.exception(f"Reaper error: {e}", key='reaper')
+
+def send_queue_options():
+    return {
+        'max_frames': config.get('send_queue_size', 256),
+        'policy': config.get('send_queue_policy', outbound.DROP_OLDEST),
+        'timeout': config.get('send_queue_timeout', 5.0),
+        'coalesce': config.get('send_coalesce_ms', 5) / 1000,
+    }
 
-            if not client.get('nickname'):
-                send_encrypted(sock, "First set your nick with /nick <name>")
-                continue
-            if 'channel' not in client:
-                send_encrypted(sock, "You're not in a channel. Use /join <channel_name>")
-                continue
+def handle_client(sock, addr, channels, client=None, pending=b''):
+    # client/pending: a connection taken over from the previous server.
+    if client is None:
+        if TCP_KEEPALIVE:
+            set_keepalive(sock, TCP_KEEPALIVE)
+        client = accept_client(outbound.QueuedSocket(sock, **send_queue_options()), addr)
+        if client is None:
+            return
 
-            formatted = format_message(client, msg)
-            print(parse_colors(formatted))  # ← now colors will be in terminal!
-            ch = client['channel']
-            if ch and ch in channels:
-                # Protection against garbage in channel list:
-                for other in channels[ch][:]:
-                    try:
-                        if not isinstance(other, dict):
-                            print(f"[!] Invalid object in channel {ch}: {repr(other)}")
-                            channels[ch].remove(other)
-                            continue
-                        send_encrypted(other['socket'], formatted)
-                    except Exception as e:
-                        print(f"[!] Message send error: {e}")
-                        try:
-                            other['socket'].close()
-                        except Exception:
-                            pass
-                        channels[ch].remove(other)
+    reader = FrameReader(handoff.ParkingSocket(sock, restarts) if restarts else sock,
+                         config.get('max_frame_size', 65536))
+    reader.feed(pending)
+    client['reader'] = reader
+    try:
+        while client['active']:
+            msg = recv_encrypted(reader, client['socket'])
+            if not msg:
+                break
+            client['seen'] = time.monotonic()
+            handle, pause = flood_control(client, msg)
+            if handle and not timed_message(client, msg, channels):
+                break
+            # Frames already buffered need no syscall, so hand the GIL to
+            # the writer threads before handling the next one (and hold a
+            # flooding client back).
+            time.sleep(pause)
 
     except Exception as e:
-        print(f"[!] Client error {addr}: {e}")
-        traceback.print_exc()
+        log.exception(f"Client error {addr}: {e}", key='client')
+    finally:
+        release_client(client, channels)
+
+def handle_frame(client, data):
+    # asyncio engine: returns False to close, else seconds to pause reading.
+    try:
+        msg = decode_payload(data, client['socket'])
+    except Exception as e:
+        metrics.inc('privnet_receive_errors_total')
+        log.warning(f"Receive error: {e}", key='receive')
+        return False
+    if not msg:
+        return False
+    client['seen'] = time.monotonic()
+    handle, pause = flood_control(client, msg)
+    if handle and not timed_message(client, msg, channels):
+        return False
+    return pause
+
+# === Restart ===
+
+def client_state(client, pending, frames):
+    sock = client['socket']
+    compact = None
+    if sock.compact:
+        # The new server has a string table of its own: the client is told
+        # to forget the ids (D=) before the first record it sends. The clock
+        # may have gone with dropped frames.
+        compact = {'clock': None if sock.compact.dropped != sock.dropped else sock.compact.clock}
+    return {'addr': list(client['addr']), 'nickname': client.get('nickname'), 'prefix': client.get('prefix'),
+            'channel': client.get('channel'), 'nick_since': client.get('nick_since'),
+            'codec': sock.codec, 'transport': sock.sealer.cipher if sock.sealer else None,
+            'server_salt': client['server_salt'].hex() if sock.sealer else None,
+            'session_salt': client['session_salt'].hex() if sock.sealer else None,
+            'counter': sock.sealer.counter if sock.sealer else 0,
+            'opener': [sock.opener.highest, sock.opener.seen] if sock.sealer else None,
+            'compact': compact, 'heartbeat': sock.heartbeat,
+            'pending': handoff.encode_bytes(pending), 'frames': [handoff.encode_bytes(f) for f in frames]}
+
+def adopt_client(sock, state):
+    # A connection the previous server handed over: same nick, channel and
+    # protocol state; no welcome, no join event. Its queued frames go first.
+    for frame in state['frames']:
+        sock.sendall(handoff.decode_bytes(frame))
+    client = registry.new_client(sock, tuple(state['addr']))
+    client['seen'] = time.monotonic()
+    if state['nickname'] and registry.claim_nick(client, state['nickname']):
+        client['nick_since'] = state['nick_since']
+    if state['prefix'] is not None:
+        client['prefix'] = state['prefix']
+    sock.codec = state['codec']
+    if state['transport']:
+        client['server_salt'] = bytes.fromhex(state['server_salt'])
+        client['session_salt'] = bytes.fromhex(state['session_salt'])
+        # The client rejects counters it has seen; stay clear of frames
+        # sealed after the old server reported the counter.
+        sock.sealer = Sealer(state['transport'], derive_key(master_key(key), client['server_salt'], b'server'))
+        sock.sealer.counter = state['counter'] + handoff.COUNTER_MARGIN
+        sock.opener = Opener(state['transport'], derive_key(master_key(key), client['session_salt'], b'client'))
+        sock.opener.highest, sock.opener.seen = state['opener']
+    if state['compact']:
+        sock.compact = CompactSession()
+        sock.compact.clock = state['compact']['clock']
+    sock.heartbeat = state['heartbeat']
+    registry.add(client)
+    if state['channel'] and state['channel'] not in channels:
+        # Missing from channels.db: bring it back rather than leave the
+        # client connected but in no channel.
+        log.warning(f"Channel #{state['channel']} of {client['addr']} wasn't saved; created it again")
+        create_channel(state['channel'], channels)
+    with channel_lock:
+        if state['channel'] in channels:
+            client['channel'] = state['channel']
+            channels[state['channel']].append(client)
+    if flood:
+        client['flood'] = flood.attach(client['addr'][0])
+    return client
+
+def park_clients(deadline):
+    # Returns the listening socket and (client, pending bytes, queued frames)
+    # for every connection stopped in time.
+    if config.get('engine', 'threaded') == 'asyncio':
+        listen, parked = asyncio_call(aio_engine.park(max(0, deadline - time.monotonic())))
+        return listen, [(c, *parked[c['socket']]) for c in clients if c['socket'] in parked]
+    local = [c for c in clients if 'reader' in c]
+    parked = set(restarts.wait_parked([listener] + [c['reader'].sock for c in local], RESTART_TIMEOUT))
+    if listener not in parked:
+        raise RuntimeError("the accept loop didn't stop")
+    handed = []
+    for c in local:
+        if c['reader'].sock in parked:
+            frames = c['socket'].hold(max(0, deadline - time.monotonic()))
+            if frames is not None:
+                handed.append((c, c['reader'].buffered(), frames))
+    return listener.sock, handed
+
+def resume_clients(listen):
+    if config.get('engine', 'threaded') == 'asyncio':
+        asyncio_call(aio_engine.resume(listen))
+    else:
+        for c in clients:
+            if not is_remote(c):
+                c['socket'].release()
+    restarts.resume()
+
+def asyncio_call(coroutine):
+    return aio_engine.asyncio.run_coroutine_threadsafe(coroutine, aio_engine.loop).result()
+
+def restart_server():
+    # Console /restart: a new server process takes over the listening socket
+    # and every connection (see handoff.py). Returns only if it failed.
+    if restarts is None:
+        return "Restart needs workers = 1, no server links and a platform that can pass sockets (Linux, macOS)."
+    # The new process loads channels.db first: it must hold every change,
+    # and no more may come until the hand-over is done or has failed.
+    channel_store.freeze()
+    try:
+        channel_store.flush()
+        return hand_over()
+    except sqlite3.Error as e:
+        return f"Can't save channels ({e}); still running."
+    finally:
+        channel_store.thaw()
+
+def hand_over():
+    path = config.get('handoff_socket', 'privnet-handoff.sock')
+    server = handoff.listen(path)
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--takeover', path])
+    try:
+        conn = handoff.wait_for(server, proc, RESTART_TIMEOUT)
+        if conn is None:
+            proc.kill()
+            return "The new server didn't start; still running."
+        deadline = time.monotonic() + RESTART_TIMEOUT
+        restarts.start()
+        listen = None
+        try:
+            listen, handed = park_clients(deadline)
+            state = {'version': SERVER_VERSION, 'encryption': bool(fernet)}
+            handoff.send_state(conn, state, listen.fileno(),
+                               [(c['socket'].fileno(), client_state(c, pending, frames)) for c, pending, frames in handed])
+        except Exception as e:
+            log.exception(f"Restart failed: {e}")
+            proc.kill()
+            resume_clients(listen)
+            return f"Restart failed ({e}); still running."
     finally:
+        server.close()
+        os.unlink(path)
+    left = len(clients) - len(handed)
+    log.info(f"Handed {len(handed)} clients over to the new server (pid {proc.pid})")
+    if left:
+        log.warning(f"{left} clients couldn't be handed over and are disconnected")
+    log.flush()
+    handoff.become_waiter(proc.pid)
+
+def take_over(path):
+    # New process of a /restart: returns the previous server's listening
+    # socket and [(socket, client state, pending bytes)]. Adopted connections
+    # keep their AEAD keys and compact sessions (adopt_client).
+    conn, state, listen, adopted = handoff.receive_state(path)
+    if state['encryption'] != bool(fernet):
+        print("Error: can't take over, encryption differs from the running server.")
+        exit(1)
+    handoff.accept_state(conn)
+    log.info(f"Took over {len(adopted)} clients from server {state['version']}")
+    return listen, [(sock, client, handoff.decode_bytes(client['pending'])) for sock, client in adopted]
+
+# === Multi-process bus ===
+
+def publish(event):
+    if bus:
+        bus.send(event)
+
+def is_remote(client):
+    return isinstance(client['socket'], RemoteSocket)
+
+def local_count():
+    return sum(1 for c in clients if not is_remote(c))
+
+def publish_client(client):
+    if bus:
+        bus.send({'t': 'client', 'id': client['bus_id'], 'addr': list(client['addr']),
+                  'nick': client.get('nickname'), 'prefix': client.get('prefix', ''),
+                  'channel': client.get('channel'), 'since': client.get('nick_since', 0)})
+
+def publish_channel(name):
+    # Other workers reload the channel from channels.db.
+    if bus:
+        channel_store.flush()
+        bus.send({'t': 'channel', 'name': name})
+
+def mirror_client(event):
+    client = bus_clients.get(event['id'])
+    if client is None:
+        addr = tuple(event['addr'])
+        client = registry.new_client(RemoteSocket(bus, event['id'], addr), addr)
+        client['bus_id'] = event['id']
+        bus_clients[event['id']] = client
+        registry.add(client)
+    if event['nick'] != client.get('nickname'):
+        if event['nick']:
+            client['nickname'] = event['nick']
+        else:
+            client.pop('nickname', None)
+    client['prefix'] = event['prefix']
+    if event['channel'] != client.get('channel'):
         with channel_lock:
-            ch = client.get('channel')
-            if ch and ch in channels and client in channels[ch]:
-                channels[ch].remove(client)
-        if client in clients:
-            clients.remove(client)
-        sock.close()
-        print(f"[-] Disconnection from {addr}")
+            registry.part(client)
+            if event['channel'] in channels:
+                client['channel'] = event['channel']
+                channels[event['channel']].append(client)
+
+def set_nick(client, nick):
+    sock = client['socket']
+    if bus and not bus.claim_nick(client['bus_id'], nick):
+        send_encrypted(sock, "Nick is already in use.")
+        return
+    if not registry.claim_nick(client, nick):
+        publish_client(client)
+        send_encrypted(sock, "Nick is already in use.")
+        return
+    admin_info = is_admin(client['addr'][0], nick)
+    if admin_info:
+        client['prefix'] = admin_info['prefix']
+    else:
+        client['prefix'] = ''
+    client['nick_since'] = time.time()
+    publish_client(client)
+    send_encrypted(sock, f"Nick set: {nick}")
+
+def blocking_call(client, call):
+    # The asyncio engine runs it on a thread, so the event loop (every other
+    # connection) doesn't wait with it; this connection's next frame does.
+    if isinstance(client['socket'], aio_engine.StreamSocket):
+        client['socket'].defer(call)
+    else:
+        call()
+
+def rename_collided(client):
+    # A client on a linked server had the nick first.
+    old = client.get('nickname')
+    while True:
+        nick = f"Guest{random.randint(1000, 99999)}"
+        if bus.claim_nick(client['bus_id'], nick) and registry.claim_nick(client, nick):
+            break
+    admin_info = is_admin(client['addr'][0], nick)
+    client['prefix'] = admin_info['prefix'] if admin_info else ''
+    client['nick_since'] = time.time()
+    publish_client(client)
+    send_encrypted(client['socket'], f"Nick {old} is taken on a linked server, your nick is now {nick}.")
+
+def on_bus_event(event):
+    kind = event['t']
+    if kind == 'client':
+        mirror_client(event)
+    elif kind == 'gone':
+        client = bus_clients.pop(event['id'], None)
+        if client:
+            client['active'] = False
+            registry.remove(client)
+    elif kind == 'chat':
+        broadcast_channel(event['ch'], event['line'], event['prefix'], event['nick'], event['text'])
+    elif kind == 'system':
+        broadcast_system_message(event['text'], relay=False)
+    elif kind in ('send', 'private', 'close', 'collide'):
+        client = bus_clients.get(event['to'])
+        if client is None or is_remote(client):
+            return
+        if kind == 'send':
+            send_encrypted(client['socket'], event['text'])
+        elif kind == 'private':
+            send_private(client['socket'], event['outgoing'], event['nick'], event['text'], event['line'])
+        elif kind == 'collide':
+            # Claiming a new nick waits for the hub, whose reply this thread reads.
+            threading.Thread(target=rename_collided, args=(client,), daemon=True).start()
+        else:
+            disconnect_client(client)
+    elif kind == 'ban':
+        banned_ips.add(event['entry'])
+    elif kind == 'unban':
+        for entry in banned_ips:
+            if entry.get('id') == event['id']:
+                banned_ips.remove(entry)
+    elif kind == 'warns':
+        if event['count']:
+            warn_counts[event['ip']] = event['count']
+        else:
+            warn_counts.pop(event['ip'], None)
+    elif kind == 'channel':
+        if channel_store.reload(event['name']):
+            channels.setdefault(event['name'], MemberSet())
+        else:
+            drop_channel(event['name'])
+    elif kind == 'plugins':
+        plugins.reload(plugin_names)
+    elif kind == 'report':
+        print(worker_report(event['what']))
+
+def on_bus_lost():
+    log.error(f"Worker {worker_id} lost the bus, shutting down.")
+    channel_store.flush()
+    log.flush()
+    os._exit(1)
+
+def start_bus():
+    global bus, link_manager
+    path = config.get('bus_socket', 'privnet-bus.sock')
+    queue_size = config.get('bus_queue_size', 65536)
+    if worker_id == 0:
+        BusHub(path, queue_size)
+        supervise_workers(WORKERS, [sys.executable, os.path.abspath(__file__)])
+    bus = BusClient(path, worker_id, on_bus_event, on_bus_lost, queue_size)
+    log.info(f"Worker {worker_id} (pid {os.getpid()}) joined the bus")
+    if LINK and worker_id == 0:
+        with open(LINK['key_path'], 'rb') as f:
+            link_manager = LinkManager(LINK['name'], f.read(), path, channel_store, queue_size)
+        if LINK.get('port'):
+            link_manager.listen(LINK.get('ip', config['ip']), LINK['port'])
+        for peer in LINK.get('peers', []):
+            link_to(peer)
+
+def link_to(peer):
+    host, _, port = peer.rpartition(':')
+    if not host or not port.isdigit():
+        return "Usage: /link <host:port>"
+    link_manager.keep_linked(host, int(port), LINK.get('retry', 10))
+    return f"Linking to {host}:{port}."
+
+def get_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return None
+
+def memory_report():
+    engine = config.get('engine', 'threaded')
+    rss = get_rss_mb()
+    connections = local_count()
+    if not rss:
+        return f"Engine: {engine} | connections: {connections} | RSS unknown on this platform"
+    return (f"Engine: {engine} | connections: {connections} | threads: {threading.active_count()} | "
+            f"RSS: {rss:.1f} MB | {connections / rss:.2f} connections/MB")
+
+def queue_report(limit=10):
+    with outbound.stats_lock:
+        totals = dict(outbound.stats)
+        batches = sorted(outbound.stats['batches'].items())
+    lines = [f"Dropped frames: {totals['dropped_frames']} | overflow disconnects: {totals['overflow_disconnects']}"]
+    if config.get('engine', 'threaded') == 'asyncio':
+        per_drain = totals['frames_drained'] / totals['drains'] if totals['drains'] else 0
+        lines.append(f"Frames handed to the transport: {totals['frames_drained']} in {totals['drains']} drains "
+                     f"({per_drain:.2f} frames/drain)")
+    else:
+        per_write = totals['frames_written'] / totals['writes'] if totals['writes'] else 0
+        lines.append(f"Frames written: {totals['frames_written']} in {totals['writes']} writes ({per_write:.2f} frames/syscall)")
+    if batches:
+        lines.append("Batch sizes: " + ", ".join(f"{size}+: {count}" for size, count in batches))
+    queued = [c for c in clients if isinstance(c.get('socket'), outbound.OutboundQueue)]
+    queued.sort(key=lambda c: (c['socket'].depth(), c['socket'].dropped), reverse=True)
+    for c in queued[:limit]:
+        q = c['socket']
+        lines.append(f"{c.get('nickname', '???')} {c['addr'][0]} | depth {q.depth()}/{q.max_frames} "
+                     f"(peak {q.peak}) | sent {q.sent} | dropped {q.dropped}")
+    return "\n".join(lines)
+
+def flood_report(limit=10):
+    if not flood:
+        return "Flood control is disabled."
+    with flood.lock:
+        totals = sorted(flood.totals.items())
+        throttled = [(c, dict(c['flood'].counts)) for c in clients if c.get('flood') and c['flood'].counts]
+    lines = ["Throttled: " + (", ".join(f"{name} {action} {count}" for (name, action), count in totals) or "nobody")]
+    throttled.sort(key=lambda item: sum(item[1].values()), reverse=True)
+    for c, counts in throttled[:limit]:
+        lines.append(f"{c.get('nickname', '???')} {c['addr'][0]} | "
+                     + ", ".join(f"{name} {action} {count}" for (name, action), count in sorted(counts.items())))
+    return "\n".join(lines)
+
+def metric_gauges():
+    local = [c for c in clients if not is_remote(c)]
+    depths = [c['socket'].depth() for c in local if isinstance(c.get('socket'), outbound.OutboundQueue)]
+    rows = [('privnet_connections', (), len(local)),
+            ('privnet_send_queue_frames', (), sum(depths)),
+            ('privnet_send_queue_max_frames', (), max(depths, default=0)),
+            ('privnet_dropped_frames_total', (), outbound.stats['dropped_frames']),
+            ('privnet_plugin_calls_pending', (), plugins.pending),
+            ('privnet_plugin_calls_rejected_total', (), plugins.rejected)]
+    if flood:
+        with flood.lock:
+            rows += [('privnet_flood_throttled_total', key, count) for key, count in flood.totals.items()]
+    return rows
+
+def format_seconds(seconds):
+    return f"{seconds * 1000:.2f} ms" if seconds != float('inf') else "> 10 s"
+
+def format_rate(name, labels=()):
+    rate = metrics.rate(name, labels)
+    return f"{rate / 1024:.1f} KB/s" if rate >= 1024 else f"{rate:.0f} B/s"
+
+def latency_line(title, histograms, limit=12):
+    busiest = sorted(histograms.items(), key=lambda item: item[1].count, reverse=True)[:limit]
+    if not busiest:
+        return f"{title}: none yet"
+    return f"{title}: " + ", ".join(
+        f"{' '.join(labels + (str(h.count),))} (p50 {format_seconds(h.quantile(0.5))}, "
+        f"p99 {format_seconds(h.quantile(0.99))})" for labels, h in busiest)
+
+def stats_report():
+    if not metrics.enabled:
+        return "Metrics are disabled."
+    gauges = metrics.gauges()
+    lines = [
+        f"Connections: {gauges[('privnet_connections', ())]} | "
+        f"in {metrics.rate('privnet_frames_in_total'):.1f} frames/s, {format_rate('privnet_bytes_in_total')} | "
+        f"out {metrics.rate('privnet_frames_out_total'):.1f} frames/s, {format_rate('privnet_bytes_out_total')}",
+        f"Errors: send {metrics.value('privnet_send_errors_total')} | "
+        f"receive {metrics.value('privnet_receive_errors_total')} | "
+        f"dropped frames {gauges[('privnet_dropped_frames_total', ())]}",
+        f"Send queues: {gauges[('privnet_send_queue_frames', ())]} frames queued, "
+        f"longest {gauges[('privnet_send_queue_max_frames', ())]}",
+    ]
+    for name in sorted(set(metrics.by_label('privnet_channel_messages_in_total'))
+                       | set(metrics.by_label('privnet_channel_messages_out_total'))):
+        lines.append(f"#{name[0]} | in {metrics.rate('privnet_channel_messages_in_total', name):.1f} msg/s, "
+                     f"{format_rate('privnet_channel_bytes_in_total', name)} | "
+                     f"out {metrics.rate('privnet_channel_messages_out_total', name):.1f} msg/s, "
+                     f"{format_rate('privnet_channel_bytes_out_total', name)}")
+    lines.append(latency_line("Encrypt", metrics.histogram('privnet_encrypt_seconds')))
+    lines.append(latency_line("Decrypt", metrics.histogram('privnet_decrypt_seconds')))
+    lines.append(latency_line("Commands", metrics.histogram('privnet_command_seconds')))
+    plugin_calls = metrics.histogram('privnet_plugin_seconds')
+    if plugin_calls:
+        lines.append(latency_line("Plugins", plugin_calls))
+    pings = metrics.histogram('privnet_ping_seconds')
+    reaped = metrics.by_label('privnet_reaped_total')
+    if pings or reaped:
+        lines.append(latency_line("Pings", pings) + " | closed: " +
+                     (", ".join(f"{reason[0]} {count}" for reason, count in sorted(reaped.items())) or "none"))
+    throttled = [(key, count) for (name, key), count in gauges.items() if name == 'privnet_flood_throttled_total']
+    if throttled:
+        lines.append("Flood control: " + ", ".join(f"{limit} {action} {count}" for (limit, action), count in sorted(throttled)))
+    lines.append(f"(rates over the last {metrics.interval:g} s)")
+    return "\n".join(lines)
+
+REPORTS = {'/mem': memory_report, '/queues': queue_report, '/flood': flood_report, '/plugins': plugins.report,
+           '/stats': stats_report}
+
+def worker_report(cmd):
+    report = REPORTS[cmd]()
+    return f"[worker {worker_id}] {report}" if bus else report
 
 def admin_console(channels):
     while True:
@@ -639,28 +1521,115 @@ def admin_console(channels):
         elif cmd.startswith("/delete "):
             print(delete_channel(cmd[8:], channels))
         elif cmd == "/list":
-            print("Channels:\n" + "\n".join(f"#{c}" for c in channels))
+            print("Channels:\n" + "\n".join(channel_list_line(c) for c in channels))
+        elif cmd.startswith("/topic "):
+            name, _, topic = cmd[7:].partition(' ')
+            print(set_topic(name, topic.strip()) if name in channels else f"Channel #{name} not found.")
+        elif cmd.startswith("/flag "):
+            name, _, change = cmd[6:].partition(' ')
+            print(set_channel_flag(name, change.strip()) if name in channels else f"Channel #{name} not found.")
+        elif cmd.startswith("/info "):
+            name = cmd[6:].strip()
+            print(channel_info(name) if name in channels else f"Channel #{name} not found.")
+        elif cmd == "/plugin_reload":
+            plugins.reload(plugin_names, lambda: print("Plugins reloaded."))
+            publish({'t': 'plugins'})
+        elif cmd in REPORTS:
+            print(worker_report(cmd))
+            publish({'t': 'report', 'what': cmd})
+        elif cmd == "/links":
+            print(link_manager.report() if link_manager else "Server links are not configured.")
+        elif cmd.startswith("/link "):
+            print(link_to(cmd[6:].strip()) if link_manager else "Server links are not configured.")
+        elif cmd == "/restart":
+            print("Restarting server...")
+            print(restart_server())
         elif cmd == "/exit":
             print("Shutting down server.")
+            channel_store.flush()
+            log.flush()
             os._exit(0)
         else:
-            print("Commands: /create /delete /list /exit")
+            print("Commands: /create /delete /list /topic /flag /info /stats /mem /queues /flood /plugins /plugin_reload /links /link /restart /exit")
 
 def start_server():
-    init_db()
-    global channels
-    channels = load_channels()
-    sock = socket.socket()
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind((config['ip'], config['port']))
-    sock.listen(5)
-    print(f"Server started on {config['ip']}:{config['port']}")
-    load_plugins()
-
-    threading.Thread(target=admin_console, args=(channels,), daemon=True).start()
+    if config.get('send_queue_policy', outbound.DROP_OLDEST) not in outbound.POLICIES:
+        print(f"Error: send_queue_policy must be one of: {', '.join(outbound.POLICIES)}.")
+        exit(1)
+    if config.get('transport', 'fernet') not in ('fernet',) + tuple(CIPHERS):
+        print(f"Error: transport must be one of: fernet, {', '.join(CIPHERS)}.")
+        exit(1)
+    if WORKERS > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        print("Error: workers > 1 needs SO_REUSEPORT, which this platform doesn't have.")
+        exit(1)
+    if LINK and (not LINK.get('name') or '/' in LINK['name']):
+        print("Error: link.name must be set and can't contain '/'.")
+        exit(1)
+    if LINK and not os.path.exists(LINK.get('key_path', '')):
+        print("Error: link.key_path not found (make one with keygen.py and copy it to every linked server).")
+        exit(1)
+    channels.update(load_channels())
+    listen, adopted = None, []
+    if '--takeover' in sys.argv:
+        load_plugins()
+        listen, adopted = take_over(sys.argv[sys.argv.index('--takeover') + 1])
+    if WORKERS > 1 or LINK:
+        start_bus()
+    metrics.collect(metric_gauges)
+    if PING_INTERVAL or PING_TIMEOUT or IDLE_TIMEOUT:
+        threading.Thread(target=reap_clients, daemon=True).start()
+    if metrics.enabled and config.get('metrics_port'):
+        # One endpoint per worker, on consecutive ports.
+        metrics.serve(config['metrics_port'] + worker_id)
+
+    if config.get('engine', 'threaded') == 'asyncio':
+        if listen is None:
+            load_plugins()
+        if worker_id == 0:
+            threading.Thread(target=admin_console, args=(channels,), daemon=True).start()
+        aio_engine.run(config['ip'], config['port'], accept_client, handle_frame,
+                       lambda client: release_client(client, channels),
+                       backlog=config.get('listen_backlog', 128),
+                       queue_options=send_queue_options(),
+                       max_frame=config.get('max_frame_size', 65536),
+                       reuse_port=WORKERS > 1,
+                       keepalive=TCP_KEEPALIVE,
+                       listen_sock=listen,
+                       adopted=adopted,
+                       on_adopt=adopt_client)
+        return
 
+    global listener
+    if listen is None:
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if WORKERS > 1:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((config['ip'], config['port']))
+        sock.listen(config.get('listen_backlog', 128))
+        log.info(f"Server started on {config['ip']}:{config['port']}")
+        load_plugins()
+    else:
+        sock = listen
+    # Every connection is back in its channel before any of them is read.
+    restored = []
+    for client_sock, state, pending in adopted:
+        client_sock.setblocking(True)
+        restored.append((client_sock, adopt_client(outbound.QueuedSocket(client_sock, **send_queue_options()), state),
+                         pending))
+    for client_sock, client, pending in restored:
+        threading.Thread(target=handle_client, args=(client_sock, client['addr'], channels, client, pending),
+                         daemon=True).start()
+
+    if worker_id == 0:
+        threading.Thread(target=admin_console, args=(channels,), daemon=True).start()
+
+    # The file status (blocking or not) is shared with the server this one
+    # took the socket from, so it is always set here.
+    sock.setblocking(not restarts)
+    listener = handoff.ParkingSocket(sock, restarts) if restarts else sock
     while True:
-        client_sock, addr = sock.accept()
+        client_sock, addr = listener.accept()
         threading.Thread(target=handle_client, args=(client_sock, addr, channels), daemon=True).start()
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from colors import parse_colors
+
+# Checks that colors.parse_colors produces exactly the output of the old
+# char-by-char implementation (fixed cases plus random fuzzing), then
+# compares their throughput.
+#
+#   python3 tools/bench_colors.py
+
+def reference_parse_colors(text):
+    mc_color_map = {
+        '0': '\033[30m', '1': '\033[34m', '2': '\033[32m', '3': '\033[36m',
+        '4': '\033[31m', '5': '\033[35m', '6': '\033[33m', '7': '\033[37m',
+        '8': '\033[90m', '9': '\033[94m', 'a': '\033[92m', 'b': '\033[96m',
+        'c': '\033[91m', 'd': '\033[95m', 'e': '\033[93m', 'f': '\033[97m',
+    }
+    mc_style_map = {
+        'l': '\033[1m', 'o': '\033[3m', 'n': '\033[4m', 'm': '\033[9m',
+    }
+
+    i = 0
+    result = ''
+    while i < len(text):
+        if text[i] == '&' and i + 1 < len(text):
+            code = text[i+1].lower()
+            if code == 'r':
+                result += '\033[0m'
+                i += 2
+                continue
+            elif code in mc_color_map:
+                result += mc_color_map[code]
+                i += 2
+                continue
+            elif code in mc_style_map:
+                result += mc_style_map[code]
+                i += 2
+                continue
+        result += text[i]
+        i += 1
+    result += '\033[0m'
+    return result
+
+CASES = [
+    "", "&", "&&", "&&a", "a&", "&r", "&R", "&x", "&g", "&G", "&K", "&K", "&İ",
+    "&2Welcome to PrivNet! Write /nick <name> and /join <channel>.",
+    "[12:00] [&2#general&r] [&c&lOWNER&r]  &9DyadaMorgan&r: Hello &&&& &l&o&n&m&F&A",
+    "no codes at all", "trailing &", "&0&1&2&3&4&5&6&7&8&9&a&b&c&d&e&f&l&o&n&m&r",
+    "юнікод &aтекст &Zне код", "\033[31malready ansi&r",
+]
+
+def fuzz_cases(count, seed=1):
+    rnd = random.Random(seed)
+    alphabet = "&&&&abcdefgklmnoprxzABCDEFKLMNORZ0123456789 #[]:Kİé"
+    for _ in range(count):
+        yield ''.join(rnd.choice(alphabet) for _ in range(rnd.randrange(0, 40)))
+
+def check_equivalence(fuzz):
+    failures = 0
+    for text in list(CASES) + list(fuzz_cases(fuzz)):
+        expected = reference_parse_colors(text)
+        actual = parse_colors(text)
+        if actual != expected:
+            failures += 1
+            print(f"MISMATCH for {text!r}: expected {expected!r}, got {actual!r}")
+    return failures
+
+def rate(fn, texts, seconds):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for text in texts:
+            fn(text)
+        count += len(texts)
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Equivalence check and throughput of the colour renderer.")
+    parser.add_argument('--fuzz', type=int, default=20000)
+    parser.add_argument('--seconds', type=float, default=1.0)
+    args = parser.parse_args()
+
+    failures = check_equivalence(args.fuzz)
+    if failures:
+        print(f"{failures} mismatches.")
+        sys.exit(1)
+    print(f"Equivalence: OK ({len(CASES) + args.fuzz} inputs)")
+
+    unique = [f"[12:00] [&2#general&r]  &9user{i}&r: message number {i} with some &ccolour&r" for i in range(5000)]
+    long_text = [f"&2line {i} " + "long line with &lbold&r text " * 150 for i in range(2000)]
+    repeated = [CASES[13]] * 100
+    for label, texts in (("unique chat lines", unique), ("unique 4 KB lines", long_text), ("repeated banner", repeated)):
+        old = rate(reference_parse_colors, texts, args.seconds)
+        parse_colors.cache_clear()
+        new = rate(parse_colors, texts, args.seconds)
+        print(f"{label:>18}: old {old:>10.0f}/s | new {new:>10.0f}/s | {new / old:.1f}x")
+
+if __name__ == '__main__':
+    main()
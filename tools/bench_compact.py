@@ -0,0 +1,117 @@
+import argparse
+import os
+import random
+import shutil
+import threading
+
+from cryptography.fernet import Fernet
+from bench_compression import WORDS
+from bench_engines import launch, make_server_dir
+from headless import HeadlessClient
+
+# Link capture: one listener per protocol mode sits in the same channel of a
+# real server while a few talkers chat. Every frame each listener receives
+# (and every command it sends) is counted, so the modes can be compared on
+# identical traffic. The lines the listeners rebuild must match the plain
+# text listener exactly (talkers interleave, so order is not compared).
+#
+#   python3 tools/bench_compact.py --messages 500
+
+MODES = [
+    ("fernet, text", []),
+    ("fernet, deflate", ['deflate']),
+    ("fernet, compact", ['compact']),
+    ("fernet, compact + deflate", ['compact', 'deflate']),
+    ("aesgcm, text", ['aesgcm']),
+    ("aesgcm, compact + deflate", ['aesgcm', 'compact', 'deflate']),
+]
+COMMANDS = ['/who', '/list', '/version', '/topic', '/msg talker0 ping', '/help']
+
+def join(client, nick, prefix=None):
+    client.recv()
+    client.send(f'/nick {nick}')
+    client.recv()
+    if prefix:
+        client.send(f'/prefix {prefix}')
+        client.recv()
+    client.send('/join main')
+    client.recv()
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes on the link per message for each protocol mode.")
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--talkers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=25261)
+    args = parser.parse_args()
+
+    key = Fernet.generate_key()
+    workdir = make_server_dir('threaded', args.port, 64, {
+        "encryption": True, "key_path": "secret.key", "transport": "aesgcm", "compression": True, "compact": True,
+        "send_queue_size": args.messages * 2 + 64,
+        "flood_control": {"enabled": False},
+    })
+    with open(os.path.join(workdir, 'secret.key'), 'wb') as f:
+        f.write(key)
+    proc = launch(workdir, args.port)
+    try:
+        proc.stdin.write(b"/create main\n")
+        proc.stdin.flush()
+        listeners = []
+        for i, (label, offer) in enumerate(MODES):
+            c = HeadlessClient('127.0.0.1', args.port, key)
+            c.recv()
+            c.negotiate(offer)
+            c.send(f'/nick listener{i}')
+            c.recv()
+            c.send('/join main')
+            c.recv()
+            listeners.append(c)
+        talkers = []
+        for i in range(args.talkers):
+            t = HeadlessClient('127.0.0.1', args.port, key)
+            join(t, f'talker{i}', 'VIP' if i == 0 else None)
+            talkers.append(t)
+
+        # Commands: what each mode costs to ask and to get answered.
+        commands = []
+        for c in listeners:
+            before_in, before_out = c.bytes_in, c.bytes_out
+            for command in COMMANDS:
+                c.send(command)
+                c.recv()
+            commands.append((c.bytes_out - before_out, c.bytes_in - before_in))
+        talkers[0].recv()  # the /msg pings
+        for _ in listeners[1:]:
+            talkers[0].recv()
+
+        received = [[] for _ in listeners]
+        start = [c.bytes_in for c in listeners]
+
+        def listen(i):
+            for _ in range(args.messages):
+                received[i].append(listeners[i].recv())
+
+        threads = [threading.Thread(target=listen, args=(i,)) for i in range(len(listeners))]
+        for t in threads:
+            t.start()
+        rnd = random.Random(1)
+        for n in range(args.messages):
+            talkers[n % len(talkers)].send(' '.join(rnd.choice(WORDS) for _ in range(rnd.randrange(1, 16))))
+        for t in threads:
+            t.join(60)
+
+        baseline = (listeners[0].bytes_in - start[0]) / args.messages
+        print(f"{args.messages} channel messages from {args.talkers} talkers, {len(COMMANDS)} commands per mode")
+        for i, (label, _) in enumerate(MODES):
+            per_message = (listeners[i].bytes_in - start[i]) / args.messages
+            sent, got = commands[i]
+            same = "OK" if sorted(received[i]) == sorted(received[0]) else "MISMATCH"
+            print(f"{label:>26}: {per_message:6.1f} bytes/message ({per_message / baseline * 100:5.1f}%) | "
+                  f"commands {sent:5} up / {got:6} down bytes | lines {same}")
+    finally:
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
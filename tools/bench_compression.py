@@ -0,0 +1,79 @@
+import argparse
+import os
+import random
+import sys
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cryptography.fernet import Fernet
+from protocol.compression import compress_payload, decompress_payload
+from protocol.framing import HEADER_SIZE
+
+# Bytes on the wire per message (4-byte header included) for a sample of
+# typical server traffic, before and after negotiated compression, with and
+# without Fernet, plus the airtime that makes on a 10 kbps link.
+#
+#   python3 tools/bench_compression.py --messages 2000
+
+NICKS = ['DyadaMorgan', 'alice', 'bob42', 'radioman', 'meshnode7', 'carol']
+CHANNELS = ['general', 'main', 'mesh', 'radio']
+WORDS = ("the a to and is it you that of in this for ok yes no what relay node signal link antenna "
+         "battery north hill tonight tomorrow check works again later anybody here thanks").split()
+SYSTEM = [
+    "Nick set: {nick}", "You joined channel #{channel}", "You left channel #{channel}",
+    "Channel #{channel} members: {nick}, alice, bob42", "Unknown command. Type /help",
+    "[System] Admin {nick} kicked user bob42 for reason: spamming", "User not found.",
+]
+
+def sample_messages(count, seed=1):
+    rnd = random.Random(seed)
+    for i in range(count):
+        nick, channel = rnd.choice(NICKS), rnd.choice(CHANNELS)
+        if i % 10 == 9:
+            yield rnd.choice(SYSTEM).format(nick=nick, channel=channel)
+            continue
+        text = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randrange(1, 16)))
+        yield f"[{rnd.randrange(24):02}:{rnd.randrange(60):02}] [&2#{channel}&r]  &9{nick}&r: {text}"
+
+def plain_deflate(data):
+    # Same per-message deflate, but without the preset dictionary.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9)
+    packed = b'\x01' + compressor.compress(data) + compressor.flush()
+    return packed if len(packed) < len(data) else data
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes on the wire per chat message with and without compression.")
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--link-kbps', type=float, default=10.0)
+    args = parser.parse_args()
+
+    fernet = Fernet(Fernet.generate_key())
+    messages = [m.encode() for m in sample_messages(args.messages)]
+    for data in messages:
+        assert decompress_payload(compress_payload(data)) == data
+
+    variants = [
+        ("raw", lambda d: d),
+        ("deflate", plain_deflate),
+        ("deflate + dictionary", compress_payload),
+    ]
+    print(f"{len(messages)} messages, average text {sum(map(len, messages)) / len(messages):.1f} bytes")
+    baseline = {}
+    for encrypted in (False, True):
+        for label, codec in variants:
+            total = 0
+            for data in messages:
+                payload = codec(data)
+                if encrypted:
+                    payload = fernet.encrypt(payload)
+                total += HEADER_SIZE + len(payload)
+            per_message = total / len(messages)
+            baseline.setdefault(encrypted, per_message)
+            airtime = per_message * 8 / (args.link_kbps * 1000) * 1000
+            name = f"{'fernet' if encrypted else 'plain'} / {label}"
+            print(f"{name:>29}: {per_message:7.1f} bytes/message | {airtime:6.1f} ms at {args.link_kbps:g} kbps | "
+                  f"{per_message / baseline[encrypted] * 100:5.1f}% of raw")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Opens N idle connections against a throwaway copy of the server, once per
+# engine, and reports how many connections each engine holds per MB of RSS.
+#
+#   python3 tools/bench_engines.py --clients 1000
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server')
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def rss_mb(pid):
+    with open(f'/proc/{pid}/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def make_server_dir(engine, port, clients, extra=None):
+    workdir = tempfile.mkdtemp(prefix='privnet-bench-')
+    for name in os.listdir(SERVER_DIR):
+        if name.endswith('.py'):
+            shutil.copy(os.path.join(SERVER_DIR, name), workdir)
+    shutil.copytree(os.path.join(SERVER_DIR, 'plugins'), os.path.join(workdir, 'plugins'))
+    with open(os.path.join(workdir, 'plugins.cfg'), 'w') as f:
+        f.write("plugins = \n")
+    config = {
+        "ip": "127.0.0.1",
+        "port": port,
+        "encryption": False,
+        "welcome_text": "&2bench",
+        "max_clients": clients + 16,
+        "engine": engine,
+    }
+    config.update(extra or {})
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    return workdir
+
+def read_frame(sock):
+    header = b''
+    while len(header) < 4:
+        chunk = sock.recv(4 - len(header))
+        if not chunk:
+            raise ConnectionError("server closed the connection")
+        header += chunk
+    length = int.from_bytes(header, 'big')
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("server closed the connection")
+        data += chunk
+    return data
+
+def launch(workdir, port, stdout=subprocess.DEVNULL):
+    # Starts server.py in workdir and waits until it accepts connections.
+    env = dict(os.environ, PYTHONPATH=os.path.join(SERVER_DIR, '..'))
+    # In its own session, so a multi-process server can be stopped as a group.
+    proc = subprocess.Popen([sys.executable, 'server.py'], cwd=workdir, stdin=subprocess.PIPE, env=env,
+                            stdout=stdout, stderr=subprocess.STDOUT, start_new_session=True)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if time.time() > deadline or proc.poll() is not None:
+                proc.kill()
+                raise RuntimeError(f"server in {workdir} did not start")
+            time.sleep(0.1)
+    time.sleep(0.5)
+    return proc
+
+def measure(engine, port, clients):
+    workdir = make_server_dir(engine, port, clients)
+    proc = launch(workdir, port)
+    socks = []
+    try:
+        idle = rss_mb(proc.pid)
+        for _ in range(clients):
+            s = socket.create_connection(('127.0.0.1', port))
+            read_frame(s)
+            socks.append(s)
+        time.sleep(1.0)
+        loaded = rss_mb(proc.pid)
+        return idle, loaded
+    finally:
+        for s in socks:
+            s.close()
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare connections per MB of RSS for both server engines.")
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--port', type=int, default=25251)
+    parser.add_argument('--engines', default='threaded,asyncio')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for i, engine in enumerate(args.engines.split(',')):
+        idle, loaded = measure(engine, args.port + i, args.clients)
+        per_conn_kb = (loaded - idle) * 1024 / args.clients
+        print(f"{engine:>9}: {args.clients} connections | RSS idle {idle:.1f} MB, loaded {loaded:.1f} MB | "
+              f"{per_conn_kb:.1f} KB/connection | {args.clients / loaded:.2f} connections/MB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import time
+
+from cryptography.fernet import Fernet
+
+# Channel fan-out micro-benchmark: messages/sec against channel size for the
+# old path (one Fernet encryption per recipient) and the encrypt-once path
+# (one frame built per message and written to every recipient).
+#
+#   python3 tools/bench_fanout.py --sizes 1,10,50,200,1000
+
+MESSAGE = "[12:00] [&2#general&r]  &9DyadaMorgan&r: Hello, how is the link today?"
+
+class NullSocket:
+    def __init__(self):
+        self.sent = 0
+
+    def sendall(self, data):
+        self.sent += len(data)
+
+def per_recipient(fernet, members, message):
+    for sock in members:
+        data = fernet.encrypt(message.encode())
+        sock.sendall(len(data).to_bytes(4, 'big') + data)
+
+def encrypt_once(fernet, members, message):
+    data = fernet.encrypt(message.encode())
+    frame = len(data).to_bytes(4, 'big') + data
+    for sock in members:
+        sock.sendall(frame)
+
+def rate(fn, fernet, members, seconds):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        fn(fernet, members, MESSAGE)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Messages/sec of channel fan-out by channel size.")
+    parser.add_argument('--sizes', default='1,10,50,200,1000')
+    parser.add_argument('--seconds', type=float, default=1.0)
+    args = parser.parse_args()
+
+    fernet = Fernet(Fernet.generate_key())
+    print(f"{'members':>8} {'per-recipient msg/s':>20} {'encrypt-once msg/s':>19} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        members = [NullSocket() for _ in range(size)]
+        old = rate(per_recipient, fernet, members, args.seconds)
+        new = rate(encrypt_once, fernet, members, args.seconds)
+        print(f"{size:>8} {old:>20.0f} {new:>19.0f} {new / old:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
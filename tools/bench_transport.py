@@ -0,0 +1,48 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cryptography.fernet import Fernet
+from bench_compression import sample_messages
+from protocol.aead import CIPHERS, Opener, Sealer, derive_key, master_key, new_salt
+from protocol.compression import compress_payload
+from protocol.framing import HEADER_SIZE
+
+# Bytes on the wire and CPU time (encrypt + decrypt) per chat message for
+# Fernet and the AEAD transports, with and without compression.
+#
+#   python3 tools/bench_transport.py --messages 5000
+
+def transports(key):
+    fernet = Fernet(key)
+    yield "fernet", fernet.encrypt, fernet.decrypt
+    for cipher in CIPHERS:
+        aead_key = derive_key(master_key(key), new_salt(), b'server')
+        sealer, opener = Sealer(cipher, aead_key), Opener(cipher, aead_key)
+        yield cipher, sealer.seal, opener.open
+
+def main():
+    parser = argparse.ArgumentParser(description="Wire bytes and CPU per message for each transport.")
+    parser.add_argument('--messages', type=int, default=5000)
+    args = parser.parse_args()
+
+    key = Fernet.generate_key()
+    plain = [m.encode() for m in sample_messages(args.messages)]
+    packed = [compress_payload(m) for m in plain]
+    print(f"{len(plain)} messages, average text {sum(map(len, plain)) / len(plain):.1f} bytes")
+    for compressed, messages in ((False, plain), (True, packed)):
+        for name, encrypt, decrypt in transports(key):
+            start = time.perf_counter()
+            tokens = [encrypt(m) for m in messages]
+            for token in tokens:
+                decrypt(token)
+            elapsed = time.perf_counter() - start
+            wire = sum(HEADER_SIZE + len(t) for t in tokens) / len(tokens)
+            label = f"{name}{' + deflate' if compressed else ''}"
+            print(f"{label:>18}: {wire:7.1f} bytes/message | {elapsed / len(tokens) * 1e6:6.1f} us/message (encrypt + decrypt)")
+
+if __name__ == '__main__':
+    main()
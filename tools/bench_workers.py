@@ -0,0 +1,86 @@
+import argparse
+import os
+import shutil
+import signal
+import threading
+import time
+
+from cryptography.fernet import Fernet
+from bench_engines import launch, make_server_dir, raise_fd_limit
+from headless import HeadlessClient
+
+# Channel throughput with 1 and N worker processes (SO_REUSEPORT + bus).
+# Listeners and talkers sit in one channel spread over the workers; every
+# talker sends its messages as fast as it can, and the run ends when every
+# listener has received all of them.
+#
+#   python3 tools/bench_workers.py --workers 1,4 --listeners 200
+
+def run(workers, args, port):
+    key = Fernet.generate_key()
+    workdir = make_server_dir(args.engine, port, args.listeners + args.talkers, {
+        "encryption": True, "key_path": "secret.key", "workers": workers,
+        "send_queue_size": args.talkers * args.messages + 64,
+        "flood_control": {"enabled": False},
+    })
+    with open(os.path.join(workdir, 'secret.key'), 'wb') as f:
+        f.write(key)
+    proc = launch(workdir, port)
+    try:
+        proc.stdin.write(b"/create main\n")
+        proc.stdin.flush()
+        time.sleep(0.5)
+        clients = []
+        for i in range(args.listeners + args.talkers):
+            c = HeadlessClient('127.0.0.1', port, key, timeout=60)
+            c.recv()
+            c.send(f'/nick bench{i}')
+            c.recv()
+            c.send('/join main')
+            c.recv()
+            clients.append(c)
+        listeners, talkers = clients[:args.listeners], clients[args.listeners:]
+        expected = args.talkers * args.messages
+        time.sleep(0.5)
+
+        def listen(c):
+            for _ in range(expected):
+                c.recv()
+
+        def talk(c):
+            for n in range(args.messages):
+                c.send(f"message {n} from a benchmark talker")
+
+        readers = [threading.Thread(target=listen, args=(c,)) for c in listeners]
+        writers = [threading.Thread(target=talk, args=(c,)) for c in talkers]
+        start = time.perf_counter()
+        for t in readers + writers:
+            t.start()
+        for t in readers:
+            t.join()
+        elapsed = time.perf_counter() - start
+        return expected, expected * args.listeners / elapsed, elapsed
+    finally:
+        # Worker 0 takes the other workers down with it.
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Channel throughput with one or more worker processes.")
+    parser.add_argument('--workers', default='1,4')
+    parser.add_argument('--listeners', type=int, default=100)
+    parser.add_argument('--talkers', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--engine', default='threaded')
+    parser.add_argument('--port', type=int, default=25271)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(f"{os.cpu_count()} CPUs, {args.listeners} listeners, {args.talkers} talkers x {args.messages} messages")
+    for i, workers in enumerate(int(w) for w in args.workers.split(',')):
+        messages, rate, elapsed = run(workers, args, args.port + i)
+        print(f"{workers:>3} worker(s): {messages} messages in {elapsed:.2f} s | {rate:,.0f} deliveries/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import shutil
+import signal
+import time
+
+from cryptography.fernet import Fernet
+from bench_engines import launch, make_server_dir
+from headless import HeadlessClient
+
+# Starts three linked servers on loopback and checks what users see:
+#
+#   alpha --- bravo --- charlie        (bravo also dials charlie: a loop)
+#
+# channel sync, channel messages and /msg across two hops, a refused loop,
+# link loss, and a nick collision when charlie, started on its own, is
+# linked back with /link.
+#
+#   python3 tools/check_links.py
+
+SERVERS = ('alpha', 'bravo', 'charlie')
+
+class Network:
+    def __init__(self, base_port, engine, workers):
+        self.link_key = Fernet.generate_key()
+        self.ports = {name: base_port + 2 * i for i, name in enumerate(SERVERS)}
+        self.keys = {}
+        self.dirs = {}
+        self.procs = {}
+        self.peers = {
+            'alpha': [self.link_address('bravo')],
+            'bravo': [self.link_address('charlie')],
+            'charlie': [self.link_address('bravo')],
+        }
+        for name in SERVERS:
+            self.keys[name] = Fernet.generate_key()
+            self.dirs[name] = make_server_dir(engine, self.ports[name], 32, {
+                "encryption": True, "key_path": "secret.key",
+                "flood_control": {"enabled": False}, "workers": workers,
+            })
+            self.configure(name)
+            for filename, key in (('secret.key', self.keys[name]), ('link.key', self.link_key)):
+                with open(os.path.join(self.dirs[name], filename), 'wb') as f:
+                    f.write(key)
+
+    def link_address(self, name):
+        return f"127.0.0.1:{self.ports[name] + 1}"
+
+    def configure(self, name, isolated=False):
+        path = os.path.join(self.dirs[name], 'config.json')
+        with open(path) as f:
+            config = json.load(f)
+        config['link'] = {"name": name, "key_path": "link.key", "port": 0 if isolated else self.ports[name] + 1,
+                          "peers": [] if isolated else self.peers[name], "retry": 1}
+        with open(path, 'w') as f:
+            json.dump(config, f)
+
+    def start(self, name, channel=None):
+        log = open(os.path.join(self.dirs[name], 'out.log'), 'a')
+        self.procs[name] = launch(self.dirs[name], self.ports[name], stdout=log)
+        if channel:
+            self.console(name, f"/create {channel}")
+
+    def console(self, name, command):
+        self.procs[name].stdin.write(f"{command}\n".encode())
+        self.procs[name].stdin.flush()
+
+    def stop(self, name):
+        proc = self.procs.pop(name)
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+    def user(self, server, nick, channel=None):
+        c = HeadlessClient('127.0.0.1', self.ports[server], self.keys[server], timeout=5)
+        c.recv()
+        c.send(f'/nick {nick}')
+        c.nick_reply = c.recv()
+        if channel:
+            c.send(f'/join {channel}')
+            c.recv()
+        return c
+
+    def close(self):
+        for name in list(self.procs):
+            self.stop(name)
+        for workdir in self.dirs.values():
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def ask(client, command):
+    client.send(command)
+    return client.recv()
+
+def drain(client, seconds=1.0):
+    client.sock.settimeout(seconds)
+    lines = []
+    try:
+        while True:
+            line = client.recv()
+            if line is None:
+                break
+            lines.append(line)
+    except OSError:
+        pass
+    client.sock.settimeout(5)
+    return lines
+
+def check(label, ok, detail=''):
+    print(f"{'PASS' if ok else 'FAIL'}: {label}{f' ({detail})' if detail and not ok else ''}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Check server links with three local servers.")
+    parser.add_argument('--port', type=int, default=25301)
+    parser.add_argument('--engine', default='threaded')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    net = Network(args.port, args.engine, args.workers)
+    results = []
+    try:
+        net.start('bravo', 'main')
+        net.start('alpha', 'lobby')
+        twin_a = net.user('alpha', 'twin')
+        net.start('charlie', 'games')
+        time.sleep(2)
+
+        a = net.user('alpha', 'anna', 'main')
+        b = net.user('bravo', 'boris', 'main')
+        c = net.user('charlie', 'chen', 'main')
+        twin_c = net.user('charlie', 'twin2')
+        time.sleep(0.5)
+
+        channels = ask(a, '/list')
+        results.append(check("channel lists are merged", all(f'#{n}' in channels for n in ('main', 'lobby', 'games')), channels))
+        results.append(check("a nick taken on another server is refused",
+                             ask(twin_c, '/nick twin') == "Nick is already in use."))
+        who = ask(c, '/who')
+        results.append(check("/who lists members on every server", all(n in who for n in ('anna', 'boris', 'chen')), who))
+
+        a.send('hello from alpha')
+        c.send('hello from charlie')
+        time.sleep(0.5)
+        seen = {name: [line for line in drain(client) if 'hello from' in line] for name, client in
+                (('anna', a), ('boris', b), ('chen', c))}
+        results.append(check("channel messages reach every server",
+                             all(len(lines) == 2 for lines in seen.values()), seen))
+
+        a.send('/msg chen psst')
+        drain(a, 0.3)
+        results.append(check("/msg across two links", any('anna ➔ You]: psst' in line for line in drain(c)), ''))
+
+        logs = ''.join(open(os.path.join(net.dirs[name], 'out.log')).read() for name in ('bravo', 'charlie'))
+        results.append(check("a link that would close a loop is refused", 'already linked' in logs))
+
+        # Link loss, then a nick collision: both sides give out "solo" while
+        # charlie runs on its own, and linking it back renames the later one.
+        net.stop('charlie')
+        time.sleep(1)
+        who = ask(a, '/who')
+        results.append(check("link loss drops the other server's users", 'chen' not in who and 'boris' in who, who))
+        solo_a = net.user('alpha', 'solo')
+        net.configure('charlie', isolated=True)
+        net.start('charlie')
+        time.sleep(0.5)
+        solo_c = net.user('charlie', 'solo', 'main')
+        c = net.user('charlie', 'chen', 'main')
+        net.console('charlie', f"/link {net.link_address('bravo')}")
+        time.sleep(2)
+        notice = drain(solo_c)
+        results.append(check("nick collision renames the later claim",
+                             any('your nick is now Guest' in line for line in notice) and not drain(solo_a, 0.3), notice))
+        who = ask(a, '/who')
+        results.append(check("users are back after relinking", 'chen' in who and 'Guest' in who, who))
+        results.append(check("/msg finds the nick owner after the collision",
+                             'solo' in ask(solo_c, '/msg solo hi') and any('hi' in line for line in drain(solo_a))))
+    finally:
+        net.close()
+    print(f"{sum(results)}/{len(results)} checks passed")
+
+if __name__ == '__main__':
+    main()
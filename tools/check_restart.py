@@ -0,0 +1,80 @@
+import argparse
+import os
+import shutil
+import signal
+import time
+
+from bench_engines import launch, make_server_dir
+from headless import HeadlessClient
+
+# Checks that /restart keeps what users see, for a channel created and a
+# topic set right before it (the channel store writes back every few
+# seconds, so both are still only in memory):
+#
+#   python3 tools/check_restart.py --engine asyncio
+
+def drain(client, seconds=1.0):
+    client.sock.settimeout(seconds)
+    lines = []
+    try:
+        while True:
+            line = client.recv()
+            if line is None:
+                break
+            lines.append(line)
+    except OSError:
+        pass
+    client.sock.settimeout(5)
+    return lines
+
+def check(label, ok, detail=''):
+    print(f"{'PASS' if ok else 'FAIL'}: {label}{f' ({detail})' if detail and not ok else ''}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Check /restart with channel changes made just before it.")
+    parser.add_argument('--port', type=int, default=25401)
+    parser.add_argument('--engine', default='threaded')
+    args = parser.parse_args()
+
+    workdir = make_server_dir(args.engine, args.port, 8, {"flood_control": {"enabled": False}})
+    proc = launch(workdir, args.port, stdout=open(os.path.join(workdir, 'out.log'), 'w'))
+    results = []
+
+    def console(command):
+        proc.stdin.write(f"{command}\n".encode())
+        proc.stdin.flush()
+
+    try:
+        console("/create main")
+        time.sleep(0.2)
+        users = []
+        for nick in ('user0', 'user1'):
+            c = HeadlessClient('127.0.0.1', args.port, timeout=5)
+            c.recv()
+            c.send(f'/nick {nick}')
+            c.send('/join main')
+            drain(c, 0.3)
+            users.append(c)
+        console("/topic main set just before the restart")
+        console("/restart")
+        time.sleep(3)
+
+        a, b = users
+        a.send('hi')
+        results.append(check("members stay in a channel created right before /restart",
+                             any('user0' in line and 'hi' in line for line in drain(b)), drain(a, 0.3)))
+        c = HeadlessClient('127.0.0.1', args.port, timeout=5)
+        c.recv()
+        c.send('/join main')
+        joined = drain(c)
+        results.append(check("a topic set right before /restart is kept",
+                             any('set just before the restart' in line for line in joined), joined))
+    finally:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"{sum(results)}/{len(results)} checks passed")
+
+if __name__ == '__main__':
+    main()
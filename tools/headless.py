@@ -0,0 +1,92 @@
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cryptography.fernet import Fernet
+from protocol.aead import AEAD_MARKER, Opener, Sealer, derive_key, master_key, parse_transport
+from protocol.compact import COMPACT, COMPACT_MARK, CompactDecoder, encode_command
+from protocol.compression import CAPS_COMMAND, DEFLATE, compress_payload, decompress_payload, parse_caps
+from protocol.framing import HEADER_SIZE, FrameReader, encode_frame
+
+# Minimal GUI-less PrivNet client for the benchmark tools. It speaks the same
+# protocol as the Qt client, including /caps negotiation, and counts the
+# bytes it puts on and takes off the link.
+
+class HeadlessClient:
+    def __init__(self, host, port, key=None, timeout=10):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = FrameReader(self.sock)
+        self.fernet = Fernet(key) if key else None
+        self.master = master_key(key) if key else None
+        self.codec = None
+        self.opener = None
+        self.sealer = None
+        self.compact = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def negotiate(self, offer):
+        # Offers the given capabilities and waits for the reply; returns
+        # what the server accepted.
+        if not offer:
+            return []
+        self.send(' '.join([CAPS_COMMAND] + list(offer)))
+        while True:
+            reply = self.recv()
+            if reply is None:
+                raise ConnectionError("server closed the connection")
+            if reply.startswith("Unknown command"):
+                return []
+            if reply == CAPS_COMMAND or reply.startswith(CAPS_COMMAND + ' '):
+                break
+        args = reply[len(CAPS_COMMAND):]
+        codecs = parse_caps(args)
+        self.codec = codecs[0] if codecs else None
+        transport = parse_transport(args)
+        if transport and self.master:
+            cipher, server_salt, session_salt = transport
+            self.opener = Opener(cipher, derive_key(self.master, server_salt, b'server'))
+            self.sealer = Sealer(cipher, derive_key(self.master, session_salt, b'client'))
+        if COMPACT in args.split():
+            self.compact = CompactDecoder()
+        return args.split()
+
+    def send(self, message):
+        if self.compact:
+            message = encode_command(message)
+        data = message.encode()
+        if self.codec == DEFLATE:
+            data = compress_payload(data)
+        if self.sealer:
+            data = self.sealer.seal(data)
+        elif self.fernet:
+            data = self.fernet.encrypt(data)
+        frame = encode_frame(data)
+        self.sock.sendall(frame)
+        self.bytes_out += len(frame)
+        self.frames_out += 1
+
+    def recv(self):
+        # Next message as the Qt client would display it, None on EOF.
+        while True:
+            data = self.reader.read_frame()
+            if data is None:
+                return None
+            self.bytes_in += HEADER_SIZE + len(data)
+            self.frames_in += 1
+            if self.opener and data[:1] == AEAD_MARKER:
+                data = self.opener.open(data)
+            elif self.fernet:
+                data = self.fernet.decrypt(data)
+            message = (decompress_payload(data) if self.codec == DEFLATE else data).decode()
+            if self.compact and message.startswith(COMPACT_MARK):
+                message = self.compact.decode(message)
+            if message is not None:
+                return message
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,529 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cryptography.fernet import Fernet
+from bench_engines import SERVER_DIR, launch, make_server_dir, raise_fd_limit
+from protocol.framing import HEADER_SIZE, encode_frame, parse_header
+
+# Headless load generator. Opens thousands of simulated clients (asyncio, one
+# process) speaking the real protocol, with or without Fernet, runs a
+# scenario against a throwaway server (or --connect to a running one) and
+# reports end-to-end latency percentiles, messages per second, and the
+# server's CPU and peak RSS per phase. Results go to a JSON file; --compare
+# puts two of them side by side.
+#
+#   python3 tools/loadgen.py --clients 1000 --scenario mixed
+#   python3 tools/loadgen.py --clients 200 --no-encryption --scenario burst
+#   python3 tools/loadgen.py --compare old.json new.json
+#
+# A scenario is a list of phases, built in (SCENARIOS) or from a JSON file:
+#
+#   {"phases": [{"phase": "chat", "duration": 10, "talkers": 0.1, "rate": 2, "burst": 1},
+#               {"phase": "msg", "duration": 5, "talkers": 0.2, "rate": 1},
+#               {"phase": "who", "duration": 5, "talkers": 0.1, "rate": 1},
+#               {"phase": "churn", "duration": 10, "workers": 20, "idle": 0.2}]}
+#
+# talkers is the share of clients that send, rate is messages per second per
+# talker (sent `burst` at a time). Every client connects, sets /nick and
+# /joins one of --channels channels first ("setup"). Latencies are measured
+# on one clock: the sender puts its send time in the message.
+
+MARK = 'LG|'
+
+SCENARIOS = {
+    'chat': [{'phase': 'chat', 'duration': 10, 'talkers': 0.1, 'rate': 2, 'burst': 1}],
+    'burst': [{'phase': 'chat', 'duration': 10, 'talkers': 0.05, 'rate': 10, 'burst': 20}],
+    'msg': [{'phase': 'msg', 'duration': 10, 'talkers': 0.2, 'rate': 1}],
+    'who': [{'phase': 'who', 'duration': 10, 'talkers': 0.1, 'rate': 1}],
+    'churn': [{'phase': 'churn', 'duration': 10, 'workers': 20, 'idle': 0.2}],
+}
+SCENARIOS['mixed'] = SCENARIOS['chat'] + SCENARIOS['msg'] + SCENARIOS['who'] + SCENARIOS['churn']
+
+REQUEST_TIMEOUT = 15
+SETTLE_TIMEOUT = 5
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.ended = None
+        self.latencies = {}
+        self.sent = {}
+        self.expected = {}
+        self.received = {}
+        self.errors = 0
+        self.server = None
+
+    def count(self, table, kind, n=1):
+        table[kind] = table.get(kind, 0) + n
+
+    def latency(self, kind, seconds):
+        self.latencies.setdefault(kind, []).append(seconds)
+
+    def pending(self):
+        return sum(self.expected.values()) - sum(self.received.get(k, 0) for k in self.expected)
+
+    def result(self):
+        elapsed = (self.ended or time.perf_counter()) - self.started
+        received = sum(self.received.values())
+        return {
+            'phase': self.name,
+            'duration_s': round(elapsed, 3),
+            'sent': self.sent,
+            'expected': self.expected,
+            'received': self.received,
+            'lost': {k: max(0, v - self.received.get(k, 0)) for k, v in self.expected.items()},
+            'errors': self.errors,
+            'sent_per_s': round(sum(self.sent.values()) / elapsed, 1),
+            'deliveries_per_s': round(received / elapsed, 1),
+            'latency_ms': {kind: summary(values) for kind, values in sorted(self.latencies.items())},
+            'server': self.server,
+        }
+
+def summary(values):
+    values = sorted(values)
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+    return {'count': len(values), 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+            'max': round(values[-1] * 1000, 2)}
+
+class LoadClient:
+    def __init__(self, run, index, fernet):
+        self.run = run
+        self.index = index
+        self.fernet = fernet
+        self.nick = None
+        self.channel = None
+        self.replies = asyncio.Queue()
+        self.writer = None
+
+    async def connect(self, host, port):
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.task = asyncio.ensure_future(self.read_loop())
+        await self.expect(('',))
+        return time.perf_counter() - start
+
+    def send(self, message):
+        data = message.encode()
+        if self.fernet:
+            data = self.fernet.encrypt(data)
+        self.writer.write(encode_frame(data))
+
+    async def read_loop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(HEADER_SIZE)
+                data = await self.reader.readexactly(parse_header(header))
+                at = time.perf_counter()
+                if self.fernet:
+                    data = self.fernet.decrypt(data)
+                message = data.decode()
+                mark = message.find(MARK)
+                if mark >= 0:
+                    self.run.delivered(self, message, message[mark:], at)
+                else:
+                    self.replies.put_nowait((at, message))
+        except (asyncio.IncompleteReadError, OSError, ValueError):
+            pass
+        finally:
+            self.replies.put_nowait((time.perf_counter(), None))
+
+    async def expect(self, prefixes):
+        while True:
+            at, reply = await asyncio.wait_for(self.replies.get(), REQUEST_TIMEOUT)
+            if reply is None:
+                raise ConnectionError("server closed the connection")
+            if reply.startswith(prefixes):
+                return at, reply
+
+    async def request(self, message, prefixes):
+        start = time.perf_counter()
+        self.send(message)
+        at, reply = await self.expect(prefixes)
+        return at - start, reply
+
+    async def login(self, nick, channel):
+        # Returns (nick latency, join latency).
+        nick_time, reply = await self.request(f'/nick {nick}', ('Nick set', 'Nick is'))
+        if not reply.startswith('Nick set'):
+            raise ConnectionError(reply)
+        join_time, reply = await self.request(f'/join {channel}', ('You joined', "Channel #"))
+        if not reply.startswith('You joined'):
+            raise ConnectionError(reply)
+        self.nick, self.channel = nick, channel
+        return nick_time, join_time
+
+    def close(self):
+        if self.writer:
+            self.task.cancel()
+            self.writer.close()
+
+class Run:
+    def __init__(self, args, fernet):
+        self.args = args
+        self.fernet = fernet
+        self.phase = Phase('setup')
+        self.clients = []
+        self.members = {}
+
+    def delivered(self, client, message, marked, at):
+        try:
+            _, kind, sender, sent_at = marked.split('|', 3)
+            sent_at = float(sent_at.split()[0])
+        except ValueError:
+            return
+        if kind == 'chat' and int(sender) == client.index:
+            return
+        if kind == 'msg' and '[You ➔' in message:
+            return
+        self.phase.count(self.phase.received, kind)
+        self.phase.latency(kind, at - sent_at)
+
+    def stamp(self, kind, client):
+        return f"{MARK}{kind}|{client.index}|{time.perf_counter():.6f}"
+
+    def talkers(self, share):
+        count = max(1, int(len(self.clients) * share))
+        return random.sample(self.clients, min(count, len(self.clients)))
+
+    async def settle(self):
+        # Waits for deliveries still in flight, as long as they keep coming.
+        last, idle_since = self.phase.pending(), time.perf_counter()
+        while self.phase.pending() > 0 and time.perf_counter() - idle_since < SETTLE_TIMEOUT:
+            await asyncio.sleep(0.05)
+            if self.phase.pending() != last:
+                last, idle_since = self.phase.pending(), time.perf_counter()
+
+    # --- phases ---
+
+    async def setup(self, host, port, channels):
+        gate = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def join(i):
+            client = LoadClient(self, i, self.fernet)
+            channel = channels[i % len(channels)]
+            async with gate:
+                try:
+                    self.phase.latency('connect', await client.connect(host, port))
+                    nick_time, join_time = await client.login(f"lg{i}", channel)
+                except (OSError, asyncio.TimeoutError, ConnectionError) as e:
+                    self.phase.errors += 1
+                    if self.phase.errors <= 5:
+                        print(f"[!] Client {i} failed to log in: {e}")
+                    client.close()
+                    return
+            self.phase.latency('nick', nick_time)
+            self.phase.latency('join', join_time)
+            self.clients.append(client)
+            self.members[channel] = self.members.get(channel, 0) + 1
+
+        await asyncio.gather(*(join(i) for i in range(self.args.clients)))
+
+    async def chat(self, spec):
+        deadline = time.perf_counter() + spec.get('duration', 10)
+        burst = spec.get('burst', 1)
+        interval = burst / spec.get('rate', 1)
+
+        async def talk(client):
+            next_at = time.perf_counter() + random.uniform(0, interval)
+            while True:
+                await asyncio.sleep(max(0, next_at - time.perf_counter()))
+                if time.perf_counter() >= deadline:
+                    return
+                for _ in range(burst):
+                    client.send(self.stamp('chat', client))
+                self.phase.count(self.phase.sent, 'chat', burst)
+                self.phase.count(self.phase.expected, 'chat', burst * (self.members[client.channel] - 1))
+                await client.writer.drain()
+                next_at += interval
+
+        await asyncio.gather(*(talk(c) for c in self.talkers(spec.get('talkers', 0.1))))
+        await self.settle()
+
+    async def msg(self, spec):
+        deadline = time.perf_counter() + spec.get('duration', 10)
+        interval = 1 / spec.get('rate', 1)
+
+        async def talk(client):
+            await asyncio.sleep(random.uniform(0, interval))
+            while time.perf_counter() < deadline:
+                target = random.choice(self.clients)
+                if target is not client:
+                    client.send(f"/msg {target.nick} {self.stamp('msg', client)}")
+                    self.phase.count(self.phase.sent, 'msg')
+                    self.phase.count(self.phase.expected, 'msg')
+                    await client.writer.drain()
+                await asyncio.sleep(interval)
+
+        await asyncio.gather(*(talk(c) for c in self.talkers(spec.get('talkers', 0.2))))
+        await self.settle()
+
+    async def who(self, spec):
+        deadline = time.perf_counter() + spec.get('duration', 10)
+        interval = 1 / spec.get('rate', 1)
+
+        async def ask(client):
+            await asyncio.sleep(random.uniform(0, interval))
+            while time.perf_counter() < deadline:
+                try:
+                    seconds, _ = await client.request('/who', ('Channel #',))
+                    self.phase.count(self.phase.sent, 'who')
+                    self.phase.count(self.phase.received, 'who')
+                    self.phase.latency('who', seconds)
+                except (OSError, asyncio.TimeoutError, ConnectionError):
+                    self.phase.errors += 1
+                    return
+                await asyncio.sleep(max(0, interval - seconds))
+
+        await asyncio.gather(*(ask(c) for c in self.talkers(spec.get('talkers', 0.1))))
+
+    async def churn(self, spec, host, port, channels):
+        deadline = time.perf_counter() + spec.get('duration', 10)
+
+        async def cycle(worker):
+            n = 0
+            while time.perf_counter() < deadline:
+                client = LoadClient(self, -1, self.fernet)
+                start = time.perf_counter()
+                try:
+                    self.phase.latency('connect', await client.connect(host, port))
+                    await client.login(f"lgc{worker}x{n}", random.choice(channels))
+                    self.phase.latency('churn', time.perf_counter() - start)
+                    self.phase.count(self.phase.sent, 'churn')
+                    await asyncio.sleep(spec.get('idle', 0.2))
+                except (OSError, asyncio.TimeoutError, ConnectionError):
+                    self.phase.errors += 1
+                finally:
+                    client.close()
+                n += 1
+
+        await asyncio.gather(*(cycle(w) for w in range(spec.get('workers', 20))))
+
+# --- server side ---
+
+def process_tree(root):
+    # root and every process below it (worker processes).
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents.setdefault(int(f.read().rsplit(')', 1)[1].split()[1]), []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    tree, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(parents.get(pid, []))
+    return tree
+
+class ServerMonitor:
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.peak_rss = 0.0
+
+    def sample(self):
+        # (CPU seconds, RSS MB) summed over the server's processes.
+        cpu, rss = 0.0, 0.0
+        for pid in process_tree(self.pid):
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / self.ticks
+                rss += int(fields[21]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+            except (OSError, IndexError, ValueError):
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+        return cpu, rss
+
+    async def watch(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(0.5)
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def start_server(args, key):
+    workdir = make_server_dir(args.engine, args.port, args.clients + 64, dict({
+        "encryption": key is not None, "key_path": "secret.key", "workers": args.workers,
+        "flood_control": {"enabled": args.flood},
+    }, **json.loads(args.server_config)))
+    if key:
+        with open(os.path.join(workdir, 'secret.key'), 'wb') as f:
+            f.write(key)
+    proc = launch(workdir, args.port)
+    for i in range(args.channels):
+        proc.stdin.write(f"/create lg{i}\n".encode())
+    proc.stdin.flush()
+    time.sleep(0.5)
+    return workdir, proc
+
+async def run_scenario(args, phases, host, port, key, channels, pid):
+    run = Run(args, Fernet(key) if key else None)
+    monitor = ServerMonitor(pid) if pid and os.path.isdir('/proc') else None
+    watcher = asyncio.ensure_future(monitor.watch()) if monitor else None
+    results = []
+
+    async def timed(phase, work):
+        run.phase = phase
+        if monitor:
+            monitor.peak_rss = 0.0
+            before = monitor.sample()
+        await work
+        phase.ended = time.perf_counter()
+        if monitor:
+            cpu, rss = monitor.sample()
+            phase.server = {'cpu_percent': round((cpu - before[0]) / (phase.ended - phase.started) * 100, 1),
+                            'rss_mb': round(rss, 1), 'rss_mb_peak': round(max(monitor.peak_rss, rss), 1)}
+        results.append(phase.result())
+        print_phase(results[-1])
+
+    await timed(Phase('setup'), run.setup(host, port, channels))
+    if not run.clients:
+        raise SystemExit("No client could log in.")
+    _, version = await run.clients[0].request('/version', ('Server version',))
+    for spec in phases:
+        kind = spec['phase']
+        if kind == 'churn':
+            work = run.churn(spec, host, port, channels)
+        elif kind in ('chat', 'msg', 'who'):
+            work = getattr(run, kind)(spec)
+        else:
+            raise SystemExit(f"Unknown phase {kind!r}.")
+        await timed(Phase(kind), work)
+    if watcher:
+        watcher.cancel()
+    for client in run.clients:
+        client.close()
+    return version.split(':', 1)[-1].strip(), results
+
+def print_phase(result):
+    server = result['server']
+    usage = f" | server CPU {server['cpu_percent']}%, RSS {server['rss_mb_peak']} MB" if server else ""
+    lost = sum(result['lost'].values())
+    print(f"{result['phase']:>6}: {result['duration_s']:.1f} s | sent {result['sent_per_s']}/s | "
+          f"delivered {result['deliveries_per_s']}/s | lost {lost} | errors {result['errors']}{usage}")
+    for kind, s in result['latency_ms'].items():
+        print(f"        {kind:>8} latency ms: p50 {s['p50']} | p90 {s['p90']} | p99 {s['p99']} | "
+              f"max {s['max']} | n={s['count']}")
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    for label, run in (('old', old), ('new', new)):
+        settings = run['settings']
+        print(f"{label}: {run['server_version']} ({run.get('git')}) {run['time']} | {settings['clients']} clients, "
+              f"{settings['engine'] or settings['target']}, {'Fernet' if settings['encryption'] else 'no encryption'}")
+
+    def change(a, b):
+        return f"{a} -> {b}" + (f" ({(b - a) / a * 100:+.0f}%)" if a else "")
+
+    for a, b in zip(old['phases'], new['phases']):
+        if a['phase'] != b['phase']:
+            print(f"phase {a['phase']} vs {b['phase']}: scenarios differ, stopping here")
+            break
+        print(f"{a['phase']}: delivered/s {change(a['deliveries_per_s'], b['deliveries_per_s'])}")
+        for kind in sorted(set(a['latency_ms']) & set(b['latency_ms'])):
+            la, lb = a['latency_ms'][kind], b['latency_ms'][kind]
+            print(f"  {kind} p50 ms {change(la['p50'], lb['p50'])} | p99 ms {change(la['p99'], lb['p99'])}")
+        if a.get('server') and b.get('server'):
+            print(f"  server CPU % {change(a['server']['cpu_percent'], b['server']['cpu_percent'])} | "
+                  f"RSS MB {change(a['server']['rss_mb_peak'], b['server']['rss_mb_peak'])}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the PrivNet server.")
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--scenario', default='mixed', help=f"{', '.join(SCENARIOS)} or a JSON file")
+    parser.add_argument('--no-encryption', action='store_true', help="plain frames instead of Fernet")
+    parser.add_argument('--engine', default='threaded')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--flood', action='store_true', help="keep flood control on in the test server")
+    parser.add_argument('--server-config', default='{}', help="JSON merged into the test server's config.json")
+    parser.add_argument('--port', type=int, default=25351)
+    parser.add_argument('--connect', help="host:port of a running server instead of a test server")
+    parser.add_argument('--key', help="key file of the running server (omit for no encryption)")
+    parser.add_argument('--channel-names', help="comma-separated channels on the running server")
+    parser.add_argument('--pid', type=int, help="pid of the running server, for CPU and RSS")
+    parser.add_argument('--connect-concurrency', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help="results file (default: loadgen-<time>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two results files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    random.seed(args.seed)
+    raise_fd_limit()
+    if args.scenario in SCENARIOS:
+        phases = SCENARIOS[args.scenario]
+    else:
+        with open(args.scenario) as f:
+            phases = json.load(f)['phases']
+
+    workdir = proc = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(':')
+        port = int(port)
+        key = open(args.key, 'rb').read().strip() if args.key else None
+        if not args.channel_names:
+            raise SystemExit("--connect needs --channel-names.")
+        channels = args.channel_names.split(',')
+        pid = args.pid
+    else:
+        host, port = '127.0.0.1', args.port
+        key = None if args.no_encryption else Fernet.generate_key()
+        workdir, proc = start_server(args, key)
+        channels = [f"lg{i}" for i in range(args.channels)]
+        pid = proc.pid
+
+    print(f"{args.clients} clients, {len(channels)} channels, scenario {args.scenario}, "
+          f"{'Fernet' if key else 'no encryption'}, {os.cpu_count()} CPUs")
+    try:
+        version, results = asyncio.run(run_scenario(args, phases, host, port, key, channels, pid))
+    finally:
+        if proc:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    out = args.out or f"loadgen-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(out, 'w') as f:
+        json.dump({
+            'tool': 'loadgen',
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'server_version': version,
+            'git': git_revision(),
+            'machine': {'cpus': os.cpu_count(), 'python': platform.python_version(), 'platform': platform.platform()},
+            'settings': {'clients': args.clients, 'channels': channels, 'scenario': args.scenario, 'phases': phases,
+                         'encryption': key is not None, 'engine': None if args.connect else args.engine,
+                         'workers': None if args.connect else args.workers, 'target': f"{host}:{port}"},
+            'phases': results,
+        }, f, indent=2)
+    print(f"Results saved to {out}")
+
+if __name__ == '__main__':
+    main()
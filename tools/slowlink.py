@@ -0,0 +1,434 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cryptography.fernet import Fernet, InvalidToken
+from bench_engines import launch, make_server_dir
+from headless import HeadlessClient
+from protocol.compression import decompress_payload
+from protocol.framing import HEADER_SIZE
+
+# Slow-link emulator: a TCP proxy that sits between a client and the server
+# and imposes a radio/dial-up link on the bytes going through it, so the
+# real server.py and client framing can be measured on one machine.
+#
+#   python3 tools/slowlink.py proxy --listen 25152 --server 127.0.0.1:25151 --profile radio10k
+#       (point the Qt client at port 25152; --log frames.jsonl records every frame)
+#   python3 tools/slowlink.py measure --profiles radio10k,dialup --backlog 20
+#
+# Each direction is a link of `bandwidth` bits/s (TCP/IP overhead included)
+# with `latency` seconds one way plus up to +-`jitter`. Loss comes in bursts
+# (Gilbert model: `loss` of the packets are lost on average, `loss_burst`
+# in a row); TCP hides a lost packet but delivers it `rto` seconds later,
+# and everything behind it waits. `buffer` bytes can be in flight per
+# direction before the sender is held back, like a modem's buffer.
+# `disconnect_every` drops the connection after a random time around that
+# many seconds. --seed makes the loss, jitter and disconnects repeatable.
+#
+# Per frame the proxy records when it fully arrived from the sender and when
+# it was fully delivered; with --key, Fernet frames are labelled with their
+# text. measure starts a throwaway server and reports, through the emulated
+# link, the time to the first message, the /nick and /join round trips and
+# how long a backlog of channel messages takes to drain.
+
+PROFILES = {
+    'lan': {'bandwidth': 0, 'latency': 0.0005, 'jitter': 0, 'loss': 0, 'loss_burst': 1},
+    'dialup': {'bandwidth': 56000, 'latency': 0.1, 'jitter': 0.02, 'loss': 0.005, 'loss_burst': 1},
+    'gprs': {'bandwidth': 40000, 'latency': 0.4, 'jitter': 0.15, 'loss': 0.01, 'loss_burst': 2},
+    'mesh': {'bandwidth': 20000, 'latency': 0.5, 'jitter': 0.25, 'loss': 0.05, 'loss_burst': 4},
+    'radio10k': {'bandwidth': 10000, 'latency': 0.3, 'jitter': 0.1, 'loss': 0.02, 'loss_burst': 3},
+}
+DEFAULTS = {'rto': 1.0, 'buffer': 16384, 'disconnect_every': 0}
+
+MSS = 1460
+PACKET_OVERHEAD = 40
+
+MODES = {
+    'fernet': [],
+    'deflate': ['deflate'],
+    'compact': ['aesgcm', 'compact', 'deflate'],
+}
+
+class LinkModel:
+    # When each packet of one direction arrives at the other end.
+
+    def __init__(self, settings, rng):
+        self.bandwidth = settings['bandwidth']
+        self.latency = settings['latency']
+        self.jitter = settings['jitter']
+        self.rto = settings['rto']
+        self.rng = rng
+        burst = max(1.0, settings['loss_burst'])
+        loss = min(settings['loss'], 0.99)
+        self.recover = 1 / burst
+        self.fail = loss * self.recover / (1 - loss) if loss else 0.0
+        self.bad = False
+        self.free_at = 0.0
+        self.last_arrival = 0.0
+        self.retransmits = 0
+
+    def lost(self):
+        if self.bad:
+            self.bad = self.rng.random() >= self.recover
+        else:
+            self.bad = self.rng.random() < self.fail
+        return self.bad
+
+    def schedule(self, size, now):
+        start = max(now, self.free_at)
+        while True:
+            sent = start + ((size + PACKET_OVERHEAD) * 8 / self.bandwidth if self.bandwidth else 0)
+            self.free_at = sent
+            if not self.lost():
+                break
+            self.retransmits += 1
+            start = sent + self.rto
+        arrival = sent + max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+        # TCP delivers in order: nothing overtakes a late packet.
+        self.last_arrival = max(arrival, self.last_arrival)
+        return self.last_arrival
+
+class FrameTap:
+    # Splits a byte stream into PrivNet frames: [(size, time, payload)].
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data, now):
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= HEADER_SIZE:
+            size = int.from_bytes(self.buffer[:HEADER_SIZE], 'big')
+            if len(self.buffer) < HEADER_SIZE + size:
+                break
+            frames.append((size, now, bytes(self.buffer[HEADER_SIZE:HEADER_SIZE + size])))
+            del self.buffer[:HEADER_SIZE + size]
+        return frames
+
+class Pipe:
+    def __init__(self, session, direction, model, buffer):
+        self.session = session
+        self.direction = direction
+        self.model = model
+        self.slots = max(1, buffer // MSS)
+        self.tap_in = FrameTap()
+        self.tap_out = FrameTap()
+        self.arrived = []
+        self.delivered = 0
+        self.bytes = 0
+
+    async def run(self, reader, writer):
+        queue = asyncio.Queue(self.slots)
+
+        async def receive():
+            while True:
+                data = await reader.read(MSS)
+                now = time.perf_counter()
+                if not data:
+                    await queue.put(None)
+                    return
+                self.arrived += [at for _, at, _ in self.tap_in.feed(data, now)]
+                await queue.put((self.model.schedule(len(data), now), data))
+
+        async def deliver():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    writer.close()
+                    return
+                arrival, data = item
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+                self.bytes += len(data)
+                for size, at, payload in self.tap_out.feed(data, time.perf_counter()):
+                    self.session.record(self.direction, size, self.arrived[self.delivered], at, payload)
+                    self.delivered += 1
+
+        await asyncio.gather(receive(), deliver())
+
+class Session:
+    def __init__(self, proxy, number):
+        self.proxy = proxy
+        self.number = number
+        self.started = time.perf_counter()
+        self.frames = []
+        self.events = []
+
+    def label(self, payload):
+        if not self.proxy.fernet:
+            return None
+        try:
+            return decompress_payload(self.proxy.fernet.decrypt(payload)).decode(errors='replace')[:80]
+        except (InvalidToken, ValueError):
+            return None
+
+    def record(self, direction, size, arrived, delivered, payload):
+        entry = {'session': self.number, 'dir': direction, 'n': len(self.frames), 'bytes': HEADER_SIZE + size,
+                 'in': round(arrived - self.started, 4), 'out': round(delivered - self.started, 4)}
+        text = self.label(payload)
+        if text is not None:
+            entry['text'] = text
+        self.frames.append(entry)
+        self.proxy.write_log(entry)
+
+    def event(self, what):
+        entry = {'session': self.number, 'event': what, 'at': round(time.perf_counter() - self.started, 4)}
+        self.events.append(entry)
+        self.proxy.write_log(entry)
+
+    def summary(self, up, down):
+        frames_down = [f for f in self.frames if f['dir'] == 'down']
+        waits = sorted(f['out'] - f['in'] for f in frames_down)
+        lines = [f"session {self.number}: {len(self.frames) - len(frames_down)} frames up, {len(frames_down)} down, "
+                 f"{up.bytes} / {down.bytes} bytes, retransmits {up.model.retransmits} / {down.model.retransmits}"]
+        if frames_down:
+            lines.append(f"  first message after {frames_down[0]['out']:.2f} s | time on the link "
+                         f"p50 {waits[len(waits) // 2]:.2f} s, max {waits[-1]:.2f} s")
+        rtts = self.round_trips()
+        if rtts:
+            lines.append("  round trips: " + ", ".join(f"{cmd} {rtt:.2f} s" for cmd, rtt in rtts[:8]))
+        return "\n".join(lines)
+
+    def round_trips(self):
+        # Command sent -> first frame back after it (labelled with --key).
+        rtts = []
+        for i, f in enumerate(self.frames):
+            if f['dir'] == 'up' and f.get('text', '').startswith('/'):
+                reply = next((g for g in self.frames[i + 1:] if g['dir'] == 'down' and g['in'] >= f['out']), None)
+                if reply:
+                    rtts.append((f['text'].split()[0], reply['out'] - f['in']))
+        return rtts
+
+class SlowLinkProxy:
+    def __init__(self, server, up, down, seed=None, key=None, log=None, quiet=False):
+        self.server = server
+        self.up = up
+        self.down = down
+        self.seed = seed
+        self.fernet = Fernet(key) if key else None
+        self.log = open(log, 'a') if log else None
+        self.log_lock = threading.Lock()
+        self.quiet = quiet
+        self.sessions = 0
+        self.finished = []
+
+    def write_log(self, entry):
+        if self.log:
+            with self.log_lock:
+                self.log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self.log.flush()
+
+    def rng(self, number, direction):
+        return random.Random(f"{self.seed}-{number}-{direction}") if self.seed is not None else random.Random()
+
+    async def handle(self, client_reader, client_writer):
+        self.sessions += 1
+        session = Session(self, self.sessions)
+        try:
+            server_reader, server_writer = await asyncio.open_connection(*self.server)
+        except OSError as e:
+            print(f"[!] Can't reach the server: {e}")
+            client_writer.close()
+            return
+        session.event('connect')
+        up = Pipe(session, 'up', LinkModel(self.up, self.rng(session.number, 'up')), self.up['buffer'])
+        down = Pipe(session, 'down', LinkModel(self.down, self.rng(session.number, 'down')), self.down['buffer'])
+        tasks = [asyncio.ensure_future(up.run(client_reader, server_writer)),
+                 asyncio.ensure_future(down.run(server_reader, client_writer))]
+        every = self.up['disconnect_every']
+        if every:
+            rng = self.rng(session.number, 'cut')
+            tasks.append(asyncio.ensure_future(asyncio.sleep(rng.uniform(0.5 * every, 1.5 * every))))
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if every and tasks[2] in done:
+            session.event('disconnect')
+        else:
+            # One side closed; let the other direction finish delivering.
+            done, pending = await asyncio.wait(pending - {tasks[-1]} if every else pending, timeout=30)
+        for task in tasks:
+            task.cancel()
+        client_writer.close()
+        server_writer.close()
+        session.event('close')
+        self.finished.append(session)
+        if not self.quiet:
+            print(session.summary(up, down))
+
+    async def serve(self, host, port, ready=None):
+        server = await asyncio.start_server(self.handle, host, port)
+        if ready:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def start(self, host, port):
+        # In a background thread; returns once it accepts connections.
+        ready = threading.Event()
+        threading.Thread(target=asyncio.run, args=(self.serve(host, port, ready),), daemon=True).start()
+        ready.wait(5)
+
+def link_settings(args, direction):
+    settings = dict(DEFAULTS, **PROFILES[args.profile])
+    for name in list(settings):
+        value = getattr(args, name, None)
+        if value is not None:
+            settings[name] = value
+    bandwidth = getattr(args, f"{direction}_bandwidth", None)
+    if bandwidth is not None:
+        settings['bandwidth'] = bandwidth
+    return settings
+
+def add_link_arguments(parser):
+    for name in ('bandwidth', 'latency', 'jitter', 'loss', 'loss_burst', 'rto', 'disconnect_every'):
+        parser.add_argument(f"--{name.replace('_', '-')}", type=float, help=f"override the profile's {name}")
+    parser.add_argument('--buffer', type=int, help="bytes in flight per direction")
+    parser.add_argument('--up-bandwidth', type=float, help="client -> server bits/s, if different")
+    parser.add_argument('--down-bandwidth', type=float, help="server -> client bits/s, if different")
+    parser.add_argument('--seed', type=int, default=1)
+
+# --- measure ---
+
+def wait_for(client, prefix):
+    while True:
+        message = client.recv()
+        if message is None:
+            raise ConnectionError("server closed the connection")
+        if message.startswith(prefix):
+            return message
+
+def measure_once(port, key, offer, nick):
+    result = {}
+    start = time.perf_counter()
+    slow = HeadlessClient('127.0.0.1', port, key, timeout=120)
+    slow.recv()
+    result['first_message_s'] = time.perf_counter() - start
+    if offer:
+        start = time.perf_counter()
+        slow.negotiate(offer)
+        result['caps_s'] = time.perf_counter() - start
+    for command, reply, name in ((f'/nick {nick}', 'Nick set', 'nick_s'), ('/join main', 'You joined', 'join_s')):
+        start = time.perf_counter()
+        slow.send(command)
+        wait_for(slow, reply)
+        result[name] = time.perf_counter() - start
+    return slow, result
+
+def drain_backlog(slow, talker, backlog, size, result):
+    before = slow.bytes_in
+    text = ('x' * size)[:size]
+    start = time.perf_counter()
+    for i in range(backlog):
+        talker.send(f"backlog {i} {text}")
+    seen = 0
+    while seen < backlog:
+        message = slow.recv()
+        if message is None:
+            raise ConnectionError("server closed the connection")
+        if 'backlog ' in message:
+            seen += 1
+            if seen == 1:
+                result['backlog_first_s'] = time.perf_counter() - start
+    result['backlog_drain_s'] = time.perf_counter() - start
+    result['backlog_bytes'] = slow.bytes_in - before
+
+def measure(args):
+    key = Fernet.generate_key()
+    workdir = make_server_dir('threaded', args.port, 64, dict({
+        "encryption": True, "key_path": "secret.key", "transport": "aesgcm", "compression": True, "compact": True,
+        "flood_control": {"enabled": False}, "send_queue_size": max(256, args.backlog * 2),
+    }, **json.loads(args.server_config)))
+    with open(os.path.join(workdir, 'secret.key'), 'wb') as f:
+        f.write(key)
+    proc = launch(workdir, args.port)
+    results = []
+    try:
+        proc.stdin.write(b"/create main\n")
+        proc.stdin.flush()
+        time.sleep(0.3)
+        talker = HeadlessClient('127.0.0.1', args.port, key)
+        talker.recv()
+        talker.send('/nick talker')
+        talker.recv()
+        talker.send('/join main')
+        talker.recv()
+        print(f"{'profile':>9} {'mode':>8} | first msg | /nick rtt | /join rtt | backlog {args.backlog}x{args.size} B: "
+              f"first, drained, bytes")
+        run = 0
+        for profile in args.profiles.split(','):
+            args.profile = profile
+            up, down = link_settings(args, 'up'), link_settings(args, 'down')
+            for mode in args.modes.split(','):
+                run += 1
+                proxy_port = args.port + run
+                SlowLinkProxy(('127.0.0.1', args.port), up, down, seed=args.seed, quiet=True).start('127.0.0.1',
+                                                                                                    proxy_port)
+                slow, result = measure_once(proxy_port, key, MODES[mode], f"slow{run}")
+                drain_backlog(slow, talker, args.backlog, args.size, result)
+                slow.close()
+                result.update(profile=profile, mode=mode, link=up)
+                results.append(result)
+                print(f"{profile:>9} {mode:>8} | {result['first_message_s']:8.2f}s | {result['nick_s']:8.2f}s | "
+                      f"{result['join_s']:8.2f}s | {result['backlog_first_s']:.2f}s, {result['backlog_drain_s']:.2f}s, "
+                      f"{result['backlog_bytes']} B")
+    finally:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': args.seed, 'results': results}, f, indent=2)
+        print(f"Results saved to {args.out}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulated slow link between a PrivNet client and server.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    proxy = commands.add_parser('proxy', help="run the proxy in front of a server")
+    proxy.add_argument('--listen', type=int, default=25152)
+    proxy.add_argument('--server', default='127.0.0.1:25151')
+    proxy.add_argument('--profile', default='radio10k', choices=sorted(PROFILES))
+    proxy.add_argument('--key', help="server key file, to label Fernet frames in the log")
+    proxy.add_argument('--log', help="append a JSON line per frame and event to this file")
+    add_link_arguments(proxy)
+
+    bench = commands.add_parser('measure', help="measure a throwaway server through the link")
+    bench.add_argument('--profiles', default='lan,dialup,radio10k')
+    bench.add_argument('--modes', default='fernet,compact', help=f"{', '.join(MODES)}")
+    bench.add_argument('--backlog', type=int, default=20, help="channel messages queued for the slow client")
+    bench.add_argument('--size', type=int, default=60, help="bytes of text per backlog message")
+    bench.add_argument('--port', type=int, default=25371)
+    bench.add_argument('--server-config', default='{}', help="JSON merged into the test server's config.json")
+    bench.add_argument('--out', help="save the results as JSON")
+    add_link_arguments(bench)
+    args = parser.parse_args()
+
+    if args.command == 'measure':
+        measure(args)
+        return
+    host, _, port = args.server.rpartition(':')
+    key = open(args.key, 'rb').read().strip() if args.key else None
+    up, down = link_settings(args, 'up'), link_settings(args, 'down')
+    print(f"Emulating {args.profile} on 127.0.0.1:{args.listen} -> {args.server}: "
+          f"{down['bandwidth'] or 'unlimited'} bit/s down, {up['bandwidth'] or 'unlimited'} bit/s up, "
+          f"{down['latency'] * 1000:.0f} ms +-{down['jitter'] * 1000:.0f} ms, loss {down['loss']:.1%} "
+          f"(bursts of {down['loss_burst']:g}), seed {args.seed}")
+    proxy_server = SlowLinkProxy((host, int(port)), up, down, seed=args.seed, key=key, log=args.log)
+    try:
+        asyncio.run(proxy_server.serve('127.0.0.1', args.listen))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()